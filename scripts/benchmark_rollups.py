@@ -0,0 +1,235 @@
+"""
+Compare two ways of adding new hits to the daily rollups:
+
+-   running a separate GROUP BY for each rollup, plus one query for
+    the visitor sessions and one for the earliest day (the old way)
+-   reading the new hits once, and counting them for every rollup
+    in a single pass (what ``AnalyticsDatabase`` does now)
+
+It creates a database with synthetic hits spread over a year, then
+times how long it takes to build the rollups from scratch with each
+approach, in chunks of ``BACKFILL_CHUNK_SIZE`` hits.
+
+Usage:
+
+    python3 scripts/benchmark_rollups.py [HIT_COUNT ...]
+
+The default is to compare them at 1M and 10M hits.  Creating the
+10M-hit database takes a minute or two, and about 1GB of disk space.
+"""
+
+import datetime
+import pathlib
+import sys
+import tempfile
+import time
+
+from analytics.database import (
+    AnalyticsDatabase,
+    BACKFILL_CHUNK_SIZE,
+    NEW_COUNTED_HITS,
+)
+from analytics.date_helpers import to_day_number
+
+
+# The statements we'd run for each chunk of hits, one per rollup.
+SEPARATE_QUERIES = [
+    f"""
+    INSERT INTO daily_pages (day, page_id, hits)
+    SELECT e.day, e.page_id, count(*)
+    {NEW_COUNTED_HITS}
+    GROUP BY e.day, e.page_id
+    ON CONFLICT (day, page_id) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    f"""
+    INSERT INTO daily_countries (day, country, hits)
+    SELECT e.day, e.country, count(*)
+    {NEW_COUNTED_HITS} AND e.country IS NOT NULL
+    GROUP BY e.day, e.country
+    ON CONFLICT (day, country) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    f"""
+    INSERT INTO daily_referrers (day, page_id, referrer_id, hits)
+    SELECT e.day, e.page_id, e.referrer_id, count(*)
+    {NEW_COUNTED_HITS}
+    GROUP BY e.day, e.page_id, e.referrer_id
+    ON CONFLICT (day, page_id, referrer_id) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    f"""
+    INSERT INTO daily_totals (day, hits, visitors)
+    SELECT e.day, count(*), 0
+    {NEW_COUNTED_HITS}
+    GROUP BY e.day
+    ON CONFLICT (day) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    f"""
+    INSERT INTO path_totals (host_id, path, hits)
+    SELECT p.host_id, p.path, count(*)
+    {NEW_COUNTED_HITS}
+    GROUP BY p.host_id, p.path
+    ON CONFLICT (host_id, path) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+]
+
+
+class SeparateQueriesDatabase(AnalyticsDatabase):
+    """
+    Updates the rollups the old way, with a separate query for each rollup.
+    """
+
+    def _update_rollups(self, max_hits: int) -> int:
+        """
+        Add up to ``max_hits`` hits to the daily rollups, reading
+        the new hits once for each rollup.
+        """
+        start_id = self._get_metadata("rollups_high_water_mark")
+
+        end_id, hit_count = self.db.execute(
+            """
+            SELECT max(id), count(*) FROM (
+                SELECT id FROM hits WHERE id > ? ORDER BY id LIMIT ?
+            );
+            """,
+            [start_id, max_hits],
+        ).fetchone()
+
+        if hit_count == 0:
+            return 0
+
+        params = {"start_id": start_id, "end_id": end_id}
+
+        for statement in SEPARATE_QUERIES:
+            self.db.execute(statement, params)
+
+        sessions_by_day: dict[int, set[int]] = {}
+
+        for day, session_id in self.db.execute(
+            f"SELECT e.day, e.session_id {NEW_COUNTED_HITS};", params
+        ):
+            sessions_by_day.setdefault(day, set()).add(session_id)
+
+        self._update_visitor_sketches(sessions_by_day)
+
+        self.db.execute(f"SELECT min(e.day) {NEW_COUNTED_HITS};", params).fetchone()
+
+        self._set_metadata("rollups_high_water_mark", end_id)
+
+        return int(hit_count)
+
+
+def create_database(path: pathlib.Path, hit_count: int) -> None:
+    """
+    Create a database with ``hit_count`` synthetic hits, spread evenly
+    over the year up to today.
+
+    Like the real hits, most of them go to a few popular pages, most of
+    them don't have a referrer, and each visitor looks at a few pages.
+    """
+    db = AnalyticsDatabase(path)
+
+    today = datetime.date.today()
+    first_day = to_day_number(today - datetime.timedelta(days=365))
+    first_timestamp = first_day * 86400
+
+    db.db.executescript(
+        f"""
+        INSERT INTO hosts (id, host) VALUES
+            (1, 'alexwlchan.net'), (2, 'localhost');
+
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n LIMIT 2000)
+        INSERT INTO pages (id, host_id, path, title)
+        SELECT i, CASE WHEN i % 50 = 0 THEN 2 ELSE 1 END, '/page-' || i, 'Page ' || i
+        FROM n;
+
+        WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n LIMIT 500)
+        INSERT INTO referrers (id, referrer, query, normalised_referrer)
+        SELECT i, 'https://example-' || i || '.com/', '[]', 'Example ' || (i % 20)
+        FROM n;
+
+        WITH RECURSIVE n(i) AS (
+            SELECT 1 UNION ALL SELECT i + 1 FROM n LIMIT {hit_count}
+        )
+        INSERT INTO hits (
+            id, date, page_id, referrer_id, session_id, country,
+            is_bot, is_me, url, timestamp, day
+        )
+        SELECT
+            i,
+            '',
+            1 + (abs(random()) % 2000) * (abs(random()) % 2000) / 2000,
+            CASE WHEN abs(random()) % 10 < 7 THEN 1 ELSE 1 + abs(random()) % 500 END,
+            abs(random()) % {max(hit_count // 1000, 1)},
+            CASE abs(random()) % 5
+                WHEN 0 THEN NULL WHEN 1 THEN 'US' WHEN 2 THEN 'GB'
+                WHEN 3 THEN 'DE' ELSE 'FR'
+            END,
+            0,
+            abs(random()) % 20 = 0,
+            NULL,
+            {first_timestamp} + i * 365 * 86400 / {hit_count},
+            {first_day} + i * 365 / {hit_count}
+        FROM n;
+        """
+    )
+    db.db.conn.close()
+
+
+def time_rollups(db: AnalyticsDatabase) -> float:
+    """
+    Empty the rollups, then time how long it takes to rebuild them.
+    """
+    db.db.executescript(
+        """
+        DELETE FROM metadata;
+        DELETE FROM daily_totals;
+        DELETE FROM daily_sketches;
+        DELETE FROM daily_pages;
+        DELETE FROM daily_countries;
+        DELETE FROM daily_referrers;
+        DELETE FROM path_totals;
+        """
+    )
+
+    start = time.perf_counter()
+
+    while db._build_rollups(BACKFILL_CHUNK_SIZE):
+        pass
+
+    return time.perf_counter() - start
+
+
+def get_rollups(db: AnalyticsDatabase) -> list[list[tuple[int, ...]]]:
+    """
+    Return the contents of all the rollups, to check both approaches
+    give the same result.
+    """
+    return [
+        db.db.execute(f"SELECT * FROM {table} ORDER BY 1, 2, 3;").fetchall()
+        for table in ("daily_pages", "daily_countries", "daily_referrers")
+    ] + [
+        db.db.execute(f"SELECT * FROM {table} ORDER BY 1, 2;").fetchall()
+        for table in ("daily_totals", "path_totals")
+    ]
+
+
+if __name__ == "__main__":
+    hit_counts = [int(arg) for arg in sys.argv[1:]] or [1_000_000, 10_000_000]
+
+    for hit_count in hit_counts:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / "benchmark.sqlite"
+            create_database(path, hit_count)
+
+            separate_db = SeparateQueriesDatabase(path)
+            separate_time = time_rollups(separate_db)
+            separate_rollups = get_rollups(separate_db)
+            separate_db.db.conn.close()
+
+            single_pass_db = AnalyticsDatabase(path)
+            single_pass_time = time_rollups(single_pass_db)
+            assert get_rollups(single_pass_db) == separate_rollups
+            single_pass_db.db.conn.close()
+
+        print(f"{hit_count:,} hits:")
+        print(f"  separate queries: {separate_time:6.1f}s")
+        print(f"       single pass: {single_pass_time:6.1f}s")
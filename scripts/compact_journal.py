@@ -0,0 +1,42 @@
+"""
+Load closed segments from the ingest journal into the events table.
+
+This is only needed if the app is running with ``INGEST_MODE = "journal"``.
+Run it as a separate process next to the web server, e.g.
+
+    python3 scripts/compact_journal.py --watch 10
+
+which loads new segments every 10 seconds.  Without ``--watch``, it loads
+whatever segments are waiting and then exits, which is suitable for cron.
+"""
+
+import argparse
+import pathlib
+import time
+
+from analytics.database import AnalyticsDatabase
+from analytics.journal import compact_journal
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="requests.sqlite")
+    parser.add_argument("--journal", default="journal")
+    parser.add_argument(
+        "--watch", type=float, help="keep running, and check every N seconds"
+    )
+    args = parser.parse_args()
+
+    db = AnalyticsDatabase(args.database, migrate=False)
+    journal_dir = pathlib.Path(args.journal)
+
+    while True:
+        loaded_events = compact_journal(db, journal_dir)
+
+        if loaded_events:
+            print(f"Loaded {loaded_events} events from {journal_dir}")
+
+        if args.watch is None:
+            break
+
+        time.sleep(args.watch)
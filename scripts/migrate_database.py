@@ -0,0 +1,54 @@
+"""
+Bring the schema of the events database up to date.
+
+The app doesn't migrate the database itself, because some steps (e.g.
+building a new index) hold the writer lock until they're done, and we
+don't want the tracking pixel to wait for them.  Run this before you
+restart the server -- the app won't use a database which is missing
+any migrations.
+
+Usage:
+
+    python3 scripts/migrate_database.py [--database PATH] [--dry-run]
+
+With ``--dry-run``, it prints the steps it would run and how many rows
+each one touches, without changing anything.  The database is opened
+read-only and without any pragmas, because some of them (e.g.
+``journal_mode``) are saved in the file.
+"""
+
+import argparse
+import pathlib
+import time
+
+from analytics.database import AnalyticsDatabase
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="requests.sqlite")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="describe the pending work, but don't change anything",
+    )
+    args = parser.parse_args()
+
+    if args.dry_run and not pathlib.Path(args.database).exists():
+        plan = ["Create a new database from schema.sql"]
+    elif args.dry_run:
+        db = AnalyticsDatabase(args.database, pragmas={}, read_only=True)
+        plan = db.plan_migrations()
+    else:
+        db = AnalyticsDatabase(args.database, migrate=False)
+        plan = db.plan_migrations()
+
+    if not plan:
+        print("The database is up to date")
+    elif args.dry_run:
+        for step in plan:
+            print(f"- {step}")
+    else:
+        start = time.monotonic()
+        db.migrate(log=print)
+        print(f"Finished in {time.monotonic() - start:.1f}s")
@@ -4,6 +4,7 @@ set -o errexit
 set -o nounset
 
 git pull origin main
+python3 scripts/migrate_database.py
 kill -HUP $(cat analytics.pid)
 curl -v https://analytics.alexwlchan.net >/dev/null
 python3 scripts/update_normalised_referrer.py
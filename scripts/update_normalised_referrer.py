@@ -1,14 +1,41 @@
 """
 Update the database with the latest definitions of get_normalised_referrer().
+
+Each referrer records the version of the rules it was normalised with
+(``RULES_VERSION`` in ``referrers.py``), so we only re-normalise the
+referrers which were normalised with older rules.  If the rules haven't
+changed since the last run, this doesn't do anything.
+
+The referrers are read in chunks, normalised in a pool of worker
+processes, and each chunk is saved in its own short transaction as soon
+as it's ready.  This means we don't hold all the referrers in memory,
+the tracking pixel isn't kept waiting for the writer lock, and if the
+script is interrupted, the next run carries on where it left off.
+
+Usage:
+
+    python3 scripts/update_normalised_referrer.py [--database PATH]
+        [--workers N] [--chunk-size N]
+
 """
 
+from collections.abc import Iterable, Iterator
+import argparse
+import concurrent.futures
 import functools
 import json
+import os
+import time
 
-from sqlite_utils import Database
 import tqdm
 
-from analytics.referrers import get_normalised_referrer, QueryParams
+from analytics.database import AnalyticsDatabase
+from analytics.referrers import get_normalised_referrer, QueryParams, RULES_VERSION
+
+
+Chunk = list[tuple[int, str, str]]
+
+NormalisedChunk = dict[int, str | None]
 
 
 @functools.cache
@@ -20,32 +47,125 @@ def parse_query(qs: str) -> QueryParams:
     return tuple(tuple(q) for q in json.loads(qs))
 
 
-def get_events_to_upsert(db):
+def normalise_chunk(rows: Chunk) -> NormalisedChunk:
     """
-    Find events in the database whose ``normalised_referrer`` is outdated.
+    Normalise a chunk of referrers.  This runs in a worker process.
     """
-    cursor = db["events"].rows_where(
-        "referrer != '' or query != '[]'",
-        select="id, referrer, normalised_referrer, query",
-    )
-    total = db["events"].count_where("referrer != '' or query != '[]'")
+    return {
+        referrer_id: get_normalised_referrer(
+            referrer=referrer, query=parse_query(query)
+        )
+        for referrer_id, referrer, query in rows
+    }
+
+
+def read_outdated_chunks(db: AnalyticsDatabase, chunk_size: int) -> Iterator[Chunk]:
+    """
+    Generate chunks of the referrers which were normalised with older
+    rules, in ID order.
+    """
+    after_id = 0
+
+    while rows := db.get_outdated_referrers(
+        RULES_VERSION, after_id=after_id, limit=chunk_size
+    ):
+        yield rows
+        after_id = rows[-1][0]
+
+
+def save_chunks(
+    db: AnalyticsDatabase,
+    futures: Iterable[concurrent.futures.Future[NormalisedChunk]],
+    progress: tqdm.tqdm,
+) -> int:
+    """
+    Save each chunk of normalised referrers in its own transaction.
+
+    Returns the number of normalised referrers which changed.
+    """
+    changed = 0
 
-    for row in tqdm.tqdm(cursor, total=total):
-        normalised_referrer = get_normalised_referrer(
-            referrer=row["referrer"],
-            query=parse_query(row["query"]),
+    for f in futures:
+        normalised_referrers = f.result()
+        changed += db.update_normalised_referrers(
+            normalised_referrers, rules_version=RULES_VERSION
         )
+        progress.update(len(normalised_referrers))
+
+    return changed
+
+
+def update_outdated_referrers(
+    db: AnalyticsDatabase, *, workers: int, chunk_size: int
+) -> tuple[int, int]:
+    """
+    Re-normalise every referrer which was normalised with older rules.
+
+    Each distinct referrer/query string is only stored once, so we only
+    have to normalise each one once, rather than once per event.
+
+    Returns the number of referrers we normalised, and the number of
+    normalised referrers which changed.
+    """
+    total = db.count_outdated_referrers(RULES_VERSION)
+
+    if total == 0:
+        return 0, 0
+
+    changed = 0
 
-        if normalised_referrer != row["normalised_referrer"]:
-            yield {
-                "id": row["id"],
-                "normalised_referrer": normalised_referrer,
-            }
+    with (
+        concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor,
+        tqdm.tqdm(total=total) as progress,
+    ):
+        pending: set[concurrent.futures.Future[NormalisedChunk]] = set()
+
+        for rows in read_outdated_chunks(db, chunk_size):
+            pending.add(executor.submit(normalise_chunk, rows))
+
+            # Don't read too far ahead of the workers, so we only have
+            # a few chunks in memory at once.
+            if len(pending) >= workers * 2:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                changed += save_chunks(db, done, progress)
+
+        changed += save_chunks(db, concurrent.futures.as_completed(pending), progress)
+
+    return total, changed
 
 
 if __name__ == "__main__":
-    db = Database("requests.sqlite")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database", default="requests.sqlite")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="how many processes to normalise referrers in",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="how many referrers to normalise and save at once",
+    )
+    args = parser.parse_args()
+
+    db = AnalyticsDatabase(args.database, migrate=False)
 
-    events = list(get_events_to_upsert(db))
+    start = time.monotonic()
+    normalised, changed = update_outdated_referrers(
+        db, workers=args.workers, chunk_size=args.chunk_size
+    )
+    elapsed = time.monotonic() - start
 
-    db["events"].upsert_all(events, pk="id")
+    if normalised == 0:
+        print("The normalised referrers are up to date")
+    else:
+        print(
+            f"Normalised {normalised:,} referrers in {elapsed:.1f}s "
+            f"({normalised / elapsed:,.0f} referrers/s), "
+            f"{changed:,} of them changed"
+        )
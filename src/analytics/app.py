@@ -2,20 +2,25 @@
 Main Flask app.
 """
 
+import atexit
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import json
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
 import typing
-import uuid
 
 from flask import (
     abort,
     current_app,
     Flask,
-    g,
     redirect,
     render_template,
     request,
-    send_file,
     url_for,
 )
 from flask import Response as FlaskResponse
@@ -24,18 +29,18 @@ import hyperlink
 from werkzeug.wrappers.response import Response as WerkzeugResponse
 
 from . import date_helpers
-from .countries import (
-    get_country_iso_code,
-    get_country_name,
-    get_flag_emoji,
-    maxmind_db_path,
-)
-from .database import AnalyticsDatabase
-from .fetch_netlify_bandwidth import fetch_netlify_bandwidth_usage
-from .fetch_rss_feed import fetch_rss_feed_entries, NoNewEntries
+from .countries import CountryLookup, get_country_name, get_flag_emoji
+from .database import AnalyticsDatabase, CachedResult, DatabasePool, DEFAULT_PRAGMAS
+from .event_writer import EventWriter
+from .journal import EventJournal
+from .migrations import LATEST_VERSION
+from .fetch_netlify_bandwidth import fetch_netlify_bandwidth_usage, get_retry_after
+from .fetch_rss_feed import fetch_rss_feed, NoNewEntries, save_etag
 from .referrers import get_normalised_referrer
-from .types import RecentPost
+from .refresher import BackgroundRefresher
+from .types import Event, RecentPost
 from .utils import (
+    delete_old_session_keys,
     draw_pi_chart_arc,
     get_hex_color_between,
     get_session_identifier,
@@ -46,29 +51,289 @@ from .utils import (
 app = Flask(__name__)
 
 
-def get_db() -> AnalyticsDatabase:
+# These files are tiny and never change, so we read them into memory
+# once at startup, rather than opening them for every request.
+STATIC_DIR = pathlib.Path(__file__).parent / "static"
+
+TRACKING_PIXEL = (STATIC_DIR / "a.gif").read_bytes()
+ROBOTS_TXT = (STATIC_DIR / "robots.txt").read_bytes()
+
+
+def static_response(
+    body: bytes, *, mimetype: str, cache_control: str | None = None
+) -> FlaskResponse:
+    """
+    Create a response for a static file that's already been read
+    into memory.
+    """
+    headers = {"Content-Length": str(len(body))}
+
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+
+    return FlaskResponse(body, mimetype=mimetype, headers=headers)
+
+
+_extensions_lock = threading.RLock()
+
+
+def get_db_pool() -> DatabasePool:
+    """
+    Return the pool of database connections.
+
+    There's one pool per process, which hands out a long-lived connection
+    to each thread.
     """
-    Open a connection to an instance of AnalyticsDatabase.
+    with _extensions_lock:
+        try:
+            pool: DatabasePool = current_app.extensions["analytics.db_pool"]
+        except KeyError:
+            pool = _create_db_pool(read_only=False)
+            current_app.extensions["analytics.db_pool"] = pool
+
+    return pool
+
 
-    This follows the pattern described for accessing SQLite in the
-    Flask docs: https://flask.palletsprojects.com/en/3.0.x/patterns/sqlite3/
+def get_read_only_db_pool() -> DatabasePool:
     """
-    db = getattr(g, "_database", None)
-    if db is None:
-        db = g._database = AnalyticsDatabase(
-            current_app.config.get("DATABASE_PATH", "requests.sqlite")
+    Return the pool of read-only database connections.
+
+    The dashboard panels use these connections, which are opened with
+    SQLite's ``mode=ro``, so a panel can never write to the database.
+    """
+    with _extensions_lock:
+        try:
+            pool: DatabasePool = current_app.extensions["analytics.read_only_db_pool"]
+        except KeyError:
+            pool = _create_db_pool(read_only=True)
+            current_app.extensions["analytics.read_only_db_pool"] = pool
+
+    return pool
+
+
+def _create_db_pool(*, read_only: bool) -> DatabasePool:
+    """
+    Create a pool of database connections, and check the database has
+    had the latest migrations.
+    """
+    pragmas = {**DEFAULT_PRAGMAS, **current_app.config.get("SQLITE_PRAGMAS", {})}
+
+    # The journal mode is saved in the database file, so a read-only
+    # connection can't set it -- it uses the mode set by the writers.
+    if read_only:
+        pragmas.pop("journal_mode", None)
+
+    pool = DatabasePool(
+        current_app.config.get("DATABASE_PATH", "requests.sqlite"),
+        pragmas=pragmas,
+        read_only=read_only,
+    )
+
+    try:
+        check_database_is_migrated(pool.get())
+    except RuntimeError:
+        pool.close()
+        raise
+
+    return pool
+
+
+def check_database_is_migrated(db: AnalyticsDatabase) -> None:
+    """
+    Refuse to use the database if it hasn't had the latest migrations.
+
+    The app doesn't migrate the database itself, because a migration
+    can hold the writer lock for a long time -- instead, we run
+    ``scripts/migrate_database.py`` when we deploy.
+    """
+    version = db.get_pragma("user_version")
+
+    if version < LATEST_VERSION:
+        message = (
+            f"The database is at version {version}, but the app needs "
+            f"version {LATEST_VERSION}; run scripts/migrate_database.py"
         )
-    return db
+        print(message, file=sys.stderr)
+        raise RuntimeError(message)
+
+
+def get_db() -> AnalyticsDatabase:
+    """
+    Return the connection to AnalyticsDatabase for the current thread.
+    """
+    return get_db_pool().get()
+
+
+def get_read_only_db() -> AnalyticsDatabase:
+    """
+    Return the read-only connection to AnalyticsDatabase for the
+    current thread.
+    """
+    return get_read_only_db_pool().get()
+
+
+def get_event_sink() -> EventWriter | EventJournal:
+    """
+    Return the object which records events from the tracking pixel.
+
+    This depends on the ``INGEST_MODE`` config option:
+
+    *   ``database`` (the default) buffers events in memory, and writes them
+        to the database in batches
+    *   ``journal`` appends events to a journal on local disk, which is
+        loaded into the database by a separate compactor
+        (see ``scripts/compact_journal.py``)
+
+    There's one sink per process, which is created the first time
+    somebody requests the tracking pixel.
+    """
+    with _extensions_lock:
+        try:
+            sink: EventWriter | EventJournal = current_app.extensions[
+                "analytics.event_sink"
+            ]
+        except KeyError:
+            config = current_app.config
+
+            if config.get("INGEST_MODE", "database") == "journal":
+                sink = EventJournal(
+                    pathlib.Path(config.get("JOURNAL_DIRECTORY", "journal")),
+                    max_segment_events=config.get("JOURNAL_SEGMENT_EVENTS", 10000),
+                    max_segment_age=config.get("JOURNAL_SEGMENT_AGE", 60.0),
+                    fsync_interval=config.get("JOURNAL_FSYNC_INTERVAL", 1.0),
+                )
+            else:
+                sink = EventWriter(
+                    get_db_pool(),
+                    batch_size=config.get("EVENT_BATCH_SIZE", 100),
+                    flush_interval=config.get("EVENT_FLUSH_INTERVAL", 1.0),
+                    max_queue_size=config.get("EVENT_QUEUE_SIZE", 10000),
+                    overflow_policy=config.get("EVENT_OVERFLOW_POLICY", "flush"),
+                )
+
+            sink.start()
+            current_app.extensions["analytics.event_sink"] = sink
+
+    return sink
+
+
+def get_country_lookup() -> CountryLookup:
+    """
+    Return the CountryLookup which finds the country for an IP address.
+
+    There's one per process, so the MaxMind database stays open
+    between requests.
+    """
+    with _extensions_lock:
+        try:
+            lookup: CountryLookup = current_app.extensions["analytics.country_lookup"]
+        except KeyError:
+            lookup = CountryLookup(
+                check_interval=current_app.config.get("MAXMIND_CHECK_INTERVAL", 300)
+            )
+            current_app.extensions["analytics.country_lookup"] = lookup
+
+    return lookup
+
 
+def get_dashboard_executor() -> ThreadPoolExecutor:
+    """
+    Return the thread pool which runs the queries for the dashboard panels.
 
-@app.teardown_appcontext
-def close_connection(exception: typing.Any) -> None:
+    There's one pool per process, with at most ``DASHBOARD_THREADS``
+    threads.  Each thread gets its own long-lived read-only connection
+    from ``get_read_only_db_pool()``, so the panels can query SQLite
+    in parallel.
+    """
+    with _extensions_lock:
+        try:
+            executor: ThreadPoolExecutor = current_app.extensions[
+                "analytics.dashboard_executor"
+            ]
+        except KeyError:
+            executor = ThreadPoolExecutor(
+                max_workers=current_app.config.get("DASHBOARD_THREADS", 4),
+                thread_name_prefix="dashboard",
+            )
+            current_app.extensions["analytics.dashboard_executor"] = executor
+
+    return executor
+
+
+def get_background_refresher() -> BackgroundRefresher:
+    """
+    Return the BackgroundRefresher which fetches my RSS feed and
+    my Netlify bandwidth usage for the dashboard.
+
+    There's one per process, which starts fetching the first time
+    somebody looks at the dashboard.  The RSS feed is fetched every
+    ``RSS_FEED_REFRESH_INTERVAL`` seconds, and the Netlify usage every
+    ``NETLIFY_REFRESH_INTERVAL`` seconds (or later, if the Netlify API
+    tells us to wait).
     """
-    Close the database connection (usually at the end of the request).
+    with _extensions_lock:
+        try:
+            refresher: BackgroundRefresher = current_app.extensions[
+                "analytics.background_refresher"
+            ]
+        except KeyError:
+            config = current_app.config
+
+            refresher = BackgroundRefresher()
+            refresher.add_task(
+                "recent_posts",
+                lambda: _run_in_app_context(save_new_posts),
+                interval=config.get("RSS_FEED_REFRESH_INTERVAL", 300),
+            )
+            refresher.add_task(
+                "netlify_usage",
+                fetch_netlify_bandwidth_usage,
+                interval=config.get("NETLIFY_REFRESH_INTERVAL", 3600),
+                retry_after=get_retry_after,
+            )
+
+            refresher.start()
+            current_app.extensions["analytics.background_refresher"] = refresher
+
+    return refresher
+
+
+@atexit.register
+def shutdown() -> None:
     """
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.close()
+    Release any long-lived resources held by the app, e.g. write any
+    events which are still buffered in memory.
+
+    This runs when the process exits, which includes gunicorn shutting
+    down old workers after a ``kill -HUP``.
+    """
+    with _extensions_lock:
+        event_sink = app.extensions.pop("analytics.event_sink", None)
+        refresher = app.extensions.pop("analytics.background_refresher", None)
+        dashboard_executor = app.extensions.pop("analytics.dashboard_executor", None)
+        pool = app.extensions.pop("analytics.db_pool", None)
+        read_only_pool = app.extensions.pop("analytics.read_only_db_pool", None)
+        country_lookup = app.extensions.pop("analytics.country_lookup", None)
+
+    if event_sink is not None:
+        event_sink.stop()
+
+    if refresher is not None:
+        refresher.stop()
+
+    # We wait for any running panels to finish before we close the
+    # database connections they're using.
+    if dashboard_executor is not None:
+        dashboard_executor.shutdown(cancel_futures=True)
+
+    if pool is not None:
+        pool.close()
+
+    if read_only_pool is not None:
+        read_only_pool.close()
+
+    if country_lookup is not None:
+        country_lookup.close()
 
 
 @app.route("/")
@@ -87,22 +352,13 @@ def index() -> str | WerkzeugResponse:
         return render_template("index.html")
 
 
-@app.route("/a.gif")
-def tracking_pixel() -> FlaskResponse:
+def build_event(*, url: str, referrer: str, title: str) -> Event:
     """
-    Tracking pixel.
+    Create an event for a page view in the current request.
 
-    Nobody visits this directly, but they make a request for it and it
-    records a tracking event in the database.  This is based on a combination
-    of query parameters passed in the URL, and the HTTP headers.
+    The page information comes from the arguments; everything else
+    (the IP address, User-Agent and cookies) comes from the HTTP headers.
     """
-    try:
-        url = request.args["url"]
-        referrer = request.args["referrer"]
-        title = request.args["title"]
-    except KeyError:
-        abort(400)
-
     user_agent = request.user_agent.string
 
     u = hyperlink.parse(url)
@@ -111,17 +367,24 @@ def tracking_pixel() -> FlaskResponse:
 
     normalised_referrer = get_normalised_referrer(referrer=referrer, query=u.query)
 
-    country = get_country_iso_code(
-        maxmind_db_path=maxmind_db_path(), ip_address=ip_address
+    country = get_country_lookup().get_country_iso_code(ip_address)
+
+    now = datetime.datetime.now()
+    key_dir = pathlib.Path(
+        current_app.config.get("SESSION_KEY_DIRECTORY", "session_keys")
     )
 
-    event = {
-        "id": uuid.uuid4(),
-        "date": datetime.datetime.now().isoformat(),
+    delete_old_session_keys(now, key_dir=key_dir)
+
+    return {
+        "date": now.isoformat(),
         "url": url,
         "title": title,
         "session_id": get_session_identifier(
-            datetime.date.today(), ip_address=ip_address, user_agent=user_agent
+            now.date(),
+            ip_address=ip_address,
+            user_agent=user_agent,
+            key_dir=key_dir,
         ),
         "country": country,
         "host": u.host,
@@ -133,10 +396,86 @@ def tracking_pixel() -> FlaskResponse:
         "is_me": request.cookies.get("analytics.alexwlchan-isMe") == "true",
     }
 
-    db = get_db()
-    db.events_table.insert(event)
 
-    return send_file("static/a.gif")
+@app.route("/a.gif")
+def tracking_pixel() -> FlaskResponse:
+    """
+    Tracking pixel.
+
+    Nobody visits this directly, but they make a request for it and it
+    records a tracking event in the database.  This is based on a combination
+    of query parameters passed in the URL, and the HTTP headers.
+    """
+    try:
+        url = request.args["url"]
+        referrer = request.args["referrer"]
+        title = request.args["title"]
+    except KeyError:
+        abort(400)
+
+    event = build_event(url=url, referrer=referrer, title=title)
+
+    get_event_sink().put(event)
+
+    # The browser needs to fetch the pixel for every page view, or we
+    # won't record the hit.
+    return static_response(
+        TRACKING_PIXEL, mimetype="image/gif", cache_control="no-store"
+    )
+
+
+@app.route("/events", methods=["POST"])
+def record_events() -> FlaskResponse:
+    """
+    Record a batch of events sent in a single request.
+
+    The body is a JSON array of objects with the same fields as the
+    query parameters for the tracking pixel, e.g.
+
+        [{"url": "https://alexwlchan.net/", "referrer": "", "title": "alexwlchan"}]
+
+    This is designed for ``navigator.sendBeacon()``, which sends the body
+    as ``text/plain``, so we don't look at the Content-Type header.
+    """
+    max_body_size = current_app.config.get("EVENTS_MAX_BODY_SIZE", 256 * 1024)
+
+    # Reject a body which is too big before we read it into memory.
+    # A chunked body doesn't have a Content-Length, so we also stop
+    # reading once we're past the limit.
+    if (request.content_length or 0) > max_body_size:
+        abort(413)
+
+    body = request.stream.read(max_body_size + 1)
+
+    if len(body) > max_body_size:
+        abort(413)
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        abort(400)
+
+    max_batch_size = current_app.config.get("EVENTS_MAX_BATCH_SIZE", 100)
+
+    if not isinstance(payload, list) or not 0 < len(payload) <= max_batch_size:
+        abort(400)
+
+    events = []
+
+    for item in payload:
+        try:
+            url, referrer, title = item["url"], item["referrer"], item["title"]
+        except (KeyError, TypeError):
+            abort(400)
+
+        if not all(isinstance(value, str) for value in (url, referrer, title)):
+            abort(400)
+
+        events.append(build_event(url=url, referrer=referrer, title=title))
+
+    get_event_sink().put_many(events)
+
+    return FlaskResponse(status=204)
 
 
 @app.route("/robots.txt")
@@ -146,41 +485,37 @@ def robots_txt() -> FlaskResponse:
 
     This tells bots/crawlers to ignore the entire site.
     """
-    return send_file("static/robots.txt")
+    return static_response(ROBOTS_TXT, mimetype="text/plain")
 
 
-def get_recent_posts() -> list[RecentPost]:
+def save_new_posts() -> None:
     """
-    Return a list of the ten most recent posts, and the number of times
-    they were viewed.
+    Save any new entries from my RSS feed in the database.
+
+    This runs in the background refresher, rather than when somebody
+    looks at the dashboard.
     """
     db = get_db()
 
     try:
-        entries = fetch_rss_feed_entries()
-        db.posts_table.upsert_all(entries, pk="id")
+        feed = fetch_rss_feed(known_hashes=db.get_post_content_hashes())
     except NoNewEntries:
-        pass
+        return
 
-    query = """
-        SELECT p.host, p.path, p.title, p.date_posted, COUNT(e.url) AS count
-        FROM posts p
-        LEFT JOIN events e ON p.host = e.host AND p.path = e.path AND e.is_me = '0'
-        GROUP BY p.host, p.path, p.date_posted
-        ORDER BY p.date_posted DESC
-        LIMIT 10;
+    db.save_posts(feed.entries)
+    save_etag(feed.etag)
+
+
+def get_recent_posts() -> list[RecentPost]:
+    """
+    Return a list of the ten most recent posts, and the number of times
+    they were viewed.
     """
+    # This waits for the first fetch of the RSS feed, if it hasn't
+    # finished yet -- after that, it returns immediately.
+    get_background_refresher().get("recent_posts")
 
-    return [
-        {
-            "host": row["host"],
-            "path": row["path"],
-            "title": row["title"],
-            "date_posted": datetime.datetime.fromisoformat(row["date_posted"]),
-            "count": row["count"],
-        }
-        for row in db.db.query(query)
-    ]
+    return get_read_only_db().count_recent_post_views(limit=10)
 
 
 Counter = dict[str, int]
@@ -196,6 +531,96 @@ app.jinja_env.filters["prettydate"] = date_helpers.prettydate
 app.jinja_env.globals["pi_chart_arc"] = draw_pi_chart_arc
 
 
+def _run_in_app_context(task: Callable[[], typing.Any]) -> typing.Any:
+    """
+    Run a task in a background thread (e.g. saving cached results, or
+    refreshing the RSS feed), which needs an app context to look up
+    the database connection.
+
+    This doesn't catch any errors -- the dashboard panels are run by
+    ``_run_dashboard_panel()``, and if a panel takes too long or fails,
+    ``run_dashboard_panels()`` logs it and shows a placeholder.
+    """
+    with app.app_context():
+        return task()
+
+
+def _run_dashboard_panel(
+    panel: Callable[[], typing.Any],
+) -> tuple[typing.Any, list[CachedResult]]:
+    """
+    Run a dashboard panel in a thread from the dashboard pool, and
+    return its result, and any query results which weren't in the cache.
+    """
+    with app.app_context():
+        return panel(), get_read_only_db().pop_uncached_results()
+
+
+def save_cached_results(results: list[CachedResult]) -> None:
+    """
+    Save the results of dashboard queries in the cache.
+
+    This is best-effort: if we can't save them (e.g. the database is
+    busy), the next dashboard runs the queries again.
+    """
+    try:
+        get_db().save_cached_results(results)
+    except sqlite3.OperationalError as e:
+        print(f"Unable to save cached results: {e}", file=sys.stderr)
+
+
+def run_dashboard_panels(
+    panels: dict[str, Callable[[], typing.Any]],
+) -> dict[str, typing.Any]:
+    """
+    Run the queries for the dashboard panels in parallel, and return
+    a dict (panel name -> result).
+
+    If a panel takes longer than ``DASHBOARD_PANEL_TIMEOUT`` seconds,
+    its result is None, and the dashboard shows a placeholder.  The panel
+    keeps running in the background, but it doesn't hold up the page.
+    Likewise, if a panel fails, its result is None and we log the error.
+
+    Any query results which weren't in the cache are saved in the
+    background, so the page doesn't wait for the writer lock.
+    """
+    executor = get_dashboard_executor()
+    timeout = current_app.config.get("DASHBOARD_PANEL_TIMEOUT", 10)
+
+    futures = {
+        name: executor.submit(_run_dashboard_panel, panel)
+        for name, panel in panels.items()
+    }
+
+    # Every panel starts at the same time, so they share a deadline.
+    deadline = time.monotonic() + timeout
+
+    results = {}
+    uncached_results = []
+
+    for name, future in futures.items():
+        try:
+            results[name], panel_uncached_results = future.result(
+                timeout=max(0, deadline - time.monotonic())
+            )
+            uncached_results.extend(panel_uncached_results)
+        except TimeoutError:
+            print(
+                f"Dashboard panel {name!r} took longer than {timeout}s", file=sys.stderr
+            )
+            results[name] = None
+        except Exception as e:
+            print(f"Dashboard panel {name!r} failed: {e}", file=sys.stderr)
+            results[name] = None
+
+    if uncached_results:
+        executor.submit(
+            _run_in_app_context, lambda: save_cached_results(uncached_results)
+        )
+
+    return results
+
+
 @app.route("/dashboard/")
 def dashboard() -> str:
     """
@@ -215,27 +640,43 @@ def dashboard() -> str:
         end_date = datetime.date.today()
         end_is_default = True
 
-    analytics_db = get_db()
-
-    by_date = analytics_db.count_requests_per_day(start_date, end_date)
-    unique_visitors = analytics_db.count_unique_visitors_per_day(start_date, end_date)
-    visitors_by_country = analytics_db.count_visitors_by_country(start_date, end_date)
-
-    popular_pages = analytics_db.count_hits_per_page(start_date, end_date, limit=25)
-
-    missing_pages = analytics_db.count_missing_pages(start_date, end_date)
-
-    counted_referrers = analytics_db.count_referrers(start_date, end_date)
+    # Each panel runs in a different thread, so it gets the read-only
+    # database connection for that thread.
+    panels = run_dashboard_panels(
+        {
+            "by_date": lambda: get_read_only_db().count_requests_per_day(
+                start_date, end_date
+            ),
+            "unique_visitors": lambda: get_read_only_db().count_unique_visitors_per_day(
+                start_date, end_date
+            ),
+            "total_unique_visitors": lambda: get_read_only_db().count_unique_visitors(
+                start_date, end_date
+            ),
+            "visitors_by_country": lambda: get_read_only_db().count_visitors_by_country(
+                start_date, end_date
+            ),
+            "popular_pages": lambda: get_read_only_db().count_hits_per_page(
+                start_date, end_date, limit=25
+            ),
+            "missing_pages": lambda: get_read_only_db().count_missing_pages(
+                start_date, end_date
+            ),
+            "counted_referrers": lambda: get_read_only_db().count_referrers(
+                start_date, end_date
+            ),
+            "recent_posts": get_recent_posts,
+            "netlify_usage": lambda: get_background_refresher().get("netlify_usage"),
+            "latest_event": lambda: get_read_only_db().get_latest_recorded_event(),
+        }
+    )
 
     country_names = {
-        country: get_country_name(country) for country in visitors_by_country
+        country: get_country_name(country)
+        for country in panels["visitors_by_country"] or {}
     }
 
-    recent_posts = get_recent_posts()
-
-    netlify_usage = fetch_netlify_bandwidth_usage()
-
-    latest_event = analytics_db.get_latest_recorded_event()
+    country_lookup_stats = get_country_lookup().stats()
 
     return render_template(
         "dashboard.html",
@@ -243,16 +684,9 @@ def dashboard() -> str:
         end=end_date,
         start_is_default=start_is_default,
         end_is_default=end_is_default,
-        by_date=by_date,
-        unique_visitors=unique_visitors,
-        popular_pages=popular_pages,
-        missing_pages=list(missing_pages),
-        counted_referrers=counted_referrers,
-        visitors_by_country=visitors_by_country,
+        **panels,
         country_names=country_names,
-        recent_posts=recent_posts,
-        netlify_usage=netlify_usage,
-        latest_event=latest_event,
+        country_lookup_stats=country_lookup_stats,
         now=date_helpers.now(),
         today=datetime.date.today(),
         yesterday=date_helpers.yesterday(),
@@ -17,14 +17,18 @@ This approach means:
 
 import functools
 import glob
+import os
 import pathlib
+import sys
+import threading
+import time
 import typing
 
 import maxminddb
 import pycountry
 
 
-def maxmind_db_path() -> pathlib.Path:
+def maxmind_db_path(directory: pathlib.Path = pathlib.Path(".")) -> pathlib.Path:
     """
     Return the path to the MaxMind database.
 
@@ -35,36 +39,163 @@ def maxmind_db_path() -> pathlib.Path:
     This is the naming convention used in the packages I download
     from MaxMind.
     """
-    # TODO: Should this be a config option?
-    db_folder = max(glob.glob("GeoLite2-Country_*"))
+    db_folder = max(glob.glob(str(directory / "GeoLite2-Country_*")))
     db_path = pathlib.Path(db_folder) / "GeoLite2-Country.mmdb"
     return db_path
 
 
-@functools.lru_cache
-def get_country_iso_code(
-    maxmind_db_path: pathlib.Path, *, ip_address: str
-) -> str | None:
+class CountryLookupStats(typing.TypedDict):
+    """
+    Counters that describe how country lookups are performing.
     """
-    Guess the country where this IP address is located.
 
-    Returns the 2-digit ISO country code, or None if the IP address cannot
-    be geolocated.
+    database: str | None
+    lookups: int
+    cache_hits: int
+    reloads: int
 
-        >>> country_iso_code('52.85.118.55')
-        'US'
 
-        >>> country_iso_code('127.0.0.1')
-        None
+class CountryLookup:
+    """
+    Looks up countries in the newest MaxMind database.
 
+    The database is opened once and memory-mapped, rather than opened
+    for every lookup.  Every ``check_interval`` seconds, we look for
+    a newer ``GeoLite2-Country_*`` folder (or a change to the current
+    database file), and if we find one, we switch to it.
     """
-    with maxminddb.open_database(maxmind_db_path) as reader:
-        result = reader.get(ip_address)
 
-    if isinstance(result, dict) and isinstance(result["country"], dict):
-        return typing.cast(str, result["country"]["iso_code"])
+    def __init__(
+        self,
+        directory: pathlib.Path = pathlib.Path("."),
+        *,
+        check_interval: float = 300,
+        cache_size: int = 10000,
+    ):
+        """
+        Create a new instance of CountryLookup.
+        """
+        self.directory = directory
+        self.check_interval = check_interval
 
-    return None
+        self.reloads = 0
+
+        # The lookup cache is cleared when we switch databases, so we
+        # keep a running total of lookups from previous databases.
+        self._previous_lookups = 0
+        self._previous_cache_hits = 0
+
+        self._reload_lock = threading.Lock()
+        self._next_check = 0.0
+
+        self._path: pathlib.Path | None = None
+        self._mtime: float | None = None
+        self._reader: maxminddb.Reader | None = None
+
+        # When we switch to a new database, another thread may still be
+        # using the old reader, so we wait until the next switch to
+        # close it.
+        self._retired_reader: maxminddb.Reader | None = None
+
+        self._cached_lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def get_country_iso_code(self, ip_address: str) -> str | None:
+        """
+        Guess the country where this IP address is located.
+
+        Returns the 2-digit ISO country code, or None if the IP address cannot
+        be geolocated.
+
+            >>> lookup.get_country_iso_code('52.85.118.55')
+            'US'
+
+            >>> lookup.get_country_iso_code('127.0.0.1')
+            None
+
+        """
+        if time.monotonic() >= self._next_check:
+            self.reload_if_changed()
+
+        return self._cached_lookup(ip_address)
+
+    def _lookup(self, ip_address: str) -> str | None:
+        """
+        Look up an IP address in the current database, bypassing the cache.
+
+        If we haven't been able to open a database yet, we don't know
+        the country.  The cache is cleared when we open one.
+        """
+        if self._reader is None:
+            return None
+
+        result = self._reader.get(ip_address)
+
+        if isinstance(result, dict) and isinstance(result["country"], dict):
+            return typing.cast(str, result["country"]["iso_code"])
+
+        return None
+
+    def reload_if_changed(self) -> None:
+        """
+        Switch to the newest MaxMind database, if it's changed since
+        we last looked.
+
+        This runs in the tracking pixel, so if we can't open the new
+        database (e.g. because it's being replaced), we log the error
+        and keep using the current one until the next check.
+        """
+        with self._reload_lock:
+            self._next_check = time.monotonic() + self.check_interval
+
+            try:
+                path = maxmind_db_path(self.directory)
+                mtime = os.stat(path).st_mtime
+
+                if path == self._path and mtime == self._mtime:
+                    return
+
+                reader = maxminddb.open_database(path, mode=maxminddb.MODE_MMAP)
+            except (OSError, ValueError, maxminddb.InvalidDatabaseError) as e:
+                print(f"Unable to open MaxMind database: {e}", file=sys.stderr)
+                return
+
+            if self._retired_reader is not None:
+                self._retired_reader.close()
+
+            self._retired_reader = self._reader
+            self._reader, self._path, self._mtime = reader, path, mtime
+
+            cache_info = self._cached_lookup.cache_info()
+            self._previous_lookups += cache_info.hits + cache_info.misses
+            self._previous_cache_hits += cache_info.hits
+            self._cached_lookup.cache_clear()
+            self.reloads += 1
+
+    def stats(self) -> CountryLookupStats:
+        """
+        Return counters that describe how the lookups are performing.
+        """
+        cache_info = self._cached_lookup.cache_info()
+
+        return {
+            "database": None if self._path is None else str(self._path),
+            "lookups": self._previous_lookups + cache_info.hits + cache_info.misses,
+            "cache_hits": self._previous_cache_hits + cache_info.hits,
+            "reloads": self.reloads,
+        }
+
+    def close(self) -> None:
+        """
+        Close the MaxMind database.
+        """
+        with self._reload_lock:
+            for reader in (self._reader, self._retired_reader):
+                if reader is not None:
+                    reader.close()
+
+            self._reader = self._retired_reader = None
+            self._path = self._mtime = None
+            self._next_check = 0.0
 
 
 def get_flag_emoji(country_id: str) -> str:
@@ -5,16 +5,248 @@ Ideally this file should handle all interactions between the app and
 the database.
 """
 
+from collections.abc import Callable, Iterable, Iterator, Mapping
 import collections
+import contextlib
 import datetime
+import hashlib
+import json
+import math
+import operator
 import pathlib
+import sqlite3
+import threading
 import typing
+import uuid
 
 from sqlite_utils import Database
-from sqlite_utils.db import Table
+from sqlite_utils.db import Table, View
 
-from .date_helpers import days_between
-from .types import CountedReferrers, MissingPage, PerDayCount, PerPageCount
+from .migrations import (
+    Backfill,
+    LATEST_VERSION,
+    Migration,
+    MIGRATIONS,
+    record_latest_event,
+    split_statements,
+)
+from .date_helpers import (
+    days_between,
+    from_day_number,
+    from_timestamp,
+    to_day_number,
+    to_timestamp,
+)
+from .fetch_rss_feed import RssEntry
+from .hyperloglog import HyperLogLog
+from .referrers import RULES_VERSION
+from .types import (
+    CountedReferrers,
+    Event,
+    MissingPage,
+    PerDayCount,
+    PerPageCount,
+    RecentPost,
+)
+
+
+Pragmas = Mapping[str, str | int]
+
+T = typing.TypeVar("T")
+
+
+class CachedResult(typing.NamedTuple):
+    """
+    The result of a dashboard query, ready to be saved in ``query_cache``.
+    """
+
+    key: str
+    version: str
+    result: str
+
+
+# These settings are applied to every connection we open.
+#
+# In particular, WAL mode means the dashboard can read the database
+# while the tracking pixel is writing to it, and the busy timeout means
+# a writer waits for the lock rather than failing immediately with
+# "database is locked".
+#
+# See https://www.sqlite.org/pragma.html
+DEFAULT_PRAGMAS: Pragmas = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # milliseconds
+    "cache_size": -20000,  # negative means KiB, so this is ~20MB
+    "mmap_size": 268435456,  # 256MB
+}
+
+
+SCHEMA = (pathlib.Path(__file__).parent / "schema.sql").read_text()
+
+
+# The ``events`` view joins the ``hits`` table with the lookup tables,
+# so it looks like a flat table with one row per event.
+#
+# This is written exactly as SQLite stores it in ``sqlite_master``, so
+# we can tell if the view in the database is out of date.
+EVENTS_VIEW = """CREATE VIEW events AS
+SELECT
+    e.id AS id,
+    e.date AS date,
+    e.timestamp AS timestamp,
+    e.day AS day,
+    coalesce(e.url, 'https://' || h.host || p.path) AS url,
+    p.title AS title,
+    e.session_id AS session_id,
+    e.country AS country,
+    h.host AS host,
+    p.path AS path,
+    r.query AS query,
+    r.referrer AS referrer,
+    r.normalised_referrer AS normalised_referrer,
+    e.is_bot AS is_bot,
+    e.is_me AS is_me
+FROM hits e
+JOIN pages p ON p.id = e.page_id
+JOIN hosts h ON h.id = p.host_id
+JOIN referrers r ON r.id = e.referrer_id"""
+
+
+# The indexes on the ``hits`` table, as (name -> columns).
+#
+# The dashboard reads the daily rollups and ``path_totals`` rather than
+# ``hits``, so we only need one index here:
+#
+#   - ``hits_by_timestamp`` finds the latest event, and any hits which
+#     don't have a timestamp yet
+#
+# Any other index on ``hits`` is dropped when the database is migrated,
+# so this is the only place you need to change to add or remove one.
+HITS_INDEXES: dict[str, list[str]] = {
+    "hits_by_timestamp": ["timestamp"],
+}
+
+
+# The hits we count on the dashboard.  We skip my own visits, and visits
+# to local or preview copies of the site.
+#
+# The daily rollups and ``path_totals`` only include these hits, so if
+# you change this, add a migration which empties them and the
+# ``query_cache``, and resets the ``rollups_high_water_mark``, and
+# they'll be rebuilt.
+COUNTED_HITS = """
+    e.is_me = 0
+    AND h.host != 'localhost'
+    AND h.host != '127.0.0.1'
+    AND h.host NOT LIKE '%--alexwlchan.netlify.app'
+"""
+
+# The hits with IDs in the range (:start_id, :end_id] which haven't
+# been added to the rollups yet.
+NEW_COUNTED_HITS = f"""
+    FROM hits e
+    JOIN pages p ON p.id = e.page_id
+    JOIN hosts h ON h.id = p.host_id
+    WHERE e.id > :start_id AND e.id <= :end_id AND {COUNTED_HITS}
+"""
+
+# We read the new hits once, and count them for every rollup in a single
+# pass in ``_update_rollups()``.  Running a separate GROUP BY for each
+# rollup is simpler, but it reads the same hits (and joins them to
+# ``pages`` and ``hosts``) five or six times -- see
+# ``scripts/benchmark_rollups.py`` for a comparison.
+NEW_COUNTED_HITS_FOR_ROLLUPS = f"""
+    SELECT e.day, e.page_id, e.referrer_id, e.country, e.session_id
+    {NEW_COUNTED_HITS};
+"""
+
+# These statements add the counts for a range of hits to the daily
+# rollups.  They only include the new hits, so the cost of keeping the
+# rollups up to date is proportional to the number of hits we write,
+# not the number we've got.
+#
+# The visitor counts are updated separately, in ``_update_visitor_sketches()``.
+UPSERT_ROLLUPS = {
+    "daily_totals": """
+        INSERT INTO daily_totals (day, hits, visitors) VALUES (?, ?, 0)
+        ON CONFLICT (day) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    "daily_pages": """
+        INSERT INTO daily_pages (day, page_id, hits) VALUES (?, ?, ?)
+        ON CONFLICT (day, page_id) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    "daily_countries": """
+        INSERT INTO daily_countries (day, country, hits) VALUES (?, ?, ?)
+        ON CONFLICT (day, country) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    "daily_referrers": """
+        INSERT INTO daily_referrers (day, page_id, referrer_id, hits)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (day, page_id, referrer_id)
+        DO UPDATE SET hits = hits + excluded.hits;
+    """,
+    "path_totals": """
+        INSERT INTO path_totals (host_id, path, hits)
+        SELECT host_id, path, :hits FROM pages WHERE id = :page_id
+        ON CONFLICT (host_id, path) DO UPDATE SET hits = hits + excluded.hits;
+    """,
+}
+
+
+# How many rows we change in each transaction when running a backfill.
+# Each transaction holds the writer lock, so this is small enough that
+# the tracking pixel isn't blocked for long.
+BACKFILL_CHUNK_SIZE = 10000
+
+
+# The most lookup IDs we cache on each connection before we start again.
+MAX_CACHED_DIMENSION_IDS = 100000
+
+
+def legacy_session_id(session_id: str | int) -> int:
+    """
+    Convert a session identifier from the old flat ``events`` table,
+    where it was a UUID-shaped string, to a 64-bit integer.
+    """
+    if isinstance(session_id, int):
+        return session_id
+
+    try:
+        session_bytes = uuid.UUID(session_id).bytes
+    except ValueError:
+        session_bytes = hashlib.sha256(session_id.encode("utf8")).digest()
+
+    return int.from_bytes(session_bytes[:8], byteorder="big", signed=True)
+
+
+def sum_rows(
+    parts: Iterable[list[dict[str, typing.Any]]],
+    *,
+    group_by: list[str],
+    sum_column: str,
+    limit: int | None = None,
+) -> list[dict[str, typing.Any]]:
+    """
+    Combine the rows from several queries, adding up ``sum_column`` for
+    rows with the same values in the ``group_by`` columns.
+
+    Returns the ``limit`` rows with the largest totals, largest first.
+    """
+    totals: dict[tuple[typing.Any, ...], dict[str, typing.Any]] = {}
+
+    for rows in parts:
+        for row in rows:
+            key = tuple(row[column] for column in group_by)
+
+            try:
+                totals[key][sum_column] += row[sum_column]
+            except KeyError:
+                totals[key] = dict(row)
+
+    result = sorted(totals.values(), key=operator.itemgetter(sum_column), reverse=True)
+
+    return result[:limit]
 
 
 class AnalyticsDatabase:
@@ -23,26 +255,72 @@ class AnalyticsDatabase:
     updating and querying it.
     """
 
-    def __init__(self, path: pathlib.Path | str):
+    def __init__(
+        self,
+        path: pathlib.Path | str,
+        *,
+        pragmas: Pragmas = DEFAULT_PRAGMAS,
+        migrate: bool = True,
+        read_only: bool = False,
+    ):
         """
         Create a new instance of AnalyticsDatabase.
+
+        Unless ``migrate`` is False, this brings the schema up to date
+        when the database is opened.
+
+        If ``read_only`` is True, the database is opened with SQLite's
+        ``mode=ro``, so nothing can be written through this connection.
+        The file must already exist, and it's never migrated.
         """
-        self.db = Database(path)
+        # We may close this connection from a different thread to the
+        # one which opened it (see ``DatabasePool.close()``), but it's
+        # only ever used by one thread at a time.
+        if read_only:
+            uri = pathlib.Path(path).absolute().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(path, check_same_thread=False)
+
+        self.db = Database(conn)
         self.path = pathlib.Path(path)
 
+        for name, value in pragmas.items():
+            self.db.execute(f"PRAGMA {name} = {value};")
+
+        # (table, *values) -> id for rows in the hosts/pages/referrers
+        # tables, so we don't have to look them up for every event.
+        self._dimension_ids: dict[tuple[typing.Any, ...], int] = {}
+
+        # Query results which weren't in ``query_cache``; see ``_cached()``.
+        self._uncached_results: list[CachedResult] = []
+
+        if migrate and not read_only:
+            self.migrate()
+
     def close(self) -> None:
         """
         Close the underlying database connection.
         """
         self.db.close()  # type: ignore
 
+    def get_pragma(self, name: str) -> typing.Any:
+        """
+        Return the current value of a SQLite pragma on this connection.
+        """
+        return self.db.execute(f"PRAGMA {name};").fetchone()[0]
+
     @property
-    def events_table(self) -> Table:
+    def events_table(self) -> View:
         """
-        The table which stores all the analytics events -- that is,
+        The view which returns all the analytics events -- that is,
         any time somebody visits my site.
+
+        The events are stored in the ``hits`` table, with the long strings
+        (URLs, titles, referrers) stored once in lookup tables; this view
+        joins them back together.  See ``schema.sql``.
         """
-        return Table(self.db, "events")
+        return View(self.db, "events")  # type: ignore
 
     @property
     def posts_table(self) -> Table:
@@ -52,57 +330,942 @@ class AnalyticsDatabase:
         """
         return Table(self.db, "posts")
 
-    @staticmethod
-    def _where_clause(start_date: datetime.date, end_date: datetime.date) -> str:
+    @property
+    def referrers_table(self) -> Table:
         """
-        This creates a SQLite query fragment that filters out certain
-        values I don't want, and filters to a date range.
+        The table which stores every distinct referrer/query string,
+        and how we normalised it.
         """
-        # Note: we add the 'x' so that complete datestamps
-        # e.g. 2001-02-03T04:56:07Z sort lower than a date like '2001-02-03'
-        return f"""
-            is_me = '0'
-            and host != 'localhost'
-            and host != '127.0.0.1'
-            and host not like '%--alexwlchan.netlify.app'
-            and date >= '{start_date.isoformat()}'
-            and date <= '{end_date.isoformat() + 'x'}'
-        """.strip()
+        return Table(self.db, "referrers")
 
-    def count_requests_per_day(
-        self, start_date: datetime.date, end_date: datetime.date
-    ) -> list[PerDayCount]:
+    def insert_events(self, events: list[Event]) -> None:
         """
-        Given a range of days, return a count of total hits in those days, e.g.
+        Record a batch of events in the database.
 
-            {"2001-01-01" -> 123, "2001-01-02" -> 456, …}
+        All the events are written in a single transaction, so a batch
+        of 100 events only pays for one commit rather than 100.
+        """
+        with self._write_transaction():
+            self._insert_events(events)
+
+    def load_journal_segment(self, segment_name: str, events: list[Event]) -> bool:
+        """
+        Record the events from a segment of the ingest journal, unless
+        that segment has already been loaded.
+
+        The events and a checkpoint for the segment are written in the
+        same transaction, so a segment is loaded exactly once, even if
+        the compactor crashes before it deletes the segment file.
+
+        Returns True if the events were loaded, False if the segment
+        had already been loaded.
+        """
+        with self._write_transaction():
+            is_loaded = self.db.execute(
+                "SELECT 1 FROM journal_checkpoints WHERE segment = ?;", [segment_name]
+            ).fetchone()
+
+            if is_loaded:
+                return False
+
+            self._insert_events(events)
+            self.db.execute(
+                "INSERT INTO journal_checkpoints (segment, event_count) VALUES (?, ?);",
+                [segment_name, len(events)],
+            )
+
+        return True
+
+    def delete_journal_checkpoint(self, segment_name: str) -> None:
+        """
+        Delete the checkpoint for a journal segment.
+
+        This should only be called once the segment file has been deleted,
+        and so can't be loaded again.
+        """
+        with self._write_transaction():
+            self.db.execute(
+                "DELETE FROM journal_checkpoints WHERE segment = ?;", [segment_name]
+            )
+
+    def count_outdated_referrers(self, rules_version: int) -> int:
+        """
+        Count the referrers which weren't normalised with this version
+        of the rules.
+        """
+        return int(
+            self.db.execute(
+                "SELECT count(*) FROM referrers WHERE rules_version IS NOT ?;",
+                [rules_version],
+            ).fetchone()[0]
+        )
+
+    def get_outdated_referrers(
+        self, rules_version: int, *, after_id: int = 0, limit: int
+    ) -> list[tuple[int, str, str]]:
+        """
+        Return the ID, referrer and query string for up to ``limit``
+        referrers which weren't normalised with this version of the rules,
+        in ID order, starting after ``after_id``.
+        """
+        cursor = self.db.execute(
+            """
+            SELECT id, referrer, query
+            FROM referrers
+            WHERE id > ? AND rules_version IS NOT ?
+            ORDER BY id
+            LIMIT ?;
+            """,
+            [after_id, rules_version, limit],
+        )
+
+        return [(int(id), referrer, query) for id, referrer, query in cursor]
+
+    def update_normalised_referrers(
+        self, normalised_referrers: Mapping[int, str | None], *, rules_version: int
+    ) -> int:
+        """
+        Store the normalised referrers for a batch of referrers, and
+        record that they were normalised with this version of the rules.
+
+        They're all written in a single transaction, so if this is
+        interrupted, each referrer is either updated or still outdated.
+
+        Returns the number of normalised referrers which changed.
+        """
+        with self._write_transaction():
+            cursor = self.db.conn.executemany(
+                """
+                UPDATE referrers SET normalised_referrer = ?
+                WHERE id = ? AND normalised_referrer IS NOT ?;
+                """,
+                [
+                    (normalised_referrer, referrer_id, normalised_referrer)
+                    for referrer_id, normalised_referrer in normalised_referrers.items()
+                ],
+            )
+            changed = int(cursor.rowcount)
+
+            self.db.conn.executemany(
+                "UPDATE referrers SET rules_version = ? WHERE id = ?;",
+                [(rules_version, referrer_id) for referrer_id in normalised_referrers],
+            )
+
+            if changed > 0:
+                self._invalidate_closed_days()
+
+        return changed
+
+    def migrate(self, *, log: Callable[[str], None] = lambda message: None) -> None:
+        """
+        Bring the database schema up to date.
+
+        This runs any migrations the database hasn't had yet, replaces
+        the view and indexes if they've changed, then runs any backfills
+        a chunk at a time.  It's safe to run repeatedly, or in several
+        processes at once.
+        """
+        if self._get_pending_migrations():
+            with self._write_transaction():
+                if self._is_new_database():
+                    log("Creating a new database from schema.sql")
+                    for statement in split_statements(SCHEMA):
+                        self.db.execute(statement)
+                    self.db.execute(f"PRAGMA user_version = {LATEST_VERSION};")
+
+                for migration in self._get_pending_migrations():
+                    log(f"Migration {migration.version}: {migration.description}")
+                    migration.upgrade(self.db)
+                    self.db.execute(f"PRAGMA user_version = {migration.version};")
+
+        self._create_view_and_indexes(log)
+
+        for backfill in self._backfills():
+            if not backfill.count_pending():
+                continue
+
+            while rows := backfill.run_chunk(BACKFILL_CHUNK_SIZE):
+                log(f"{backfill.description}: {rows} rows")
+
+    def plan_migrations(self) -> list[str]:
+        """
+        Describe the work ``migrate()`` would do, without changing
+        anything, with an estimate of how many rows each step touches.
+        """
+        if self._is_new_database():
+            return ["Create a new database from schema.sql"]
+
+        plan = [
+            f"Migration {m.version}: {m.description}"
+            for m in self._get_pending_migrations()
+        ]
+
+        hits_count = self.db["hits"].count if "hits" in self.db.table_names() else 0
+
+        for name, (_, expected_sql) in sorted(
+            self._get_outdated_view_and_indexes().items()
+        ):
+            if name == "events":
+                plan.append("Replace the events view")
+            elif expected_sql is None:
+                plan.append(f"Drop index {name}")
+            else:
+                plan.append(
+                    f"Create index {name} over {hits_count:,} rows "
+                    "(in a single transaction)"
+                )
+
+        for backfill in self._backfills():
+            pending = backfill.count_pending()
+
+            if pending:
+                transactions = math.ceil(pending / BACKFILL_CHUNK_SIZE)
+                plan.append(
+                    f"{backfill.description}: {pending:,} rows "
+                    f"in {transactions:,} transactions of up to "
+                    f"{BACKFILL_CHUNK_SIZE:,} rows"
+                )
+
+        return plan
+
+    def _is_new_database(self) -> bool:
+        """
+        Returns True if this database doesn't have any events tables yet.
+        """
+        return self.get_pragma("user_version") == 0 and not (
+            {"events", "hits"} & set(self.db.table_names())
+        )
+
+    def _get_pending_migrations(self) -> list[Migration]:
+        """
+        Return the migrations this database hasn't had yet.
+        """
+        version = self.get_pragma("user_version")
+
+        return [m for m in MIGRATIONS if m.version > version]
+
+    @contextlib.contextmanager
+    def _write_transaction(self) -> Iterator[None]:
+        """
+        Run a block of statements in a single write transaction.
+
+        We take the writer lock at the start of the transaction, so
+        a concurrent writer waits for the busy timeout rather than
+        failing halfway through.
+        """
+        try:
+            with self.db.conn:
+                self.db.execute("BEGIN IMMEDIATE;")
+                yield
+        except BaseException:
+            # If the transaction was rolled back, we may have cached
+            # the IDs of lookup rows which no longer exist.
+            self._dimension_ids.clear()
+            raise
+
+    def _create_view_and_indexes(self, log: Callable[[str], None]) -> None:
+        """
+        Make sure the ``events`` view and the indexes on ``hits`` match
+        their definitions in this file, replacing any which are out of date.
+        """
+        if not self._get_outdated_view_and_indexes():
+            return
+
+        with self._write_transaction():
+            outdated = self._get_outdated_view_and_indexes()
+
+            for name, (current_sql, expected_sql) in sorted(outdated.items()):
+                if current_sql is not None:
+                    kind = "VIEW" if name == "events" else "INDEX"
+                    self.db.execute(f"DROP {kind} {name};")
+
+                if expected_sql is not None:
+                    log(f"Creating {name}")
+                    self.db.execute(expected_sql)
+
+    def _get_outdated_view_and_indexes(
+        self,
+    ) -> dict[str, tuple[str | None, str | None]]:
+        """
+        Find the view and indexes which don't match their definitions,
+        as (name -> (current SQL, expected SQL)).  The SQL is None if
+        it doesn't exist/shouldn't exist.
+        """
+        expected = {"events": EVENTS_VIEW} | {
+            name: f"CREATE INDEX {name} ON hits({', '.join(columns)})"
+            for name, columns in HITS_INDEXES.items()
+        }
+
+        current = {
+            name: sql
+            for name, sql in self.db.execute(
+                """
+                SELECT name, sql FROM sqlite_master
+                WHERE (type = 'view' AND name = 'events')
+                OR (type = 'index' AND tbl_name = 'hits' AND sql IS NOT NULL)
+                """
+            )
+        }
+
+        return {
+            name: (current.get(name), expected.get(name))
+            for name in current.keys() | expected.keys()
+            if current.get(name) != expected.get(name)
+        }
+
+    def _backfills(self) -> list[Backfill]:
+        """
+        Return the backfills that ``migrate()`` runs after the migrations.
+        """
+        return [
+            Backfill(
+                description="Fill in timestamp and day for old hits",
+                count_pending=self._count_hits_without_timestamps,
+                run_chunk=self._backfill_timestamps,
+            ),
+            Backfill(
+                description="Move events from the old flat events table",
+                count_pending=self._count_legacy_events,
+                run_chunk=self._move_legacy_events,
+            ),
+            Backfill(
+                description="Add old hits to the daily rollups",
+                count_pending=self._count_hits_outside_rollups,
+                run_chunk=self._build_rollups,
+            ),
+        ]
+
+    def _count_hits_without_timestamps(self) -> int:
+        """
+        Count the hits which don't have a ``timestamp`` and ``day`` yet.
+        """
+        if "hits" not in self.db.table_names():
+            return 0
+
+        if "timestamp" not in self.db["hits"].columns_dict:
+            return self.db["hits"].count
+
+        return int(
+            self.db.execute(
+                "SELECT count(*) FROM hits WHERE timestamp IS NULL;"
+            ).fetchone()[0]
+        )
+
+    def _backfill_timestamps(self, chunk_size: int) -> int:
+        """
+        Fill in the ``timestamp`` and ``day`` columns for hits which were
+        recorded before we had them.
+        """
+        with self._write_transaction():
+            cursor = self.db.execute(
+                """
+                UPDATE hits
+                SET
+                    timestamp = strftime('%s', substr(date, 1, 19)),
+                    day = strftime('%s', substr(date, 1, 10)) / 86400
+                WHERE id IN (
+                    SELECT id FROM hits WHERE timestamp IS NULL ORDER BY id LIMIT ?
+                );
+                """,
+                [chunk_size],
+            )
+
+            # Old hits are usually older than the latest event, but if
+            # the only hits we have are old, they're the latest event.
+            record_latest_event(self.db)
+
+        return int(cursor.rowcount)
+
+    def _count_legacy_events(self) -> int:
+        """
+        Count the events in an old-style flat ``events`` table.
+        """
+        table_names = self.db.table_names()
+
+        for name in ("events_legacy", "events"):
+            if name in table_names:
+                return int(self.db[name].count)
+
+        return 0
+
+    def _move_legacy_events(self, chunk_size: int) -> int:
+        """
+        Move rows from an old-style flat ``events`` table into the new
+        tables, and drop the old table as soon as it's empty.
+
+        Each chunk is copied and deleted in the same transaction, so this
+        can be interrupted and restarted, and if two processes run it
+        at once, each row is still only copied once.
+        """
+        with self._write_transaction():
+            if "events_legacy" not in self.db.table_names():
+                return 0
+
+            rows = list(
+                self.db.query(
+                    "SELECT rowid, * FROM events_legacy ORDER BY rowid LIMIT ?;",
+                    [chunk_size],
+                )
+            )
+
+            self._insert_events(
+                [
+                    {
+                        "date": row["date"],
+                        "url": row["url"],
+                        "title": row["title"],
+                        "session_id": legacy_session_id(row["session_id"]),
+                        "country": row["country"],
+                        "host": row["host"],
+                        "referrer": row["referrer"] or "",
+                        "normalised_referrer": row["normalised_referrer"],
+                        "path": row["path"],
+                        "query": row["query"] or "[]",
+                        "is_bot": bool(int(row["is_bot"])),
+                        "is_me": bool(int(row["is_me"])),
+                    }
+                    for row in rows
+                ],
+                rules_version=None,
+            )
+
+            self.db.execute(
+                "DELETE FROM events_legacy WHERE rowid <= ?;", [rows[-1]["rowid"]]
+            )
+
+            if self.db["events_legacy"].count == 0:
+                self.db.execute("DROP TABLE events_legacy;")
+
+        return len(rows)
+
+    def _get_metadata(self, key: str) -> int:
+        """
+        Return a value from the ``metadata`` table, or 0 if it hasn't
+        been set yet.
+        """
+        row = self.db.execute(
+            "SELECT value FROM metadata WHERE key = ?;", [key]
+        ).fetchone()
+
+        return 0 if row is None else int(row[0])
+
+    def _set_metadata(self, key: str, value: int) -> None:
+        """
+        Store a value in the ``metadata`` table, as part of a transaction
+        managed by the caller.
+        """
+        self.db.execute(
+            """
+            INSERT INTO metadata (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value;
+            """,
+            [key, value],
+        )
+
+    def _advance_metadata(self, key: str, value: int) -> None:
+        """
+        Store a value in the ``metadata`` table, unless the existing
+        value is already bigger, as part of a transaction managed
+        by the caller.
+        """
+        self.db.execute(
+            """
+            INSERT INTO metadata (key, value) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value);
+            """,
+            [key, value],
+        )
+
+    def _count_hits_outside_rollups(self) -> int:
+        """
+        Count the hits which haven't been added to the daily rollups.
+        """
+        table_names = self.db.table_names()
+
+        if "hits" not in table_names:
+            return 0
+
+        if "metadata" in table_names:
+            start_id = self._get_metadata("rollups_high_water_mark")
+        else:
+            start_id = 0
+
+        return int(
+            self.db.execute(
+                "SELECT count(*) FROM hits WHERE id > ?;", [start_id]
+            ).fetchone()[0]
+        )
+
+    def _build_rollups(self, chunk_size: int) -> int:
+        """
+        Add a chunk of hits to the daily rollups in its own transaction.
+        """
+        with self._write_transaction():
+            return self._update_rollups(chunk_size)
+
+    def _update_rollups(self, max_hits: int) -> int:
+        """
+        Add up to ``max_hits`` hits to the daily rollups, as part of
+        a transaction managed by the caller, and return how many we added.
+
+        We know which hits are new because we record the ID of the last
+        hit we added (the high-water mark).  We wait until every hit has
+        a timestamp, because the rollups are grouped by day.
+        """
+        if self.db.execute(
+            "SELECT 1 FROM hits WHERE timestamp IS NULL LIMIT 1;"
+        ).fetchone():
+            return 0
+
+        start_id = self._get_metadata("rollups_high_water_mark")
+
+        end_id, hit_count = self.db.execute(
+            """
+            SELECT max(id), count(*) FROM (
+                SELECT id FROM hits WHERE id > ? ORDER BY id LIMIT ?
+            );
+            """,
+            [start_id, max_hits],
+        ).fetchone()
+
+        if hit_count == 0:
+            return 0
+
+        new_hits = self.db.execute(
+            NEW_COUNTED_HITS_FOR_ROLLUPS, {"start_id": start_id, "end_id": end_id}
+        ).fetchall()
+
+        # Each count is a single call to ``Counter()`` over the hits we've
+        # already read, which does the counting in C rather than in
+        # a Python loop.
+        #
+        # Every hit has a referrer (even if it's empty), so we can get
+        # the page counts from the referrer counts, which are much
+        # smaller than the hits.
+        hits_by_day = collections.Counter(map(operator.itemgetter(0), new_hits))
+
+        hits_by_referrer = collections.Counter(
+            map(operator.itemgetter(0, 1, 2), new_hits)
+        )
+
+        hits_by_page: collections.Counter[tuple[int, int]] = collections.Counter()
+
+        for (day, page_id, _), count in hits_by_referrer.items():
+            hits_by_page[day, page_id] += count
+
+        hits_by_country = collections.Counter(map(operator.itemgetter(0, 3), new_hits))
+
+        sessions_by_day: dict[int, set[int]] = collections.defaultdict(set)
+
+        for day, session_id in set(map(operator.itemgetter(0, 4), new_hits)):
+            sessions_by_day[day].add(session_id)
+
+        self.db.conn.executemany(UPSERT_ROLLUPS["daily_totals"], hits_by_day.items())
+        self.db.conn.executemany(
+            UPSERT_ROLLUPS["daily_pages"],
+            [(*key, count) for key, count in hits_by_page.items()],
+        )
+        self.db.conn.executemany(
+            UPSERT_ROLLUPS["daily_countries"],
+            [
+                (day, country, count)
+                for (day, country), count in hits_by_country.items()
+                if country is not None
+            ],
+        )
+        self.db.conn.executemany(
+            UPSERT_ROLLUPS["daily_referrers"],
+            [(*key, count) for key, count in hits_by_referrer.items()],
+        )
+
+        hits_by_page_id: collections.Counter[int] = collections.Counter()
+
+        for (_, page_id), count in hits_by_page.items():
+            hits_by_page_id[page_id] += count
+
+        self.db.conn.executemany(
+            UPSERT_ROLLUPS["path_totals"],
+            [
+                {"page_id": page_id, "hits": count}
+                for page_id, count in hits_by_page_id.items()
+            ],
+        )
+
+        self._update_visitor_sketches(sessions_by_day)
+
+        if hits_by_day and min(hits_by_day) < to_day_number(datetime.date.today()):
+            self._invalidate_closed_days()
+
+        self._set_metadata("rollups_high_water_mark", end_id)
+
+        return int(hit_count)
+
+    def _invalidate_closed_days(self) -> None:
+        """
+        Record that the rollups for days before today have changed, e.g.
+        because a hit arrived late, so any cached results are out of date.
+        This is part of a transaction managed by the caller.
+        """
+        self._set_metadata(
+            "closed_days_version", self._get_metadata("closed_days_version") + 1
+        )
+
+    def _update_visitor_sketches(self, sessions_by_day: dict[int, set[int]]) -> None:
+        """
+        Add the sessions from a range of hits to the HyperLogLog sketch
+        for each day, and update the estimated visitors in ``daily_totals``,
+        as part of a transaction managed by the caller.
+        """
+        for day, session_ids in sessions_by_day.items():
+            row = self.db.execute(
+                "SELECT sketch FROM daily_sketches WHERE day = ?;", [day]
+            ).fetchone()
+
+            sketch = HyperLogLog() if row is None else HyperLogLog.from_bytes(row[0])
+
+            for session_id in session_ids:
+                sketch.add(session_id)
+
+            self.db.execute(
+                """
+                INSERT INTO daily_sketches (day, sketch) VALUES (?, ?)
+                ON CONFLICT (day) DO UPDATE SET sketch = excluded.sketch;
+                """,
+                [day, sketch.to_bytes()],
+            )
+            self.db.execute(
+                "UPDATE daily_totals SET visitors = ? WHERE day = ?;",
+                [sketch.count(), day],
+            )
+
+    def _find_dimension_id(self, table: str, **values: typing.Any) -> int | None:
+        """
+        Look up the ID of the row in a lookup table with these values,
+        or return None if there isn't one.
+        """
+        where = " AND ".join(f"{column} IS ?" for column in values)
+
+        row = self.db.execute(
+            f"SELECT id FROM {table} WHERE {where};", list(values.values())
+        ).fetchone()
+
+        return None if row is None else int(row[0])
+
+    def _get_dimension_id(
+        self,
+        table: str,
+        *,
+        attributes: dict[str, typing.Any] | None = None,
+        **values: typing.Any,
+    ) -> int:
+        """
+        Return the ID of the row in a lookup table with these values,
+        creating it if necessary, as part of a transaction managed by
+        the caller.
+
+        The ``attributes`` are stored if we create the row, but they
+        aren't used to find it, e.g. the normalised referrer for
+        a referrer/query string.
+        """
+        key = (table, *values.values())
+
+        try:
+            return self._dimension_ids[key]
+        except KeyError:
+            pass
+
+        row_id = self._find_dimension_id(table, **values)
+
+        if row_id is None:
+            columns = values | (attributes or {})
+
+            cursor = self.db.execute(
+                f"""
+                INSERT INTO {table} ({", ".join(columns)})
+                VALUES ({", ".join("?" for _ in columns)});
+                """,
+                list(columns.values()),
+            )
+            assert cursor.lastrowid is not None
+            row_id = cursor.lastrowid
+
+        if len(self._dimension_ids) >= MAX_CACHED_DIMENSION_IDS:
+            self._dimension_ids.clear()
+
+        self._dimension_ids[key] = row_id
+        return row_id
+
+    def _insert_events(
+        self, events: list[Event], *, rules_version: int | None = RULES_VERSION
+    ) -> None:
+        """
+        Insert events into the hits table and add them to the daily
+        rollups, as part of a transaction managed by the caller.
+
+        The ``rules_version`` is the version of the rules which worked
+        out the normalised referrers, or None if we don't know.  We assume
+        it's the same rules as this process, which is only wrong if this
+        process loads events from the journal which were recorded before
+        the rules changed.
+        """
+        rows = []
+
+        for e in events:
+            host_id = self._get_dimension_id("hosts", host=e["host"])
+            page_id = self._get_dimension_id(
+                "pages", host_id=host_id, path=e["path"], title=e["title"]
+            )
+            # If we've already seen this referrer/query string, we keep
+            # its existing normalised referrer -- that only changes when
+            # we run ``scripts/update_normalised_referrer.py``.
+            referrer_id = self._get_dimension_id(
+                "referrers",
+                referrer=e["referrer"],
+                query=e["query"],
+                attributes={
+                    "normalised_referrer": e["normalised_referrer"],
+                    "rules_version": rules_version,
+                },
+            )
+
+            # Most URLs can be rebuilt from the host and path, so we
+            # only store the ones that can't.
+            if e["url"] == f"https://{e['host']}{e['path']}":
+                url = None
+            else:
+                url = e["url"]
+
+            timestamp = to_timestamp(e["date"])
+
+            rows.append(
+                (
+                    e["date"],
+                    timestamp,
+                    timestamp // 86400,
+                    page_id,
+                    referrer_id,
+                    e["session_id"],
+                    e["country"],
+                    e["is_bot"],
+                    e["is_me"],
+                    url,
+                )
+            )
+
+        self.db.conn.executemany(
+            """
+            INSERT INTO hits (
+                date,
+                timestamp,
+                day,
+                page_id,
+                referrer_id,
+                session_id,
+                country,
+                is_bot,
+                is_me,
+                url
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """,
+            rows,
+        )
+
+        # Keep track of the latest event as we go, so the dashboard can
+        # read it without looking through the hits.
+        if rows:
+            self._advance_metadata(
+                "latest_event_timestamp", max(row[1] for row in rows)
+            )
+
+        # Add the new hits to the rollups.  If an old version of the app
+        # wrote some hits without adding them (e.g. during a deploy), we
+        # catch up on those too, a chunk at a time -- the dashboard only
+        # reads the rollups, so it never has to.
+        self._update_rollups(max(len(rows), BACKFILL_CHUNK_SIZE))
+
+    def _cached(self, key: str, compute: Callable[[], T]) -> T:
+        """
+        Return the result of a query on the daily rollups for days before
+        today, from the ``query_cache`` table if possible.
+
+        The rollups for those days only change if a hit arrives late or
+        a referrer is renamed, so the result is stored with the
+        ``closed_days_version``, and we only use it if that hasn't changed.
+
+        Reading the cache never writes to the database.  If the result
+        isn't in the cache, we keep it until somebody calls
+        ``pop_uncached_results()``, and they can save it later with
+        ``save_cached_results()``.
+
+        The result has to survive a round trip through JSON.
+        """
+        # We read the version before we run the query, so if the rollups
+        # change while we're running it, the result has an old version
+        # and it won't be saved.
+        version = f"closed:{self._get_metadata('closed_days_version')}"
+
+        cache_key = hashlib.sha256(key.encode("utf8")).hexdigest()
+
+        row = self.db.execute(
+            "SELECT version, result FROM query_cache WHERE key = ?;", [cache_key]
+        ).fetchone()
+
+        if row is not None and row[0] == version:
+            return typing.cast(T, json.loads(row[1]))
+
+        result = compute()
+
+        self._uncached_results.append(
+            CachedResult(key=cache_key, version=version, result=json.dumps(result))
+        )
+
+        return result
+
+    def _query_closed_and_open_days(
+        self,
+        key: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        query: Callable[[datetime.date, datetime.date], T],
+    ) -> list[T]:
+        """
+        Run a query for a range of days, split into the days before
+        today and the days from today onwards, and return the results
+        for each part of the range.
+
+        The days before today are closed, so their result comes from the
+        cache if possible.  Today changes with every new hit, so we always
+        run the query -- but that's a single day of rollups, so it's quick.
+        """
+        today = datetime.date.today()
+        results = []
+
+        if start_date < today:
+            closed_end_date = min(end_date, today - datetime.timedelta(days=1))
+
+            results.append(
+                self._cached(
+                    f"{key}:{start_date}:{closed_end_date}",
+                    lambda: query(start_date, closed_end_date),
+                )
+            )
+
+        if end_date >= today:
+            results.append(query(max(start_date, today), end_date))
+
+        return results
+
+    def pop_uncached_results(self) -> list[CachedResult]:
+        """
+        Return the query results which weren't in ``query_cache``, and
+        which we've computed on this connection since the last call.
+        """
+        results, self._uncached_results = self._uncached_results, []
+        return results
+
+    def save_cached_results(self, results: list[CachedResult]) -> None:
+        """
+        Save query results in ``query_cache``, in a single short transaction.
+
+        Results for an old version of the rollups are skipped, and any
+        results for old versions which are already saved are deleted.
+        """
+        with self._write_transaction():
+            version = f"closed:{self._get_metadata('closed_days_version')}"
+
+            self.db.conn.executemany(
+                """
+                INSERT INTO query_cache (key, version, stored_day, result)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    version = excluded.version,
+                    stored_day = excluded.stored_day,
+                    result = excluded.result;
+                """,
+                [
+                    (r.key, r.version, to_day_number(datetime.date.today()), r.result)
+                    for r in results
+                    if r.version == version
+                ],
+            )
+
+            self.db.execute("DELETE FROM query_cache WHERE version != ?;", [version])
+
+    def _query_rollups(
+        self,
+        sql: str,
+        start_date: datetime.date,
+        end_date: datetime.date,
+        *,
+        group_by: list[str],
+        sum_column: str,
+        limit: int | None = None,
+    ) -> list[dict[str, typing.Any]]:
+        """
+        Run a query on the daily rollups for a range of days, and return
+        the ``limit`` rows with the largest ``sum_column``.
+
+        The query takes the first and last day as parameters, and
+        shouldn't have a LIMIT -- we run it separately for the closed days
+        and for today, then add up the rows with ``sum_rows()``.
+        """
+
+        def run_query(
+            start_date: datetime.date, end_date: datetime.date
+        ) -> list[dict[str, typing.Any]]:
+            """
+            Run the query for part of the range.
+            """
+            params = [to_day_number(start_date), to_day_number(end_date)]
+            return [dict(row) for row in self.db.query(sql, params)]
+
+        return sum_rows(
+            self._query_closed_and_open_days(sql, start_date, end_date, run_query),
+            group_by=group_by,
+            sum_column=sum_column,
+            limit=limit,
+        )
+
+    def _count_per_day(
+        self, column: str, start_date: datetime.date, end_date: datetime.date
+    ) -> list[PerDayCount]:
+        """
+        Read a column from the ``daily_totals`` rollup for a range of days.
 
         This will return a complete range of days between start/end, even
         if there were no hits on some of the days.
         """
-        cursor = self.db.query(
-            f"""
-            SELECT
-                substring(date, 0, 11) as day,
-                count(*) as count
-            FROM
-                events
-            WHERE
-                {self._where_clause(start_date, end_date)}
-            GROUP BY
-                day
-            ORDER BY
-                date desc
-            """
+        rows = self._query_rollups(
+            f"SELECT day, {column} FROM daily_totals WHERE day >= ? AND day <= ?;",
+            start_date,
+            end_date,
+            group_by=["day"],
+            sum_column=column,
         )
 
-        count_lookup = {row["day"]: row["count"] for row in cursor}
+        count_lookup = {
+            from_day_number(row["day"]).isoformat(): row[column] for row in rows
+        }
 
         return [
             {"day": day.isoformat(), "count": count_lookup.get(day.isoformat(), 0)}
             for day in days_between(start_date, end_date)
         ]
 
+    def count_requests_per_day(
+        self, start_date: datetime.date, end_date: datetime.date
+    ) -> list[PerDayCount]:
+        """
+        Given a range of days, return a count of total hits in those days, e.g.
+
+            {"2001-01-01" -> 123, "2001-01-02" -> 456, …}
+
+        This will return a complete range of days between start/end, even
+        if there were no hits on some of the days.
+        """
+        return self._count_per_day("hits", start_date, end_date)
+
     def count_unique_visitors_per_day(
         self, start_date: datetime.date, end_date: datetime.date
     ) -> list[PerDayCount]:
@@ -114,28 +1277,42 @@ class AnalyticsDatabase:
         This will return a complete range of days between start/end, even
         if there were no hits on some of the days.
         """
-        cursor = self.db.query(
-            f"""
-            SELECT
-                substring(date, 0, 11) as day,
-                count(distinct session_id) as count
-            FROM
-                events
-            WHERE
-                {self._where_clause(start_date, end_date)}
-            GROUP BY
-                day
-            ORDER BY
-                date desc
+        return self._count_per_day("visitors", start_date, end_date)
+
+    def count_unique_visitors(
+        self, start_date: datetime.date, end_date: datetime.date
+    ) -> int:
+        """
+        Estimate the unique visitors over a range of days.
+
+        This merges the HyperLogLog sketch for each day in the range, so
+        it's accurate to within a couple of percent (see ``hyperloglog.py``).
+
+        Session identifiers change every day, so somebody who visits on
+        two different days is counted twice.
+        """
+
+        def merge_sketches(start_date: datetime.date, end_date: datetime.date) -> str:
             """
-        )
+            Merge the sketches for every day in part of the range, and
+            return the merged sketch as a hex string.
+            """
+            cursor = self.db.execute(
+                "SELECT sketch FROM daily_sketches WHERE day >= ? AND day <= ?;",
+                [to_day_number(start_date), to_day_number(end_date)],
+            )
 
-        count_lookup = {row["day"]: row["count"] for row in cursor}
+            sketch = HyperLogLog.union(HyperLogLog.from_bytes(row[0]) for row in cursor)
 
-        return [
-            {"day": day.isoformat(), "count": count_lookup.get(day.isoformat(), 0)}
-            for day in days_between(start_date, end_date)
-        ]
+            return sketch.to_bytes().hex()
+
+        sketches = self._query_closed_and_open_days(
+            "count_unique_visitors", start_date, end_date, merge_sketches
+        )
+
+        return HyperLogLog.union(
+            HyperLogLog.from_bytes(bytes.fromhex(sketch)) for sketch in sketches
+        ).count()
 
     def count_visitors_by_country(
         self, start_date: datetime.date, end_date: datetime.date
@@ -148,19 +1325,22 @@ class AnalyticsDatabase:
 
         The keys will (mostly) be the 2-digit ISO country codes.
         """
-        cursor = self.db.query(
-            f"""
+        cursor = self._query_rollups(
+            """
             SELECT
                 country,
-                count(*) as count
+                sum(hits) as count
             FROM
-                events
+                daily_countries
             WHERE
-                {self._where_clause(start_date, end_date)}
-                AND country IS NOT NULL
+                day >= ? AND day <= ?
             GROUP BY
                 country
-            """
+            """,
+            start_date,
+            end_date,
+            group_by=["country"],
+            sum_column="count",
         )
 
         return collections.Counter({row["country"]: row["count"] for row in cursor})
@@ -171,22 +1351,25 @@ class AnalyticsDatabase:
         """
         Given a range of dates, count the hits per unique page.
         """
-        cursor = self.db.query(
-            f"""
+        cursor = self._query_rollups(
+            """
             SELECT
-                title, host, path,
-                count(*) as count
+                p.title, h.host, p.path,
+                sum(d.hits) as count
             FROM
-                events
+                daily_pages d
+                JOIN pages p ON p.id = d.page_id
+                JOIN hosts h ON h.id = p.host_id
             WHERE
-                {self._where_clause(start_date, end_date)}
+                d.day >= ? AND d.day <= ?
             GROUP BY
-                title
-            ORDER BY
-                count desc
-            LIMIT
-                {limit}
-            """
+                p.title
+            """,
+            start_date,
+            end_date,
+            group_by=["title"],
+            sum_column="count",
+            limit=limit,
         )
 
         return [typing.cast(PerPageCount, row) for row in cursor]
@@ -208,21 +1391,25 @@ class AnalyticsDatabase:
             )
 
         """
-        referrers_by_page = self.db.query(
-            f"""
+        referrers_by_page = self._query_rollups(
+            """
             SELECT
-                title, path, normalised_referrer,
-                count(*) as count
+                p.title, p.path, r.normalised_referrer,
+                sum(d.hits) as count
             FROM
-                events
+                daily_referrers d
+                JOIN pages p ON p.id = d.page_id
+                JOIN referrers r ON r.id = d.referrer_id
             WHERE
-                {self._where_clause(start_date, end_date)}
-                and normalised_referrer != ''
+                d.day >= ? AND d.day <= ?
+                and r.normalised_referrer != ''
             GROUP BY
-                path, normalised_referrer
-            ORDER BY
-                count desc
-        """
+                p.path, r.normalised_referrer
+        """,
+            start_date,
+            end_date,
+            group_by=["path", "normalised_referrer"],
+            sum_column="count",
         )
 
         # normalised referrer -> dict(page -> count)
@@ -283,39 +1470,205 @@ class AnalyticsDatabase:
         # I see a handful of URLs like this -- I don't really know where
         # they're coming from, but they're infrequent enough that I think
         # it's a client issue rather than an issue on my site.
-        cursor = self.db.query(
-            f"""
+        cursor = self._query_rollups(
+            """
             SELECT
-                path, count(*) as count
+                p.path, sum(d.hits) as count
             FROM
-                events
+                daily_pages d
+                JOIN pages p ON p.id = d.page_id
             WHERE
-                {self._where_clause(start_date, end_date)}
-                and title = '404 Not Found – alexwlchan'
-                and path NOT LIKE '%/null'
+                d.day >= ? AND d.day <= ?
+                and p.title = '404 Not Found – alexwlchan'
+                and p.path NOT LIKE '%/null'
             GROUP BY
-                path
+                p.path
+            """,
+            start_date,
+            end_date,
+            group_by=["path"],
+            sum_column="count",
+            limit=25,
+        )
+
+        return [
+            {
+                "path": row["path"],
+                "count": row["count"],
+            }
+            for row in cursor
+        ]
+
+    def get_post_content_hashes(self) -> set[str]:
+        """
+        Return the content hashes of every post we've saved, so we can
+        skip entries in the RSS feed which haven't changed.
+        """
+        return {
+            row[0]
+            for row in self.db.execute(
+                "SELECT content_hash FROM posts WHERE content_hash IS NOT NULL;"
+            )
+        }
+
+    def save_posts(self, entries: Iterable[RssEntry]) -> int:
+        """
+        Save new or changed posts from the RSS feed, and return the
+        number of posts we wrote.
+
+        A post whose content hash matches the one we've already saved
+        isn't written again.
+        """
+        # The entries may be streamed from the RSS feed, so we read them
+        # all before we take the writer lock.
+        rows = [
+            {**entry, "date_posted": entry["date_posted"].isoformat()}
+            for entry in entries
+        ]
+
+        with self._write_transaction():
+            changes_before = self.db.conn.total_changes
+
+            self.db.conn.executemany(
+                """
+                INSERT INTO posts (id, date_posted, title, url, host, path, content_hash)
+                VALUES (:id, :date_posted, :title, :url, :host, :path, :content_hash)
+                ON CONFLICT (id) DO UPDATE SET
+                    date_posted = excluded.date_posted,
+                    title = excluded.title,
+                    url = excluded.url,
+                    host = excluded.host,
+                    path = excluded.path,
+                    content_hash = excluded.content_hash
+                WHERE content_hash IS NOT excluded.content_hash;
+                """,
+                rows,
+            )
+
+            return int(self.db.conn.total_changes - changes_before)
+
+    def count_recent_post_views(self, *, limit: int) -> list[RecentPost]:
+        """
+        Return my most recent posts, and the number of times they
+        were viewed.
+
+        The counts come from ``path_totals``, which has the all-time
+        hits for each page -- including hits where the page had
+        a different title -- so this reads one row per post.
+        """
+        cursor = self.db.query(
+            """
+            SELECT
+                p.host, p.path, p.title, p.date_posted,
+                coalesce(t.hits, 0) AS count
+            FROM
+                posts p
+                LEFT JOIN hosts h ON h.host = p.host
+                LEFT JOIN path_totals t ON t.host_id = h.id AND t.path = p.path
             ORDER BY
-                count desc
+                p.date_posted DESC
             LIMIT
-                25
-            """
+                ?
+            """,
+            [limit],
         )
 
         return [
             {
+                "host": row["host"],
                 "path": row["path"],
+                "title": row["title"],
+                "date_posted": datetime.datetime.fromisoformat(row["date_posted"]),
                 "count": row["count"],
             }
             for row in cursor
         ]
 
-    def get_latest_recorded_event(self) -> datetime.datetime:
+    def get_latest_recorded_event(self) -> datetime.datetime | None:
+        """
+        Return the time of the last event recorded in the database,
+        or None if there aren't any events yet.
+
+        This is a single row in the ``metadata`` table, which is updated
+        in the same transaction as the hits.
+        """
+        timestamp = self._get_metadata("latest_event_timestamp")
+
+        if timestamp == 0:
+            return None
+
+        return from_timestamp(timestamp)
+
+
+class DatabasePool:
+    """
+    Hands out a long-lived instance of AnalyticsDatabase to each thread.
+
+    Opening a new connection for every request means we repeat the
+    connection setup every time, and throw away SQLite's page cache.
+    Instead, each thread gets its own connection, which it reuses for
+    every request it handles.
+
+    The connections never migrate the database, because some migrations
+    hold the writer lock for a long time, and we don't want a web request
+    to wait for them.  Run ``scripts/migrate_database.py`` instead.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path | str,
+        *,
+        pragmas: Pragmas = DEFAULT_PRAGMAS,
+        read_only: bool = False,
+    ):
+        """
+        Create a new instance of DatabasePool.
+
+        If ``read_only`` is True, every connection is opened read-only.
+        """
+        self.path = pathlib.Path(path)
+        self.pragmas = pragmas
+        self.read_only = read_only
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._databases: dict[threading.Thread, AnalyticsDatabase] = {}
+
+    def get(self) -> AnalyticsDatabase:
+        """
+        Return the database connection for the current thread.
+        """
+        try:
+            db: AnalyticsDatabase = self._local.db
+            return db
+        except AttributeError:
+            pass
+
+        db = AnalyticsDatabase(
+            self.path, pragmas=self.pragmas, migrate=False, read_only=self.read_only
+        )
+        self._local.db = db
+
+        with self._lock:
+            # If we're running in a server that creates a thread per
+            # request (e.g. the Flask dev server), close the connections
+            # of any threads which have finished, so they don't pile up.
+            for thread in list(self._databases):
+                if not thread.is_alive():
+                    self._databases.pop(thread).close()
+
+            self._databases[threading.current_thread()] = db
+
+        return db
+
+    def close(self) -> None:
         """
-        Return the time of the last event recorded in the database.
+        Close every connection in the pool.
         """
-        cursor = self.db.query("SELECT MAX(date) FROM events")
+        with self._lock:
+            for db in self._databases.values():
+                db.close()
 
-        date_string = next(cursor)["MAX(date)"]
+            self._databases.clear()
 
-        return datetime.datetime.fromisoformat(date_string)
+        self._local = threading.local()
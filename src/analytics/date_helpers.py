@@ -3,6 +3,7 @@ Date-related code.
 """
 
 from collections.abc import Iterator
+import calendar
 import datetime
 
 
@@ -34,6 +35,52 @@ def days_between(
         d += datetime.timedelta(days=1)
 
 
+# Events are stored with an integer timestamp and day number, so
+# the database can filter and group on them with an index.
+#
+# These are based on the wall-clock time we recorded in the event,
+# ignoring any timezone, so an event's day number always matches the
+# first ten characters of its ISO-formatted date.
+EPOCH = datetime.date(1970, 1, 1)
+
+
+def to_timestamp(date_string: str) -> int:
+    """
+    Convert an ISO-formatted date string into seconds since the epoch,
+    e.g. '1970-01-02T00:00:01' -> 86401.
+
+    This matches ``strftime('%s', substr(date, 1, 19))`` in SQLite.
+    """
+    d = datetime.datetime.fromisoformat(date_string[:19])
+    return calendar.timegm(d.timetuple())
+
+
+def from_timestamp(timestamp: int) -> datetime.datetime:
+    """
+    Convert seconds since the epoch back into a wall-clock time,
+    e.g. 86401 -> 1970-01-02T00:00:01.
+    """
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.UTC).replace(
+        tzinfo=None
+    )
+
+
+def to_day_number(d: datetime.date) -> int:
+    """
+    Convert a date into the number of days since the epoch,
+    e.g. 1970-01-02 -> 1.
+    """
+    return (d - EPOCH).days
+
+
+def from_day_number(day: int) -> datetime.date:
+    """
+    Convert a number of days since the epoch back into a date,
+    e.g. 1 -> 1970-01-02.
+    """
+    return EPOCH + datetime.timedelta(days=day)
+
+
 def prettydate(d: str) -> str:
     """
     Returns a date formatted for the hover labels on the graph,
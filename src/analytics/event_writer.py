@@ -0,0 +1,172 @@
+"""
+Buffer analytics events in memory and write them to the database in batches.
+
+Every hit on the tracking pixel creates an event.  If I write each event
+as soon as it arrives, every request pays for its own SQLite transaction
+(and the fsync that comes with it), which limits how many hits I can
+record when a post gets popular.
+
+Instead, the tracking pixel puts events on a queue, and they get written
+in a single transaction when either:
+
+*   there are enough events to fill a batch, or
+*   the oldest event has been waiting for longer than the flush interval
+
+Any remaining events are written when the writer is stopped, e.g. when
+gunicorn shuts down a worker after a ``kill -HUP``.
+"""
+
+import queue
+import sys
+import threading
+import typing
+
+from .database import DatabasePool
+from .types import Event
+
+
+OverflowPolicy = typing.Literal["drop", "flush"]
+
+
+class EventWriter:
+    """
+    Collects events in a bounded queue, and writes them to the database
+    in batches.
+
+    If the queue fills up (e.g. because the database is slow), the
+    ``overflow_policy`` decides what happens to new events:
+
+    *   ``flush`` means the request that found the queue full writes
+        the pending events itself, so no events are lost but that
+        request is slower
+    *   ``drop`` means the new event is discarded, and counted in
+        ``dropped_events``
+
+    """
+
+    def __init__(
+        self,
+        pool: DatabasePool,
+        *,
+        batch_size: int = 100,
+        flush_interval: float = 1.0,
+        max_queue_size: int = 10000,
+        overflow_policy: OverflowPolicy = "flush",
+    ):
+        """
+        Create a new instance of EventWriter.
+
+        The flush interval is measured in seconds.
+        """
+        self.pool = pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+
+        self.queue: queue.Queue[Event] = queue.Queue(maxsize=max_queue_size)
+        self.dropped_events = 0
+
+        # Events which have been taken off the queue, but not yet
+        # written to the database.  If a write fails, they stay here
+        # and get retried on the next flush.
+        self._pending: list[Event] = []
+        self._flush_lock = threading.Lock()
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._flush_periodically, name="event-writer", daemon=True
+        )
+
+    def start(self) -> None:
+        """
+        Start the background thread that flushes events on a timer.
+        """
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread, and write any events that are
+        still in the queue.
+        """
+        self._stopped.set()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+        self.flush()
+
+    def put(self, event: Event) -> None:
+        """
+        Add an event to the queue.
+
+        If this fills a batch, the batch is written immediately.
+        """
+        self.put_many([event])
+
+    def put_many(self, events: list[Event]) -> None:
+        """
+        Add several events to the queue.
+
+        If this fills a batch, the batch is written immediately -- but
+        we don't check until all the events are queued, so events which
+        arrive together are written together.
+        """
+        for event in events:
+            try:
+                self.queue.put_nowait(event)
+            except queue.Full:
+                if self.overflow_policy == "drop":
+                    # ``+=`` isn't atomic, and several request threads
+                    # may be dropping events at once, so we count them
+                    # under the queue's lock.
+                    with self.queue.mutex:
+                        self.dropped_events += 1
+
+                    continue
+
+                self.flush()
+                self.queue.put(event)
+
+        if self.queue.qsize() >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Write the pending events to the database in a single transaction,
+        and return the number of events written.
+        """
+        with self._flush_lock:
+            if not self._pending:
+                self._pending = self._drain_queue()
+
+            if not self._pending:
+                return 0
+
+            self.pool.get().insert_events(self._pending)
+
+            written = len(self._pending)
+            self._pending = []
+            return written
+
+    def _drain_queue(self) -> list[Event]:
+        """
+        Remove all the events which are currently in the queue.
+        """
+        events = []
+
+        while True:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def _flush_periodically(self) -> None:
+        """
+        Flush the queue every ``flush_interval`` seconds, until the
+        writer is stopped.
+        """
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Unable to write events: {e}", file=sys.stderr)
@@ -16,6 +16,9 @@ import httpx
 from .utils import get_password
 
 
+API_URL = "https://api.netlify.com/api/v1/accounts/netlify-mi34feu/bandwidth"
+
+
 class NetlifyBandwidthUsage(typing.TypedDict):
     """
     The parsed data from the Netlify Bandwidth Usage API.
@@ -39,13 +42,36 @@ def parse_data(data: typing.Any) -> NetlifyBandwidthUsage:
     }
 
 
-def fetch_netlify_bandwidth_usage() -> NetlifyBandwidthUsage:
+def parse_retry_after(retry_after: str) -> datetime.datetime:
+    """
+    Parse the value of the ``Retry-After`` header from the Netlify API,
+    e.g. ``2024-06-03 12:00:00 UTC``.
+    """
+    return datetime.datetime.strptime(retry_after, "%Y-%m-%d %H:%M:%S UTC").replace(
+        tzinfo=datetime.UTC
+    )
+
+
+def get_retry_after() -> datetime.datetime | None:
+    """
+    Returns the time when the Netlify API told us we could fetch the
+    bandwidth usage again, or None if we don't know.
+    """
+    try:
+        with open("netlify_usage.json") as in_file:
+            return parse_retry_after(json.load(in_file)["retry-after"])
+    except (FileNotFoundError, KeyError, ValueError):
+        return None
+
+
+def fetch_netlify_bandwidth_usage(
+    url: str = API_URL, *, timeout: float = 10
+) -> NetlifyBandwidthUsage:
     """
     Look up my Netlify bandwidth usage from the API.
 
     See https://alexwlchan.net/til/2024/get-netlify-usage-from-api/
     """
-    team_slug = "netlify-mi34feu"
     analytics_token = get_password("netlify", "analytics_token")
 
     headers = {"Authorization": f"Bearer {analytics_token}"}
@@ -58,19 +84,14 @@ def fetch_netlify_bandwidth_usage() -> NetlifyBandwidthUsage:
         # The Netlify API returns a Retry-After header, which we include
         # in the cache.  We don't fetch the data if that expiry time hasn't
         # passed yet, because we know the response hasn't changed.
-        retry_after = datetime.datetime.strptime(
-            cached_data["retry-after"], "%Y-%m-%d %H:%M:%S UTC"
-        ).replace(tzinfo=datetime.UTC)
+        retry_after = parse_retry_after(cached_data["retry-after"])
 
         if datetime.datetime.now(datetime.UTC) < retry_after:
             return parse_data(data=cached_data["data"])
     except (FileNotFoundError, ValueError):
         pass
 
-    resp = httpx.get(
-        url=f"https://api.netlify.com/api/v1/accounts/{team_slug}/bandwidth",
-        headers=headers,
-    )
+    resp = httpx.get(url=url, headers=headers, timeout=timeout)
 
     if resp.status_code == 304:
         with open("netlify_usage.json", "w") as out_file:
@@ -3,17 +3,27 @@ Fetch entries from my RSS feed.
 
 This gives me a list of the most recent posts I've published, so I can
 see whether my new posts are getting picked up.
+
+The feed has the full text of my recent posts, but I only need the
+newest few entries, so we parse it as it's downloaded, and stop as
+soon as we reach an entry we've already saved.
 """
 
-from collections.abc import Iterator
+from collections.abc import Container, Iterable, Iterator
 import datetime
+import hashlib
+import html
+import json
 import typing
+from xml.etree import ElementTree
 
-import feedparser
 import httpx
 import hyperlink
 
 
+FEED_URL = "https://alexwlchan.net/atom.xml"
+
+
 class RssEntry(typing.TypedDict):
     """
     Represents a new post in the RSS feed.
@@ -25,6 +35,17 @@ class RssEntry(typing.TypedDict):
     url: str
     host: str
     path: str
+    content_hash: str
+
+
+class RssFeed(typing.NamedTuple):
+    """
+    The new entries in the RSS feed, newest first, and the ETag of
+    the response.
+    """
+
+    entries: list[RssEntry]
+    etag: str
 
 
 class NoNewEntries(Exception):
@@ -35,43 +56,122 @@ class NoNewEntries(Exception):
     pass
 
 
-def fetch_rss_feed_entries() -> Iterator[RssEntry]:
+ATOM_NAMESPACE = "{http://www.w3.org/2005/Atom}"
+
+ETAG_PATH = "rss_feed.etag.txt"
+
+
+def get_content_hash(
+    *, entry_id: str, date_posted: datetime.datetime, title: str, url: str
+) -> str:
+    """
+    Returns a hash of the fields we store for an entry, so we can tell
+    if it's changed since we saved it.
     """
-    Returns recent entries from the RSS feed for my main website.
+    fields = [entry_id, date_posted.isoformat(), title, url]
+    return hashlib.sha256(json.dumps(fields).encode("utf8")).hexdigest()
+
+
+def parse_entry(entry: ElementTree.Element) -> RssEntry:
+    """
+    Convert an ``<entry>`` element from the Atom feed into an RssEntry.
+    """
+    entry_id = entry.findtext(f"{ATOM_NAMESPACE}id", default="")
+    date_posted = datetime.datetime.fromisoformat(
+        entry.findtext(f"{ATOM_NAMESPACE}published", default="")
+    )
+    title = entry.findtext(f"{ATOM_NAMESPACE}title", default="")
+
+    # A title with ``type="html"`` is escaped HTML, e.g. an arrow is
+    # written as ``&rarr;``, so we decode it to get the plain text.
+    if entry.find(f"{ATOM_NAMESPACE}title[@type='html']") is not None:
+        title = html.unescape(title)
+
+    url = entry_id if entry_id.endswith("/") else entry_id + "/"
+    post_url = hyperlink.parse(url)
+
+    return {
+        "id": entry_id,
+        "date_posted": date_posted,
+        "title": title,
+        "url": url,
+        "host": post_url.host,
+        "path": "/" + "/".join(post_url.path),
+        "content_hash": get_content_hash(
+            entry_id=entry_id, date_posted=date_posted, title=title, url=url
+        ),
+    }
+
+
+def parse_new_entries(
+    chunks: Iterable[bytes], known_hashes: Container[str]
+) -> Iterator[RssEntry]:
+    """
+    Parse the entries from the Atom feed as it's downloaded, newest first.
+
+    If an entry's ``content_hash`` is in ``known_hashes``, we've already
+    saved it and it hasn't changed, so we stop there -- any entries
+    after it are older, and we'll have saved them already.
+    """
+    parser = ElementTree.XMLPullParser(events=["end"])
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+        for _, element in parser.read_events():
+            if element.tag != f"{ATOM_NAMESPACE}entry":
+                continue
+
+            entry = parse_entry(element)
+
+            if entry["content_hash"] in known_hashes:
+                return
+
+            yield entry
+
+            # We don't need the content of the entry any more, so
+            # we can free the memory it was using.
+            element.clear()
+
+
+def fetch_rss_feed(
+    url: str = FEED_URL,
+    *,
+    timeout: float = 10,
+    known_hashes: Container[str] = frozenset(),
+) -> RssFeed:
+    """
+    Returns the new entries from the RSS feed for my main website,
+    newest first.
 
     This will throw a ``NoNewEntries`` exception if the RSS feed hasn't
-    changed since the last time is was fetched.
+    changed since the last time we called ``save_etag()``.
     """
     try:
-        with open("rss_feed.etag.txt") as etag_file:
+        with open(ETAG_PATH) as etag_file:
             headers = {"If-None-Match": etag_file.read()}
     except (FileNotFoundError, ValueError):
         headers = {}
 
-    resp = httpx.get("https://alexwlchan.net/atom.xml", headers=headers)
+    with httpx.stream("GET", url, headers=headers, timeout=timeout) as resp:
+        if resp.status_code == 304:
+            raise NoNewEntries()
 
-    if resp.status_code == 304:
-        raise NoNewEntries()
+        resp.raise_for_status()
 
-    resp.raise_for_status()
-    with open("rss_feed.etag.txt", "w") as out_file:
-        out_file.write(resp.headers["etag"])
+        entries = list(parse_new_entries(resp.iter_bytes(), known_hashes))
 
-    feed = feedparser.parse(resp.text)
+        return RssFeed(entries=entries, etag=resp.headers["etag"])
 
-    for e in feed["entries"]:
-        url = e["id"]
 
-        if not url.endswith("/"):
-            url += "/"
-
-        post_url = hyperlink.parse(url)
+def save_etag(etag: str) -> None:
+    """
+    Remember the ETag of the RSS feed, so the next fetch only downloads
+    the feed if it's changed.
 
-        yield {
-            "id": e["id"],
-            "date_posted": datetime.datetime.fromisoformat(e["published"]),
-            "title": e["title"],
-            "url": url,
-            "host": post_url.host,
-            "path": "/" + "/".join(post_url.path),
-        }
+    Only call this once the entries have been saved -- if we saved the
+    ETag first and then failed to parse or save the entries, the feed
+    would look unchanged, and we'd never fetch them again.
+    """
+    with open(ETAG_PATH, "w") as out_file:
+        out_file.write(etag)
@@ -0,0 +1,125 @@
+"""
+A trie for looking up hostnames, including hostnames with wildcards.
+
+The labels of each hostname are stored in reverse order, so hostnames
+which share a suffix share a path through the trie, e.g.
+
+    com -> google -> www
+        -> yahoo  -> search -> *
+
+A ``*`` label matches any single label, so ``*.search.yahoo.com``
+matches ``cl.search.yahoo.com``, and ``www.google.*.*`` matches
+``www.google.co.uk``.  A pattern always has to match the whole hostname,
+so ``hn.algolia.com`` doesn't match ``www.hn.algolia.com``.
+
+Looking up a hostname is a single walk through the trie, which takes
+the same time however many hostnames are in the trie.
+"""
+
+from collections.abc import Iterator, Mapping
+
+
+WILDCARD = "*"
+
+
+class _Node:
+    """
+    A single label in the trie.
+    """
+
+    __slots__ = ("children", "value")
+
+    def __init__(self) -> None:
+        """
+        Create a new instance of _Node.
+        """
+        self.children: dict[str, _Node] = {}
+        self.value: str | None = None
+
+
+class HostnameTrie:
+    """
+    Maps hostname patterns to values, e.g. ``www.google.*`` to
+    ``"Search (Google, Bing, DDG, …)"``.
+    """
+
+    def __init__(self, patterns: Mapping[str, str] | None = None) -> None:
+        """
+        Create a new instance of HostnameTrie.
+        """
+        self._root = _Node()
+        self._size = 0
+
+        for pattern, value in (patterns or {}).items():
+            self.add(pattern, value)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patterns in the trie.
+        """
+        return self._size
+
+    def items(self) -> Iterator[tuple[str, str]]:
+        """
+        Generate every (pattern, value) pair in the trie.
+        """
+        stack: list[tuple[_Node, list[str]]] = [(self._root, [])]
+
+        while stack:
+            node, labels = stack.pop()
+
+            if node.value is not None:
+                yield ".".join(reversed(labels)), node.value
+
+            for label, child in node.children.items():
+                stack.append((child, labels + [label]))
+
+    def add(self, pattern: str, value: str) -> None:
+        """
+        Add a hostname pattern to the trie.
+
+        Each pattern can only be added once.
+        """
+        node = self._root
+
+        for label in reversed(pattern.split(".")):
+            node = node.children.setdefault(label, _Node())
+
+        assert node.value is None, f"Duplicate hostname pattern: {pattern}"
+        node.value = value
+        self._size += 1
+
+    def get(self, hostname: str) -> str | None:
+        """
+        Return the value for the pattern which matches this hostname,
+        or None if there isn't one.
+
+        If more than one pattern matches, exact labels take precedence
+        over wildcards, starting from the end of the hostname.
+        """
+        labels = hostname.split(".")
+        labels.reverse()
+
+        return self._get(self._root, labels, 0)
+
+    def _get(self, node: _Node, labels: list[str], depth: int) -> str | None:
+        """
+        Find the value for the rest of the labels, starting from ``node``.
+        """
+        if depth == len(labels):
+            return node.value
+
+        child = node.children.get(labels[depth])
+
+        if child is not None:
+            value = self._get(child, labels, depth + 1)
+
+            if value is not None:
+                return value
+
+        wildcard = node.children.get(WILDCARD)
+
+        if wildcard is not None:
+            return self._get(wildcard, labels, depth + 1)
+
+        return None
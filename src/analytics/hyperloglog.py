@@ -0,0 +1,136 @@
+"""
+A HyperLogLog sketch, for counting unique visitors.
+
+A sketch estimates the number of distinct values it's seen, using
+a fixed amount of memory.  Sketches can be merged, so we keep one
+sketch per day, and merge them to count the visitors over any range
+of days without going back to the raw hits.
+
+We use 2^12 = 4096 registers, which gives a standard error of about
+1.6% (1.04 / sqrt(4096)), i.e. about two-thirds of estimates are within
+1.6% of the true count, and 95% are within 3.2%.  Small counts (up to
+about 10,000) use linear counting, because the raw HyperLogLog estimate
+is biased when most of the registers are still empty.
+
+See Flajolet et al, "HyperLogLog: the analysis of a near-optimal
+cardinality estimation algorithm" (2007).
+"""
+
+from collections.abc import Iterable
+import collections
+import math
+import zlib
+
+
+PRECISION = 12
+
+REGISTER_COUNT = 1 << PRECISION
+
+STANDARD_ERROR = 1.04 / math.sqrt(REGISTER_COUNT)
+
+
+_MASK_64 = (1 << 64) - 1
+
+
+def _hash(value: int) -> int:
+    """
+    Mix the bits of a 64-bit integer, so that similar values (e.g.
+    consecutive integers) are spread evenly across the registers.
+
+    This is the finaliser from SplitMix64.
+    """
+    z = value & _MASK_64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return z ^ (z >> 31)
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct integers added to it.
+    """
+
+    def __init__(self, registers: bytes | None = None):
+        """
+        Create a new instance of HyperLogLog, which is empty unless
+        you pass the registers from an existing sketch.
+        """
+        if registers is None:
+            self.registers = bytearray(REGISTER_COUNT)
+        elif len(registers) == REGISTER_COUNT:
+            self.registers = bytearray(registers)
+        else:
+            raise ValueError(
+                f"Expected {REGISTER_COUNT} registers, got {len(registers)}"
+            )
+
+    def add(self, value: int) -> None:
+        """
+        Add a value to the sketch.
+
+        Each value is hashed; the first few bits pick a register, and
+        the register remembers the longest run of leading zeroes it's
+        seen in the rest of the hash.
+        """
+        h = _hash(value)
+
+        index = h >> (64 - PRECISION)
+        remainder = h & ((1 << (64 - PRECISION)) - 1)
+        rank = (64 - PRECISION) - remainder.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    @classmethod
+    def union(cls, sketches: Iterable["HyperLogLog"]) -> "HyperLogLog":
+        """
+        Merge several sketches into a sketch of all their values.
+
+        This takes the maximum of each register across all the sketches
+        in a single pass, which is much faster than merging them
+        one at a time.
+        """
+        registers = [s.registers for s in sketches]
+
+        if not registers:
+            return cls()
+
+        return cls(bytes(map(max, zip(*registers))))
+
+    def count(self) -> int:
+        """
+        Estimate the number of distinct values in the sketch.
+        """
+        register_values = collections.Counter(self.registers)
+
+        alpha = 0.7213 / (1 + 1.079 / REGISTER_COUNT)
+        estimate = (
+            alpha
+            * REGISTER_COUNT**2
+            / sum(count * 2.0**-rank for rank, count in register_values.items())
+        )
+
+        # If the estimate is small and some registers are still empty,
+        # linear counting is more accurate.
+        empty_registers = register_values[0]
+
+        if estimate <= 2.5 * REGISTER_COUNT and empty_registers > 0:
+            estimate = REGISTER_COUNT * math.log(REGISTER_COUNT / empty_registers)
+
+        return round(estimate)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialise the sketch to store in the database.
+
+        The registers are compressed, because on quiet days most of
+        them are still zero.
+        """
+        return zlib.compress(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        """
+        Load a sketch which was serialised with ``to_bytes()``.
+        """
+        return cls(zlib.decompress(data))
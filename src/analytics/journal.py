@@ -0,0 +1,242 @@
+"""
+An append-only journal of events on local disk.
+
+When the tracking pixel writes straight to SQLite, it has to take the
+writer lock on ``requests.sqlite``, and under bursty load that competes
+with the long read queries from the dashboard.
+
+In journal mode, the tracking pixel appends each event to a segment file
+instead, which never touches the database.  A separate compactor then
+loads closed segments into the ``events`` table in bulk.
+
+The journal is a directory of segment files:
+
+*   ``segment-<timestamp>-<pid>.open`` is being written by a web server
+    process.  Each process writes to its own segment, so processes never
+    interleave their writes.
+*   ``segment-<timestamp>-<pid>.jsonl`` is closed, and ready to be loaded.
+    A segment is closed when it has enough events, or it's old enough,
+    or the process stops.
+
+Each line in a segment is one event, encoded as JSON.  Appends are written
+to the OS immediately, but we only fsync once per ``fsync_interval``, so
+we don't pay for an fsync on every hit.
+"""
+
+from collections.abc import Iterator
+import json
+import os
+import pathlib
+import sys
+import threading
+import time
+import typing
+
+from .database import AnalyticsDatabase
+from .types import Event
+
+
+class EventJournal:
+    """
+    Appends events to segment files in the journal directory.
+    """
+
+    def __init__(
+        self,
+        directory: pathlib.Path,
+        *,
+        max_segment_events: int = 10000,
+        max_segment_age: float = 60.0,
+        fsync_interval: float = 1.0,
+    ):
+        """
+        Create a new instance of EventJournal.
+
+        The segment age and fsync interval are measured in seconds.
+        """
+        self.directory = directory
+        self.max_segment_events = max_segment_events
+        self.max_segment_age = max_segment_age
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.Lock()
+
+        self._segment: typing.TextIO | None = None
+        self._segment_path: pathlib.Path | None = None
+        self._segment_events = 0
+        self._segment_opened_at = 0.0
+        self._is_synced = True
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._sync_periodically, name="event-journal", daemon=True
+        )
+
+    def start(self) -> None:
+        """
+        Start the background thread that fsyncs the current segment, and
+        closes it when it gets too old.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread, and close the current segment.
+        """
+        self._stopped.set()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+        with self._lock:
+            self._close_segment()
+
+    def put(self, event: Event) -> None:
+        """
+        Append an event to the journal.
+        """
+        self.put_many([event])
+
+    def put_many(self, events: list[Event]) -> None:
+        """
+        Append several events to the journal.
+        """
+        lines = "".join(json.dumps(e, separators=(",", ":")) + "\n" for e in events)
+
+        with self._lock:
+            if self._segment is None:
+                self._open_segment()
+
+            assert self._segment is not None
+            self._segment.write(lines)
+            self._segment.flush()
+
+            self._segment_events += len(events)
+            self._is_synced = False
+
+            if self._segment_events >= self.max_segment_events:
+                self._close_segment()
+
+    def sync(self) -> None:
+        """
+        Make sure every event appended so far is on disk, and close the
+        current segment if it's old enough.
+        """
+        with self._lock:
+            if self._segment is None:
+                return
+
+            if time.monotonic() - self._segment_opened_at >= self.max_segment_age:
+                self._close_segment()
+            elif not self._is_synced:
+                os.fsync(self._segment.fileno())
+                self._is_synced = True
+
+    def _open_segment(self) -> None:
+        """
+        Start a new segment.
+        """
+        name = f"segment-{time.time_ns():020d}-{os.getpid()}.open"
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._segment_path = self.directory / name
+        self._segment = open(self._segment_path, "x", encoding="utf8")
+        self._segment_events = 0
+        self._segment_opened_at = time.monotonic()
+        self._is_synced = True
+
+    def _close_segment(self) -> None:
+        """
+        Close the current segment, so the compactor can load it.
+        """
+        if self._segment is None:
+            return
+
+        assert self._segment_path is not None
+
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        self._segment.close()
+
+        self._segment_path.rename(self._segment_path.with_suffix(".jsonl"))
+
+        self._segment = None
+        self._segment_path = None
+
+    def _sync_periodically(self) -> None:
+        """
+        Sync the journal every ``fsync_interval`` seconds, until the
+        journal is stopped.
+        """
+        while not self._stopped.wait(self.fsync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Unable to sync event journal: {e}", file=sys.stderr)
+
+
+def is_running(pid: int) -> bool:
+    """
+    Returns True if there's a running process with this ID.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # pragma: no cover
+        return True
+    else:
+        return True
+
+
+def recover_abandoned_segments(directory: pathlib.Path) -> None:
+    """
+    Close any open segments whose process has stopped without closing
+    them, e.g. because it was killed.
+    """
+    for path in directory.glob("segment-*.open"):
+        pid = int(path.stem.split("-")[-1])
+
+        if not is_running(pid):
+            path.rename(path.with_suffix(".jsonl"))
+
+
+def read_segment(path: pathlib.Path) -> Iterator[Event]:
+    """
+    Read the events from a closed segment.
+
+    If a process crashed halfway through writing an event, the last line
+    may be incomplete -- we skip any lines we can't parse.
+    """
+    with open(path, encoding="utf8") as in_file:
+        for line_no, line in enumerate(in_file, start=1):
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print(f"Skipping bad line {path}:{line_no}", file=sys.stderr)
+
+
+def compact_journal(db: AnalyticsDatabase, directory: pathlib.Path) -> int:
+    """
+    Load every closed segment in the journal into the events table, oldest
+    first, and delete the segments.  Returns the number of events loaded.
+
+    This is safe to run repeatedly, or to restart after a crash: each
+    segment is checkpointed in the database in the same transaction as
+    its events, so it's never loaded twice.
+    """
+    recover_abandoned_segments(directory)
+
+    loaded_events = 0
+
+    for path in sorted(directory.glob("segment-*.jsonl")):
+        events = list(read_segment(path))
+
+        if db.load_journal_segment(path.name, events):
+            loaded_events += len(events)
+
+        path.unlink()
+        db.delete_journal_checkpoint(path.name)
+
+    return loaded_events
@@ -0,0 +1,373 @@
+"""
+Numbered changes to the database schema.
+
+The database records the number of the last migration it's had in
+``PRAGMA user_version``.  ``scripts/migrate_database.py`` runs any newer
+migrations in order -- see ``AnalyticsDatabase.migrate()``.
+
+Migrations should be quick schema changes (creating tables, adding
+columns), because they all run in a single transaction which holds
+the writer lock.  Anything which has to touch every row (e.g. filling
+in a new column) is a backfill in ``AnalyticsDatabase``, which runs
+a chunk at a time after the migrations.
+
+A new database is created directly from ``schema.sql``, so when you
+add a migration, update ``schema.sql`` to match.
+"""
+
+from collections.abc import Callable
+import sqlite3
+import typing
+
+from sqlite_utils import Database
+
+
+class Migration(typing.NamedTuple):
+    """
+    A numbered change to the database schema.
+    """
+
+    version: int
+    description: str
+    upgrade: Callable[[Database], None]
+
+
+class Backfill(typing.NamedTuple):
+    """
+    A change to existing rows, which runs a chunk at a time.
+
+    ``count_pending`` returns the number of rows which still need to
+    be changed, and ``run_chunk`` changes up to N of them in a single
+    transaction, and returns the number it changed.
+    """
+
+    description: str
+    count_pending: Callable[[], int]
+    run_chunk: Callable[[int], int]
+
+
+def split_statements(script: str) -> list[str]:
+    """
+    Split a string of SQL into individual statements, so they can be
+    run inside a transaction.  (``executescript()`` commits first.)
+    """
+    statements = []
+    current = ""
+
+    for line in script.splitlines(keepends=True):
+        current += line
+
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+
+    return statements
+
+
+def create_lookup_tables(db: Database) -> None:
+    """
+    Create the ``hits`` table, and the lookup tables for hosts, pages
+    and referrers.
+
+    Until now, every event was stored in a flat ``events`` table.
+    If that table exists, we rename it so the ``events`` view can take
+    its name, and a backfill moves its rows into the new tables.
+    """
+    if "events" in db.table_names():
+        if db["events"].count > 0:
+            db.execute("ALTER TABLE events RENAME TO events_legacy;")
+        else:
+            db.execute("DROP TABLE events;")
+
+    for statement in split_statements(
+        """
+        CREATE TABLE IF NOT EXISTS [hosts] (
+           [id] INTEGER PRIMARY KEY,
+           [host] TEXT NOT NULL UNIQUE
+        );
+
+        CREATE TABLE IF NOT EXISTS [pages] (
+           [id] INTEGER PRIMARY KEY,
+           [host_id] INTEGER NOT NULL REFERENCES [hosts]([id]),
+           [path] TEXT NOT NULL,
+           [title] TEXT NOT NULL,
+           UNIQUE ([host_id], [path], [title])
+        );
+
+        CREATE TABLE IF NOT EXISTS [referrers] (
+           [id] INTEGER PRIMARY KEY,
+           [referrer] TEXT NOT NULL,
+           [query] TEXT NOT NULL,
+           [normalised_referrer] TEXT
+        );
+
+        CREATE UNIQUE INDEX IF NOT EXISTS [referrers_by_value]
+           ON [referrers]([referrer], [query]);
+
+        CREATE TABLE IF NOT EXISTS [hits] (
+           [id] INTEGER PRIMARY KEY,
+           [date] TEXT NOT NULL,
+           [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+           [referrer_id] INTEGER NOT NULL REFERENCES [referrers]([id]),
+           [session_id] INTEGER NOT NULL,
+           [country] TEXT,
+           [is_bot] INTEGER NOT NULL,
+           [is_me] INTEGER NOT NULL,
+           [url] TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS [journal_checkpoints] (
+           [segment] TEXT PRIMARY KEY NOT NULL,
+           [event_count] INTEGER NOT NULL
+        );
+        """
+    ):
+        db.execute(statement)
+
+
+def add_timestamp_columns(db: Database) -> None:
+    """
+    Add integer ``timestamp`` and ``day`` columns to ``hits``, so date
+    filters can use an index.  A backfill fills them in for old rows.
+    """
+    # Databases which were created with these columns before we started
+    # numbering migrations already have them.
+    if "day" not in db["hits"].columns_dict:
+        db.execute("ALTER TABLE hits ADD COLUMN timestamp INTEGER;")
+        db.execute("ALTER TABLE hits ADD COLUMN day INTEGER;")
+
+
+def create_rollup_tables(db: Database) -> None:
+    """
+    Create the daily rollup tables for the dashboard, and the ``metadata``
+    table which records how far through ``hits`` they've got.
+    A backfill adds the existing hits.
+    """
+    for statement in split_statements(
+        """
+        CREATE TABLE IF NOT EXISTS [metadata] (
+           [key] TEXT PRIMARY KEY NOT NULL,
+           [value] INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS [daily_totals] (
+           [day] INTEGER PRIMARY KEY,
+           [hits] INTEGER NOT NULL,
+           [visitors] INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS [daily_visitors] (
+           [day] INTEGER NOT NULL,
+           [session_id] INTEGER NOT NULL,
+           PRIMARY KEY ([day], [session_id])
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS [daily_pages] (
+           [day] INTEGER NOT NULL,
+           [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+           [hits] INTEGER NOT NULL,
+           PRIMARY KEY ([day], [page_id])
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS [daily_countries] (
+           [day] INTEGER NOT NULL,
+           [country] TEXT NOT NULL,
+           [hits] INTEGER NOT NULL,
+           PRIMARY KEY ([day], [country])
+        ) WITHOUT ROWID;
+
+        CREATE TABLE IF NOT EXISTS [daily_referrers] (
+           [day] INTEGER NOT NULL,
+           [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+           [referrer_id] INTEGER NOT NULL REFERENCES [referrers]([id]),
+           [hits] INTEGER NOT NULL,
+           PRIMARY KEY ([day], [page_id], [referrer_id])
+        ) WITHOUT ROWID;
+        """
+    ):
+        db.execute(statement)
+
+
+def add_visitor_sketches(db: Database) -> None:
+    """
+    Replace the set of sessions seen each day with a HyperLogLog sketch,
+    which is much smaller and can be merged across days.
+
+    We empty the rollups and reset their high-water mark, so the rollups
+    backfill rebuilds them (and a sketch for every day) from the hits.
+    """
+    db.execute("DROP TABLE IF EXISTS daily_visitors;")
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS [daily_sketches] (
+           [day] INTEGER PRIMARY KEY,
+           [sketch] BLOB NOT NULL
+        );
+        """
+    )
+
+    for table in ("daily_totals", "daily_pages", "daily_countries", "daily_referrers"):
+        db.execute(f"DELETE FROM {table};")
+
+    db.execute("DELETE FROM metadata WHERE key = 'rollups_high_water_mark';")
+
+
+def create_query_cache(db: Database) -> None:
+    """
+    Create a table to cache the results of dashboard queries, so they
+    can be shared between workers and survive a restart.
+    """
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS [query_cache] (
+           [key] TEXT PRIMARY KEY NOT NULL,
+           [version] TEXT NOT NULL,
+           [stored_day] INTEGER NOT NULL,
+           [result] TEXT NOT NULL
+        );
+        """
+    )
+
+
+def add_post_content_hashes(db: Database) -> None:
+    """
+    Create the ``posts`` table, which used to be created the first time
+    we saved a post, and add a hash of each post's content so we only
+    rewrite posts which have changed.
+
+    Posts we saved before now don't have a hash, so they're rewritten
+    once, the next time we see them in the RSS feed.
+    """
+    if "posts" in db.table_names():
+        if "content_hash" not in db["posts"].columns_dict:
+            db.execute("ALTER TABLE posts ADD COLUMN content_hash TEXT;")
+    else:
+        db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS [posts] (
+               [id] TEXT PRIMARY KEY,
+               [date_posted] TEXT,
+               [title] TEXT,
+               [url] TEXT,
+               [host] TEXT,
+               [path] TEXT,
+               [content_hash] TEXT
+            );
+            """
+        )
+
+
+def create_path_totals(db: Database) -> None:
+    """
+    Create a table with the all-time hit count for each page, so the
+    "recent posts" panel doesn't have to count every hit for a post.
+
+    It's filled in from the daily rollups, which is much quicker than
+    counting the hits.  If the rollups haven't caught up with the hits
+    yet, the rest of the hits are added to both when they catch up.
+    """
+    if "path_totals" in db.table_names():
+        return
+
+    db.execute(
+        """
+        CREATE TABLE [path_totals] (
+           [host_id] INTEGER NOT NULL REFERENCES [hosts]([id]),
+           [path] TEXT NOT NULL,
+           [hits] INTEGER NOT NULL,
+           PRIMARY KEY ([host_id], [path])
+        ) WITHOUT ROWID;
+        """
+    )
+    db.execute(
+        """
+        INSERT INTO path_totals (host_id, path, hits)
+        SELECT p.host_id, p.path, sum(d.hits)
+        FROM daily_pages d
+        JOIN pages p ON p.id = d.page_id
+        GROUP BY p.host_id, p.path;
+        """
+    )
+
+
+def record_latest_event(db: Database) -> None:
+    """
+    Record the timestamp of the latest hit in the ``metadata`` table,
+    so the dashboard doesn't have to look it up in ``hits``.
+
+    New hits update it as they're inserted; this fills it in for the
+    hits we already have.  It reads the ``hits_by_timestamp`` index, so
+    it's quick even with lots of hits.
+    """
+    db.execute(
+        """
+        INSERT INTO metadata (key, value)
+        SELECT 'latest_event_timestamp', value
+        FROM (SELECT max(timestamp) AS value FROM hits)
+        WHERE value IS NOT NULL
+        ON CONFLICT (key) DO UPDATE SET value = max(value, excluded.value);
+        """
+    )
+
+
+def add_referrer_rules_versions(db: Database) -> None:
+    """
+    Record which version of the rules each referrer was normalised with,
+    so we only have to re-normalise referrers when the rules change.
+
+    We don't know which rules the existing referrers were normalised
+    with, so they're all re-normalised the next time we update them.
+    """
+    if "rules_version" not in db["referrers"].columns_dict:
+        db.execute("ALTER TABLE referrers ADD COLUMN rules_version INTEGER;")
+
+
+MIGRATIONS = [
+    Migration(
+        version=1,
+        description="Store events in dictionary-encoded tables",
+        upgrade=create_lookup_tables,
+    ),
+    Migration(
+        version=2,
+        description="Add integer timestamp and day columns to hits",
+        upgrade=add_timestamp_columns,
+    ),
+    Migration(
+        version=3,
+        description="Add daily rollup tables for the dashboard",
+        upgrade=create_rollup_tables,
+    ),
+    Migration(
+        version=4,
+        description="Count daily visitors with HyperLogLog sketches",
+        upgrade=add_visitor_sketches,
+    ),
+    Migration(
+        version=5,
+        description="Add a cache for dashboard query results",
+        upgrade=create_query_cache,
+    ),
+    Migration(
+        version=6,
+        description="Store a content hash for each post",
+        upgrade=add_post_content_hashes,
+    ),
+    Migration(
+        version=7,
+        description="Add all-time hit counts for each page",
+        upgrade=create_path_totals,
+    ),
+    Migration(
+        version=8,
+        description="Record the time of the latest event",
+        upgrade=record_latest_event,
+    ),
+    Migration(
+        version=9,
+        description="Record which rules each referrer was normalised with",
+        upgrade=add_referrer_rules_versions,
+    ),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
@@ -0,0 +1,164 @@
+"""
+Refresh data from slow external services in the background.
+
+The dashboard shows data from my RSS feed and the Netlify API.  If we
+fetch them while rendering the dashboard, the page is only as fast as
+the slowest of those services, and a single slow response holds it up.
+
+Instead, each source is refreshed by a background thread on its own
+timer, and the dashboard reads the last value that was fetched
+successfully (i.e. "stale-while-revalidate").  It only has to wait for
+the very first fetch after the app starts.
+
+If a fetch fails, we keep the previous value, and try again at the
+next refresh.
+"""
+
+from collections.abc import Callable
+import datetime
+import sys
+import threading
+import typing
+
+
+class _RefreshTask:
+    """
+    A single source of data, and the latest value we fetched from it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[], typing.Any],
+        *,
+        interval: float,
+        retry_after: Callable[[], datetime.datetime | None] | None,
+    ):
+        """
+        Create a new instance of _RefreshTask.
+        """
+        self.name = name
+        self.fetch = fetch
+        self.interval = interval
+        self.retry_after = retry_after
+
+        self.value: typing.Any = None
+
+        # Set when the first fetch has finished, whether it succeeded
+        # or not.
+        self.first_fetch_finished = threading.Event()
+
+    def seconds_until_next_refresh(self) -> float:
+        """
+        Returns how long to wait before we fetch this data again.
+
+        This is usually ``interval``, but if the service has told us not
+        to fetch it again until later (e.g. with a ``Retry-After``
+        header), we wait until then.
+        """
+        delay = self.interval
+
+        if self.retry_after is not None:
+            retry_after = self.retry_after()
+
+            if retry_after is not None:
+                retry_delay = (
+                    retry_after - datetime.datetime.now(datetime.UTC)
+                ).total_seconds()
+                delay = max(delay, retry_delay)
+
+        return delay
+
+
+class BackgroundRefresher:
+    """
+    Fetches data from external services on a timer, and holds the
+    latest value from each of them.
+
+    Each source gets its own thread, so a slow service doesn't delay
+    the others.
+    """
+
+    def __init__(self) -> None:
+        """
+        Create a new instance of BackgroundRefresher.
+        """
+        self._tasks: dict[str, _RefreshTask] = {}
+        self._threads: list[threading.Thread] = []
+        self._stopped = threading.Event()
+
+    def add_task(
+        self,
+        name: str,
+        fetch: Callable[[], typing.Any],
+        *,
+        interval: float,
+        retry_after: Callable[[], datetime.datetime | None] | None = None,
+    ) -> None:
+        """
+        Fetch data from a new source every ``interval`` seconds, starting
+        as soon as the refresher is started.
+
+        If ``retry_after`` is set, it's called after each fetch, and
+        if it returns a time, we don't fetch again until that time.
+        """
+        self._tasks[name] = _RefreshTask(
+            name, fetch, interval=interval, retry_after=retry_after
+        )
+
+    def start(self) -> None:
+        """
+        Start the background threads which fetch the data.
+        """
+        for task in self._tasks.values():
+            thread = threading.Thread(
+                target=self._refresh_periodically,
+                args=(task,),
+                name=f"refresh-{task.name}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """
+        Stop the background threads.
+
+        A thread which is in the middle of a fetch finishes it first.
+        """
+        self._stopped.set()
+
+        for thread in self._threads:
+            thread.join()
+
+    def get(self, name: str) -> typing.Any:
+        """
+        Return the latest value we've fetched from this source.
+
+        If we haven't finished the first fetch yet, this waits for it.
+        If none of the fetches have succeeded, this returns None.
+        """
+        task = self._tasks[name]
+        task.first_fetch_finished.wait()
+        return task.value
+
+    def _refresh(self, task: _RefreshTask) -> None:
+        """
+        Fetch the latest value for a single source.
+        """
+        try:
+            task.value = task.fetch()
+        except Exception as e:
+            print(f"Unable to refresh {task.name!r}: {e}", file=sys.stderr)
+        finally:
+            task.first_fetch_finished.set()
+
+    def _refresh_periodically(self, task: _RefreshTask) -> None:
+        """
+        Fetch the value for a single source, then wait until it's due
+        again, until the refresher is stopped.
+        """
+        self._refresh(task)
+
+        while not self._stopped.wait(task.seconds_until_next_refresh()):
+            self._refresh(task)
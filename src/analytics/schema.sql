@@ -1,15 +1,152 @@
-CREATE TABLE IF NOT EXISTS [events] (
-   [id] TEXT PRIMARY KEY NOT NULL,
-   [date] TEXT NOT NULL,
-   [url] TEXT NOT NULL,
+-- The events are stored in a dictionary-encoded layout: the long strings
+-- which repeat on every row (hostnames, paths, titles, referrers) are
+-- stored once in a lookup table, and each hit refers to them by ID.
+--
+-- The ``events`` view joins everything back together, so it looks like
+-- the original flat table with one row per event.
+--
+-- The ``events`` view and the indexes on ``hits`` are defined in
+-- ``database.py``, so they can be replaced when they change.
+
+CREATE TABLE IF NOT EXISTS [hosts] (
+   [id] INTEGER PRIMARY KEY,
+   [host] TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS [pages] (
+   [id] INTEGER PRIMARY KEY,
+   [host_id] INTEGER NOT NULL REFERENCES [hosts]([id]),
+   [path] TEXT NOT NULL,
    [title] TEXT NOT NULL,
-   [session_id] TEXT NOT NULL,
+   UNIQUE ([host_id], [path], [title])
+);
+
+-- Each referrer/query string is stored once, with its normalised
+-- referrer, so when the normalisation rules change, we only have to
+-- update one row per referrer/query string, rather than every hit
+-- (see ``scripts/update_normalised_referrer.py``).
+--
+-- The ``rules_version`` is the ``RULES_VERSION`` from ``referrers.py``
+-- when it was normalised, or NULL if we don't know.
+CREATE TABLE IF NOT EXISTS [referrers] (
+   [id] INTEGER PRIMARY KEY,
+   [referrer] TEXT NOT NULL,
+   [query] TEXT NOT NULL,
+   [normalised_referrer] TEXT,
+   [rules_version] INTEGER
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS [referrers_by_value]
+   ON [referrers]([referrer], [query]);
+
+-- The ``url`` is only stored if it can't be rebuilt from the host
+-- and path, i.e. if it isn't ``https://{host}{path}``.
+--
+-- The ``timestamp`` (seconds) and ``day`` (days) are counted from
+-- the epoch, and are derived from the wall-clock time in ``date``.
+-- We filter and group on these, because they can use an index.
+CREATE TABLE IF NOT EXISTS [hits] (
+   [id] INTEGER PRIMARY KEY,
+   [date] TEXT NOT NULL,
+   [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+   [referrer_id] INTEGER NOT NULL REFERENCES [referrers]([id]),
+   [session_id] INTEGER NOT NULL,
    [country] TEXT,
-   [host] TEXT NOT NULL,
+   [is_bot] INTEGER NOT NULL,
+   [is_me] INTEGER NOT NULL,
+   [url] TEXT,
+   [timestamp] INTEGER,
+   [day] INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS [journal_checkpoints] (
+   [segment] TEXT PRIMARY KEY NOT NULL,
+   [event_count] INTEGER NOT NULL
+);
+
+-- Records how far the background jobs have got, e.g. the ID of the
+-- last hit which has been added to the rollups.
+CREATE TABLE IF NOT EXISTS [metadata] (
+   [key] TEXT PRIMARY KEY NOT NULL,
+   [value] INTEGER NOT NULL
+);
+
+-- The daily rollups for the dashboard, so it can read one row per day
+-- (or per day and page, etc.) rather than every hit.
+--
+-- These only count the hits that appear on the dashboard (see
+-- ``COUNTED_HITS`` in ``database.py``), and they're updated in the same
+-- transaction as the hits.
+--
+-- The ``visitors`` in ``daily_totals`` are estimated from a HyperLogLog
+-- sketch of the day's sessions in ``daily_sketches``, which we can merge
+-- to count the visitors over a range of days (see ``hyperloglog.py``).
+CREATE TABLE IF NOT EXISTS [daily_totals] (
+   [day] INTEGER PRIMARY KEY,
+   [hits] INTEGER NOT NULL,
+   [visitors] INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS [daily_sketches] (
+   [day] INTEGER PRIMARY KEY,
+   [sketch] BLOB NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS [daily_pages] (
+   [day] INTEGER NOT NULL,
+   [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+   [hits] INTEGER NOT NULL,
+   PRIMARY KEY ([day], [page_id])
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS [daily_countries] (
+   [day] INTEGER NOT NULL,
+   [country] TEXT NOT NULL,
+   [hits] INTEGER NOT NULL,
+   PRIMARY KEY ([day], [country])
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS [daily_referrers] (
+   [day] INTEGER NOT NULL,
+   [page_id] INTEGER NOT NULL REFERENCES [pages]([id]),
+   [referrer_id] INTEGER NOT NULL REFERENCES [referrers]([id]),
+   [hits] INTEGER NOT NULL,
+   PRIMARY KEY ([day], [page_id], [referrer_id])
+) WITHOUT ROWID;
+
+-- The all-time hits for each page (host and path), for the "recent posts"
+-- panel.  This is updated with the daily rollups, and counts the same hits.
+CREATE TABLE IF NOT EXISTS [path_totals] (
+   [host_id] INTEGER NOT NULL REFERENCES [hosts]([id]),
    [path] TEXT NOT NULL,
-   [query] TEXT,
-   [referrer] TEXT,
-   [normalised_referrer] TEXT,
-   [is_bot] BOOLEAN NOT NULL,
-   [is_me] BOOLEAN NOT NULL
+   [hits] INTEGER NOT NULL,
+   PRIMARY KEY ([host_id], [path])
+) WITHOUT ROWID;
+
+-- Results of queries on the rollups, so the dashboard doesn't have to
+-- run them every time it loads (see ``AnalyticsDatabase._cached()``).
+--
+-- The ``key`` is a hash of the query, and a result is only used if its
+-- ``version`` matches the current version of the rollups.
+CREATE TABLE IF NOT EXISTS [query_cache] (
+   [key] TEXT PRIMARY KEY NOT NULL,
+   [version] TEXT NOT NULL,
+   [stored_day] INTEGER NOT NULL,
+   [result] TEXT NOT NULL
+);
+
+-- My recent posts, from the RSS feed for my main site.
+--
+-- The columns match the table sqlite-utils used to create the first
+-- time we saved a post.  The ``content_hash`` is a hash of the other
+-- columns, so we can skip posts which haven't changed.  It's NULL for
+-- posts saved before we started recording it.
+CREATE TABLE IF NOT EXISTS [posts] (
+   [id] TEXT PRIMARY KEY,
+   [date_posted] TEXT,
+   [title] TEXT,
+   [url] TEXT,
+   [host] TEXT,
+   [path] TEXT,
+   [content_hash] TEXT
 );
@@ -8,6 +8,28 @@ import datetime
 import typing
 
 
+class Event(typing.TypedDict):
+    """
+    A single analytics event, i.e. somebody loading a page on my site.
+
+    This is one row in the ``events`` view.  The database assigns each
+    event an integer ID when it's recorded.
+    """
+
+    date: str
+    url: str
+    title: str
+    session_id: int
+    country: str | None
+    host: str
+    referrer: str
+    normalised_referrer: str | None
+    path: str
+    query: str
+    is_bot: bool
+    is_me: bool
+
+
 class MissingPage(typing.TypedDict):
     """
     A page which wasn't found when the user requested it, i.e. any page
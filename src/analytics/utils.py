@@ -5,25 +5,118 @@ for code that doesn't have a better place to go.
 
 import datetime
 import functools
+import hashlib
+import hmac
 import math
+import os
+import pathlib
+import secrets
+import tempfile
 import typing
-import uuid
 
 import keyring
 
 
-# 100,000 unique visitors a day is way more than I usually get,
-# so this is plenty big enough!
-@functools.lru_cache(maxsize=100000)
-def get_session_identifier(d: datetime.date, ip_address: str, user_agent: str) -> str:
+def get_session_identifier(
+    d: datetime.date, *, ip_address: str, user_agent: str, key_dir: pathlib.Path
+) -> int:
     """
-    Create a session identifier. This is a UUID that can be used
-    to correlate requests within a single session.
+    Create a session identifier. This is a 64-bit integer that can be
+    used to correlate requests within a single session.
 
     This identifiers are anonymous and only last for a single day -- after
     that, the session gets a new identifier.
+
+    The identifier is a keyed hash of the day, IP address and User-Agent,
+    so every worker gives the same identifier for the same visitor, and
+    it survives restarts.  The key changes every day, and old keys are
+    deleted, so nobody (including me) can recompute an identifier once
+    the day is over.
+    """
+    key = get_session_key(d, key_dir=key_dir)
+
+    message = "\n".join([d.isoformat(), ip_address, user_agent]).encode("utf8")
+    digest = hmac.new(key, message, hashlib.sha256).digest()
+
+    # This is stored as a SQLite INTEGER, which is a signed 64-bit value.
+    return int.from_bytes(digest[:8], byteorder="big", signed=True)
+
+
+@functools.lru_cache(maxsize=2)
+def get_session_key(d: datetime.date, *, key_dir: pathlib.Path) -> bytes:
+    """
+    Return the secret key used to create session identifiers on this day.
+
+    The key is stored on disk so it can be shared between workers.  Old
+    keys are deleted by ``delete_old_session_keys()``.
+    """
+    key_path = key_dir / f"{d.isoformat()}.key"
+
+    try:
+        return key_path.read_bytes()
+    except FileNotFoundError:
+        pass
+
+    key_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+    # Write the key to a temporary file, then link it into place.  If
+    # two workers (or two threads) create a key at the same time, only
+    # one link succeeds, and they both use the key from that one --
+    # nobody ever sees a partially-written key.
+    #
+    # mkstemp() gives every caller its own file, readable only by us.
+    fd, tmp_name = tempfile.mkstemp(dir=key_dir, prefix=f"{d.isoformat()}.")
+    tmp_path = pathlib.Path(tmp_name)
+
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(secrets.token_bytes(32))
+
+        os.link(tmp_path, key_path)
+    except FileExistsError:
+        pass
+    finally:
+        tmp_path.unlink()
+
+    return key_path.read_bytes()
+
+
+# How long we keep yesterday's session key after midnight, so requests
+# which are still in flight at midnight can finish with it.
+SESSION_KEY_GRACE_PERIOD = datetime.timedelta(minutes=5)
+
+
+def delete_old_session_keys(now: datetime.datetime, *, key_dir: pathlib.Path) -> None:
+    """
+    Delete the session keys for previous days.
+
+    Yesterday's key is kept until ``SESSION_KEY_GRACE_PERIOD`` after
+    midnight, then it's deleted by the next request.
     """
-    return str(uuid.uuid4())
+    _delete_session_keys_before(
+        (now - SESSION_KEY_GRACE_PERIOD).date(), key_dir=key_dir
+    )
+
+
+@functools.lru_cache(maxsize=2)
+def _delete_session_keys_before(d: datetime.date, *, key_dir: pathlib.Path) -> None:
+    """
+    Delete the session keys for the days before ``d``.
+
+    This is cached, so each worker only looks at the directory when
+    the cutoff changes, rather than on every request.
+    """
+    # The keys are named by ISO date, so they sort in date order.  We
+    # never delete a key for a later day, which another worker may
+    # have created if our clock is behind.
+    cutoff = d.isoformat()
+
+    for old_key_path in key_dir.glob("*.key"):
+        if old_key_path.stem < cutoff:
+            old_key_path.unlink(missing_ok=True)
+
+    # Forget the deleted keys in this worker, too.
+    get_session_key.cache_clear()
 
 
 def guess_if_bot(user_agent: str) -> bool:
@@ -3,6 +3,7 @@ Test fixtures and utility code.
 """
 
 from collections.abc import Iterator
+import json
 import os
 import pathlib
 import typing
@@ -12,7 +13,8 @@ from netaddr import IPSet
 from mmdb_writer import MMDBWriter
 import pytest
 
-from analytics.database import AnalyticsDatabase
+from analytics.database import AnalyticsDatabase, DatabasePool
+from analytics.types import Event
 
 
 @pytest.fixture()
@@ -37,6 +39,16 @@ def analytics_db(tmp_path: pathlib.Path) -> AnalyticsDatabase:
     return AnalyticsDatabase(tmp_path / "requests.sqlite")
 
 
+@pytest.fixture
+def db_pool(analytics_db: AnalyticsDatabase) -> Iterator[DatabasePool]:
+    """
+    A pool of connections to the same database as ``analytics_db``.
+    """
+    pool = DatabasePool(analytics_db.path)
+    yield pool
+    pool.close()
+
+
 @pytest.fixture()
 def client(
     analytics_db: AnalyticsDatabase,
@@ -49,29 +61,38 @@ def client(
     See https://flask.palletsprojects.com/en/3.0.x/testing/#fixtures
     """
     from analytics import app
+    from analytics.app import shutdown
 
     app.config["TESTING"] = True
     app.config["DATABASE_PATH"] = analytics_db.path
 
+    # Write every event as soon as it arrives, so tests can check the
+    # database immediately after requesting the tracking pixel.
+    app.config["EVENT_BATCH_SIZE"] = 1
+
     with app.test_client() as client:
         yield client
 
+    shutdown()
 
-@pytest.fixture
-def maxmind_db_path(tmp_path: pathlib.Path) -> pathlib.Path:
+
+def create_maxmind_db(
+    directory: pathlib.Path, *, folder_name: str, iso_code: str
+) -> pathlib.Path:
     """
-    Create a MaxMind database with the right name in the current directory.
+    Create a MaxMind database which maps the IP ranges 1.1.0.0/24 and
+    1.1.1.0/24 to the given country code.
 
     This is based on the example code for mmdb_writer.
     See https://pypi.org/project/mmdb-writer/
     """
-    geo_dir = tmp_path / "GeoLite2-Country_TEST"
+    geo_dir = directory / folder_name
     geo_dir.mkdir()
 
     writer = MMDBWriter()
 
     writer.insert_network(
-        IPSet(["1.1.0.0/24", "1.1.1.0/24"]), {"country": {"iso_code": "EXAMPLE"}}
+        IPSet(["1.1.0.0/24", "1.1.1.0/24"]), {"country": {"iso_code": iso_code}}
     )
 
     db_path = geo_dir / "GeoLite2-Country.mmdb"
@@ -79,6 +100,16 @@ def maxmind_db_path(tmp_path: pathlib.Path) -> pathlib.Path:
     return db_path
 
 
+@pytest.fixture
+def maxmind_db_path(tmp_path: pathlib.Path) -> pathlib.Path:
+    """
+    Create a MaxMind database with the right name in the current directory.
+    """
+    return create_maxmind_db(
+        tmp_path, folder_name="GeoLite2-Country_TEST", iso_code="EXAMPLE"
+    )
+
+
 @pytest.fixture(scope="module")
 def vcr_config() -> typing.Any:
     """
@@ -88,3 +119,45 @@ def vcr_config() -> typing.Any:
         "decode_compressed_response": True,
         "filter_headers": [("authorization", "NETLIFY_TOKEN")],
     }
+
+
+def create_event(
+    day: str = "2001-01-01",
+    visitor_id: int = -1,
+    country_id: str | None = "GB",
+    title: str = "Example post",
+    path: str = "/example/",
+    normalised_referrer: str = "",
+) -> Event:
+    """
+    Create an example event for testing.
+
+    Each normalised referrer comes from a different query string, as it
+    would in real events.
+    """
+    if normalised_referrer:
+        query = json.dumps([["utm_source", normalised_referrer]])
+    else:
+        query = "[]"
+
+    return {
+        "date": day + "T01:23:45Z",
+        "url": "https://alexwlchan.net" + path,
+        "session_id": visitor_id,
+        "country": country_id,
+        "is_bot": False,
+        "is_me": False,
+        "host": "alexwlchan.net",
+        "title": title,
+        "path": path,
+        "referrer": "",
+        "query": query,
+        "normalised_referrer": normalised_referrer,
+    }
+
+
+def create_events(count: int, **kwargs: typing.Any) -> list[Event]:
+    """
+    Create a list of example events for testing.
+    """
+    return [create_event(**kwargs) for _ in range(count)]
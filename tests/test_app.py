@@ -2,10 +2,23 @@
 Tests for the main Flask app.
 """
 
+from collections.abc import Container
+import datetime
+import io
+import json
+import pathlib
+import sqlite3
+import sys
+import threading
+
 from flask.testing import FlaskClient
 import pytest
 
-from analytics.database import AnalyticsDatabase
+from analytics.countries import CountryLookup
+from analytics.database import AnalyticsDatabase, CachedResult
+from analytics.fetch_netlify_bandwidth import NetlifyBandwidthUsage
+from analytics.fetch_rss_feed import NoNewEntries, RssEntry, RssFeed
+from analytics.types import PerDayCount
 
 
 def test_index_explains_domain(client: FlaskClient) -> None:
@@ -73,6 +86,27 @@ class TestTrackingPixel:
         assert resp.status_code == 200
         assert analytics_db.events_table.count == 1
 
+    def test_pixel_is_never_cached(self, client: FlaskClient) -> None:
+        """
+        The tracking pixel is a GIF which browsers are told not to cache,
+        so every page view makes a new request.
+        """
+        resp = client.get(
+            "/a.gif",
+            query_string={
+                "url": "https://alexwlchan.net/",
+                "title": "alexwlchan",
+                "referrer": "",
+            },
+            headers={"X-Real-IP": "1.2.3.4"},
+        )
+
+        assert resp.status_code == 200
+        assert resp.data.startswith(b"GIF89a")
+        assert resp.headers["Content-Type"] == "image/gif"
+        assert resp.headers["Content-Length"] == str(len(resp.data))
+        assert resp.headers["Cache-Control"] == "no-store"
+
     @pytest.mark.filterwarnings("ignore::ResourceWarning")
     def test_records_bot_event(
         self, analytics_db: AnalyticsDatabase, client: FlaskClient
@@ -121,6 +155,143 @@ class TestTrackingPixel:
         row = next(analytics_db.events_table.rows)
         assert row["normalised_referrer"] == "Mastodon"
 
+    def test_records_event_in_journal(
+        self,
+        analytics_db: AnalyticsDatabase,
+        client: FlaskClient,
+        tmp_path: pathlib.Path,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """
+        In journal mode, the event is appended to the journal rather than
+        written to the database.
+        """
+        monkeypatch.setitem(client.application.config, "INGEST_MODE", "journal")
+        monkeypatch.setitem(
+            client.application.config, "JOURNAL_DIRECTORY", tmp_path / "journal"
+        )
+
+        resp = client.get(
+            "/a.gif",
+            query_string={
+                "url": "https://alexwlchan.net/",
+                "title": "alexwlchan",
+                "referrer": "",
+            },
+            headers={"X-Real-IP": "1.2.3.4"},
+        )
+
+        assert resp.status_code == 200
+        assert analytics_db.events_table.count == 0
+        assert len(list((tmp_path / "journal").glob("segment-*.open"))) == 1
+
+
+class TestRecordEvents:
+    """
+    Tests for the batch events endpoint at ``/events``.
+    """
+
+    def test_records_batch_of_events(
+        self, analytics_db: AnalyticsDatabase, client: FlaskClient
+    ) -> None:
+        """
+        All the events in the batch are recorded, with the same enrichment
+        as the tracking pixel.
+        """
+        resp = client.post(
+            "/events",
+            data=json.dumps(
+                [
+                    {"url": "https://alexwlchan.net/", "referrer": "", "title": "home"},
+                    {
+                        "url": "https://alexwlchan.net/?utm_source=mastodon",
+                        "referrer": "",
+                        "title": "home",
+                    },
+                    {
+                        "url": "https://alexwlchan.net/about/",
+                        "referrer": "https://news.ycombinator.com/",
+                        "title": "about",
+                    },
+                ]
+            ),
+            headers={
+                "X-Real-IP": "1.1.1.1",
+                "User-Agent": "Googlebot/1.0",
+                "Content-Type": "text/plain;charset=UTF-8",
+            },
+        )
+
+        assert resp.status_code == 204
+        assert analytics_db.events_table.count == 3
+
+        rows = list(analytics_db.events_table.rows_where(order_by="id"))
+        assert [r["path"] for r in rows] == ["/", "/", "/about/"]
+        assert [r["normalised_referrer"] for r in rows] == [
+            None,
+            "Mastodon",
+            "Hacker News",
+        ]
+        assert {r["country"] for r in rows} == {"EXAMPLE"}
+        assert {r["is_bot"] for r in rows} == {1}
+        assert len({r["session_id"] for r in rows}) == 1
+
+    @pytest.mark.parametrize(
+        "body",
+        [
+            "this is not JSON",
+            json.dumps({"url": "https://alexwlchan.net/"}),
+            json.dumps([]),
+            json.dumps(
+                [{"url": "https://alexwlchan.net/", "referrer": "", "title": "home"}]
+                * 101
+            ),
+            json.dumps([{"url": "https://alexwlchan.net/", "title": "home"}]),
+            json.dumps(["https://alexwlchan.net/"]),
+            json.dumps([{"url": 1, "referrer": "", "title": "home"}]),
+        ],
+    )
+    def test_invalid_batch_is_error(
+        self, analytics_db: AnalyticsDatabase, client: FlaskClient, body: str
+    ) -> None:
+        """
+        If the body isn't a JSON list of events, you get an HTTP 400 error
+        and nothing is recorded.
+        """
+        resp = client.post("/events", data=body, headers={"X-Real-IP": "1.1.1.1"})
+
+        assert resp.status_code == 400
+        assert analytics_db.events_table.count == 0
+
+    def test_oversized_body_is_error(
+        self,
+        analytics_db: AnalyticsDatabase,
+        client: FlaskClient,
+        monkeypatch: pytest.MonkeyPatch,
+    ) -> None:
+        """
+        If the body is bigger than ``EVENTS_MAX_BODY_SIZE``, you get an
+        HTTP 413 error, whether or not it has a Content-Length.
+        """
+        monkeypatch.setitem(client.application.config, "EVENTS_MAX_BODY_SIZE", 1000)
+
+        event = {"url": "https://alexwlchan.net/", "referrer": "", "title": "home"}
+        body = json.dumps([event] * 20).encode("utf8")
+        assert len(body) > 1000
+
+        resp = client.post("/events", data=body, headers={"X-Real-IP": "1.1.1.1"})
+        assert resp.status_code == 413
+
+        resp = client.post(
+            "/events",
+            input_stream=io.BytesIO(body),
+            headers={"X-Real-IP": "1.1.1.1", "Transfer-Encoding": "chunked"},
+            environ_overrides={"wsgi.input_terminated": True},
+        )
+        assert resp.status_code == 413
+
+        assert analytics_db.events_table.count == 0
+
 
 @pytest.mark.filterwarnings("ignore::ResourceWarning")
 def test_robots_txt(client: FlaskClient) -> None:
@@ -130,12 +301,41 @@ def test_robots_txt(client: FlaskClient) -> None:
     resp = client.get("/robots.txt")
     assert resp.status_code == 200
     assert resp.data.splitlines() == [b"User-agent: *", b"Disallow: /"]
+    assert resp.headers["Content-Type"] == "text/plain; charset=utf-8"
+    assert resp.headers["Content-Length"] == str(len(resp.data))
+
+
+def test_refuses_database_which_needs_migrating(
+    client: FlaskClient,
+    analytics_db: AnalyticsDatabase,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """
+    The app doesn't migrate the database itself, and it won't use
+    a database which is missing migrations.
+    """
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    analytics_db.db.execute("PRAGMA user_version = 8;")
+
+    with client.application.app_context():
+        with pytest.raises(RuntimeError, match="run scripts/migrate_database.py"):
+            app_module.get_db_pool()
+
+    assert "The database is at version 8" in capsys.readouterr().err
+    assert analytics_db.get_pragma("user_version") == 8
+
+    analytics_db.migrate()
+
+    with client.application.app_context():
+        app_module.get_db_pool()
 
 
 @pytest.mark.filterwarnings("ignore::ResourceWarning")
 @pytest.mark.vcr()
 def test_dashboard_can_be_rendered(
-    analytics_db: AnalyticsDatabase, client: FlaskClient
+    client: FlaskClient, monkeypatch: pytest.MonkeyPatch
 ) -> None:
     """
     The dashboard can be shown.
@@ -150,6 +350,13 @@ def test_dashboard_can_be_rendered(
     #
     # To avoid this test trying to call it perpetually and creating new requests,
     # I've manually set it to the far future.
+    #
+    # We pretend the hits come from the US, so it renders the shaded
+    # colours on the world map.
+    monkeypatch.setattr(
+        CountryLookup, "get_country_iso_code", lambda self, ip_address: "US"
+    )
+
     for _ in range(5):
         resp = client.get(
             "/a.gif",
@@ -163,10 +370,6 @@ def test_dashboard_can_be_rendered(
 
         assert resp.status_code == 200
 
-    # Manually insert a country code so it renders the shaded colours on the world map
-    first_id = next(analytics_db.events_table.rows)["id"]
-    analytics_db.events_table.upsert({"id": first_id, "country": "US"}, pk="id")
-
     dashboard_resp = client.get("/dashboard/")
     assert dashboard_resp.status_code == 200
 
@@ -175,3 +378,284 @@ def test_dashboard_can_be_rendered(
 
     dashboard_resp = client.get("/dashboard/?endDate=2024-07-06")
     assert dashboard_resp.status_code == 200
+
+
+def test_slow_dashboard_panel_is_skipped(
+    client: FlaskClient,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """
+    If a dashboard panel takes too long, the dashboard is shown without
+    it, rather than waiting.
+    """
+    monkeypatch.setitem(client.application.config, "DASHBOARD_PANEL_TIMEOUT", 0.1)
+
+    netlify_is_unblocked = threading.Event()
+
+    def slow_fetch_netlify_bandwidth_usage() -> NetlifyBandwidthUsage:
+        """
+        Wait until the test is finished, then fail.
+        """
+        netlify_is_unblocked.wait(timeout=5)
+        raise RuntimeError("This should never be displayed")
+
+    def fetch_rss_feed(known_hashes: Container[str]) -> RssFeed:
+        """
+        Pretend that my RSS feed has a single post.
+        """
+        entry: RssEntry = {
+            "id": "https://alexwlchan.net/example/",
+            "url": "https://alexwlchan.net/example/",
+            "host": "alexwlchan.net",
+            "path": "/example/",
+            "title": "Example post",
+            "date_posted": datetime.datetime(2001, 1, 1, tzinfo=datetime.UTC),
+            "content_hash": "123",
+        }
+
+        return RssFeed(entries=[entry], etag='"example"')
+
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    monkeypatch.setattr(
+        app_module, "fetch_netlify_bandwidth_usage", slow_fetch_netlify_bandwidth_usage
+    )
+    monkeypatch.setattr(app_module, "fetch_rss_feed", fetch_rss_feed)
+
+    client.get(
+        "/a.gif",
+        query_string={"url": "https://alexwlchan.net/", "title": "", "referrer": ""},
+        headers={"X-Real-IP": "1.2.3.4"},
+    )
+
+    try:
+        resp = client.get("/dashboard/")
+    finally:
+        netlify_is_unblocked.set()
+
+    assert resp.status_code == 200
+    assert "This couldn’t be loaded" in resp.text
+    assert b"1 total pageviews" in resp.data
+    assert "Dashboard panel 'netlify_usage' took longer than 0.1s" in (
+        capsys.readouterr().err
+    )
+
+
+def test_failed_dashboard_panel_is_skipped(
+    client: FlaskClient, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    If a dashboard panel fails, its result is None, and the other
+    panels are still shown.
+    """
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    def broken_panel() -> None:
+        """
+        Fail, as if a query had gone wrong.
+        """
+        raise ValueError("Something went wrong")
+
+    with client.application.app_context():
+        panels = app_module.run_dashboard_panels(
+            {"broken": broken_panel, "working": lambda: 1}
+        )
+
+    assert panels == {"broken": None, "working": 1}
+    assert "Dashboard panel 'broken' failed: Something went wrong" in (
+        capsys.readouterr().err
+    )
+
+
+def test_dashboard_panels_cannot_write(client: FlaskClient) -> None:
+    """
+    The dashboard panels use read-only database connections.
+    """
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    def write_to_database() -> None:
+        """
+        Try to write to the database.
+        """
+        app_module.get_read_only_db().db.execute("DELETE FROM hits;")
+
+    with client.application.app_context():
+        with pytest.raises(sqlite3.OperationalError, match="readonly database"):
+            app_module.get_dashboard_executor().submit(
+                app_module._run_in_app_context, write_to_database
+            ).result()
+
+
+def test_dashboard_saves_cached_results_in_background(
+    client: FlaskClient,
+    analytics_db: AnalyticsDatabase,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """
+    Query results which weren't in the cache are saved after the panels
+    have finished, and if we can't save them, the panels still work.
+    """
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    def count_requests(day: datetime.date) -> list[PerDayCount]:
+        """
+        Count the requests on a single day.
+        """
+        db = app_module.get_read_only_db()
+        return db.count_requests_per_day(day, day)  # type: ignore
+
+    def wait_for_background_tasks() -> None:
+        """
+        Wait for every task on the dashboard pool to finish, including
+        saving the results, then release the app's resources.
+        """
+        with client.application.app_context():
+            app_module.get_dashboard_executor().shutdown(wait=True)
+
+        app_module.shutdown()
+
+    with client.application.app_context():
+        panels = app_module.run_dashboard_panels(
+            {"by_date": lambda: count_requests(datetime.date(2001, 1, 1))}
+        )
+
+    assert panels == {"by_date": [{"day": "2001-01-01", "count": 0}]}
+
+    wait_for_background_tasks()
+    assert analytics_db.db["query_cache"].count == 1
+
+    def save_cached_results(
+        self: AnalyticsDatabase, results: list[CachedResult]
+    ) -> None:
+        """
+        Fail to save the results, as if the database is busy.
+        """
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(AnalyticsDatabase, "save_cached_results", save_cached_results)
+
+    with client.application.app_context():
+        panels = app_module.run_dashboard_panels(
+            {"by_date": lambda: count_requests(datetime.date(2001, 1, 2))}
+        )
+
+    assert panels == {"by_date": [{"day": "2001-01-02", "count": 0}]}
+
+    wait_for_background_tasks()
+    assert analytics_db.db["query_cache"].count == 1
+    assert "Unable to save cached results: database is locked" in (
+        capsys.readouterr().err
+    )
+
+
+def test_dashboard_uses_background_refresher(
+    analytics_db: AnalyticsDatabase,
+    client: FlaskClient,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    The RSS feed and Netlify usage are fetched in the background, rather
+    than every time somebody looks at the dashboard.
+    """
+    analytics_db.posts_table.insert(
+        {
+            "id": "https://alexwlchan.net/example/",
+            "host": "alexwlchan.net",
+            "path": "/example/",
+            "title": "Example post",
+            "date_posted": "2001-01-01T00:00:00+00:00",
+        }
+    )
+
+    netlify_calls = []
+
+    def fetch_netlify_bandwidth_usage() -> NetlifyBandwidthUsage:
+        """
+        Pretend I've used half my Netlify bandwidth.
+        """
+        netlify_calls.append(1)
+
+        return {
+            "used": 100,
+            "included": 200,
+            "period_start_date": datetime.datetime(2001, 1, 1, tzinfo=datetime.UTC),
+            "period_end_date": datetime.datetime(2001, 2, 1, tzinfo=datetime.UTC),
+        }
+
+    def fetch_rss_feed(known_hashes: Container[str]) -> RssFeed:
+        """
+        Pretend that my RSS feed hasn't changed.
+        """
+        raise NoNewEntries()
+
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    monkeypatch.setattr(
+        app_module, "fetch_netlify_bandwidth_usage", fetch_netlify_bandwidth_usage
+    )
+    monkeypatch.setattr(app_module, "fetch_rss_feed", fetch_rss_feed)
+
+    client.get(
+        "/a.gif",
+        query_string={"url": "https://alexwlchan.net/", "title": "", "referrer": ""},
+        headers={"X-Real-IP": "1.2.3.4"},
+    )
+
+    for _ in range(3):
+        resp = client.get("/dashboard/")
+
+        assert resp.status_code == 200
+        assert b"Netlify bandwidth:</strong>\n      100 Bytes" in resp.data
+        assert b"Example post" in resp.data
+
+    assert netlify_calls == [1]
+
+
+def test_rss_feed_etag_is_saved_after_posts(
+    client: FlaskClient,
+    tmp_working_dir: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    The ETag of the RSS feed is only saved once the new posts have been
+    saved, so if saving them fails, we fetch them again next time.
+    """
+
+    def fetch_rss_feed(known_hashes: Container[str]) -> RssFeed:
+        """
+        Pretend that my RSS feed has changed, but has no new posts.
+        """
+        return RssFeed(entries=[], etag='"example"')
+
+    def save_posts(self: AnalyticsDatabase, entries: list[RssEntry]) -> int:
+        """
+        Pretend that the database is broken.
+        """
+        raise sqlite3.OperationalError("disk I/O error")
+
+    # ``analytics.app`` is the Flask app, so we look up the module
+    app_module = sys.modules["analytics.app"]
+
+    monkeypatch.setattr(app_module, "fetch_rss_feed", fetch_rss_feed)
+    monkeypatch.setattr(AnalyticsDatabase, "save_posts", save_posts)
+
+    with client.application.app_context():
+        with pytest.raises(sqlite3.OperationalError):
+            app_module.save_new_posts()
+
+    assert not (tmp_working_dir / "rss_feed.etag.txt").exists()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(app_module, "fetch_rss_feed", fetch_rss_feed)
+
+    with client.application.app_context():
+        app_module.save_new_posts()
+
+    assert (tmp_working_dir / "rss_feed.etag.txt").read_text() == '"example"'
@@ -2,23 +2,162 @@
 Tests for ``analytics.countries``.
 """
 
+from collections.abc import Iterator
 import pathlib
 
 import pytest
 
-from analytics.countries import get_country_iso_code, get_country_name, get_flag_emoji
+from analytics.countries import CountryLookup, get_country_name, get_flag_emoji
+from conftest import create_maxmind_db
+
+
+@pytest.fixture
+def country_lookup(maxmind_db_path: pathlib.Path) -> Iterator[CountryLookup]:
+    """
+    A CountryLookup which uses the test MaxMind database.
+    """
+    lookup = CountryLookup(maxmind_db_path.parent.parent)
+    yield lookup
+    lookup.close()
 
 
 @pytest.mark.parametrize(
     ["ip_address", "country_code"], [("1.1.1.1", "EXAMPLE"), ("127.0.0.1", None)]
 )
 def test_get_country_iso_code(
-    maxmind_db_path: pathlib.Path, ip_address: str, country_code: str | None
+    country_lookup: CountryLookup, ip_address: str, country_code: str | None
 ) -> None:
     """
     Look up a country code from an IP address.
     """
-    assert get_country_iso_code(maxmind_db_path, ip_address=ip_address) == country_code
+    assert country_lookup.get_country_iso_code(ip_address) == country_code
+
+
+class TestCountryLookup:
+    """
+    Tests for the ``CountryLookup`` class.
+    """
+
+    def test_repeated_lookups_are_cached(self, country_lookup: CountryLookup) -> None:
+        """
+        Looking up the same IP address twice uses the cache, and this
+        is reflected in the stats.
+        """
+        assert country_lookup.stats()["database"] is None
+
+        for _ in range(3):
+            assert country_lookup.get_country_iso_code("1.1.1.1") == "EXAMPLE"
+
+        stats = country_lookup.stats()
+        assert stats["lookups"] == 3
+        assert stats["cache_hits"] == 2
+        assert stats["reloads"] == 1
+        assert stats["database"] is not None
+        assert stats["database"].endswith("GeoLite2-Country.mmdb")
+
+    def test_switches_to_newer_database(self, tmp_path: pathlib.Path) -> None:
+        """
+        If a newer ``GeoLite2-Country_*`` folder appears, it switches
+        to the new database.
+        """
+        create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_1", iso_code="AA")
+
+        lookup = CountryLookup(tmp_path, check_interval=0)
+
+        try:
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+            assert lookup.stats()["reloads"] == 1
+
+            create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_2", iso_code="BB")
+            assert lookup.get_country_iso_code("1.1.1.1") == "BB"
+
+            create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_3", iso_code="CC")
+            assert lookup.get_country_iso_code("1.1.1.1") == "CC"
+
+            assert lookup.stats() == {
+                "database": str(
+                    tmp_path / "GeoLite2-Country_3" / "GeoLite2-Country.mmdb"
+                ),
+                "lookups": 4,
+                "cache_hits": 1,
+                "reloads": 3,
+            }
+        finally:
+            lookup.close()
+
+    def test_waits_for_check_interval(self, tmp_path: pathlib.Path) -> None:
+        """
+        It doesn't look for a newer database until the check interval
+        has passed.
+        """
+        create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_1", iso_code="AA")
+
+        lookup = CountryLookup(tmp_path, check_interval=3600)
+
+        try:
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+
+            create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_2", iso_code="BB")
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+        finally:
+            lookup.close()
+
+    @pytest.mark.parametrize("contents", [None, b"not a MaxMind database"])
+    def test_keeps_current_database_if_new_one_is_broken(
+        self,
+        tmp_path: pathlib.Path,
+        capsys: pytest.CaptureFixture[str],
+        contents: bytes | None,
+    ) -> None:
+        """
+        If the newest database is missing or can't be opened (e.g. because
+        it's being replaced), we keep using the current database.
+        """
+        create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_1", iso_code="AA")
+
+        lookup = CountryLookup(tmp_path, check_interval=0)
+
+        try:
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+
+            new_folder = tmp_path / "GeoLite2-Country_2"
+            new_folder.mkdir()
+
+            if contents is not None:
+                (new_folder / "GeoLite2-Country.mmdb").write_bytes(contents)
+
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+            assert lookup.stats()["reloads"] == 1
+            assert "Unable to open MaxMind database" in capsys.readouterr().err
+        finally:
+            lookup.close()
+
+    def test_unknown_country_if_no_database(
+        self, tmp_path: pathlib.Path, capsys: pytest.CaptureFixture[str]
+    ) -> None:
+        """
+        If there isn't a database yet, we don't know the country, and we
+        start using the database once it appears.
+        """
+        lookup = CountryLookup(tmp_path, check_interval=0)
+
+        try:
+            assert lookup.get_country_iso_code("1.1.1.1") is None
+            assert "Unable to open MaxMind database" in capsys.readouterr().err
+
+            create_maxmind_db(tmp_path, folder_name="GeoLite2-Country_1", iso_code="AA")
+            assert lookup.get_country_iso_code("1.1.1.1") == "AA"
+        finally:
+            lookup.close()
+
+    def test_can_reopen_after_close(self, country_lookup: CountryLookup) -> None:
+        """
+        If the lookup is closed, the database is reopened on the next lookup.
+        """
+        assert country_lookup.get_country_iso_code("1.1.1.1") == "EXAMPLE"
+        country_lookup.close()
+        assert country_lookup.get_country_iso_code("1.1.1.1") == "EXAMPLE"
 
 
 @pytest.mark.parametrize(
@@ -3,43 +3,30 @@ Tests for ``analytics.database``.
 """
 
 import datetime
+import pathlib
 import random
+import sqlite3
+import threading
 import typing
+import uuid
 
 import pytest
+from sqlite_utils import Database
+from sqlite_utils.db import Table
 
-from analytics.database import AnalyticsDatabase
-from analytics.types import CountedReferrers, PerDayCount
-
-
-def create_event(
-    day: str,
-    visitor_id: int = -1,
-    country_id: str | None = "GB",
-    title: str = "Example post",
-    path: str = "/example/",
-    normalised_referrer: str = "",
-) -> typing.Any:
-    """
-    Create an example event for testing.
-    """
-    return {
-        "date": day + "T01:23:45Z",
-        "session_id": visitor_id,
-        "country": country_id,
-        "is_me": False,
-        "host": "alexwlchan.net",
-        "title": title,
-        "path": path,
-        "normalised_referrer": normalised_referrer,
-    }
-
-
-def create_events(count: int, **kwargs: typing.Any) -> list[typing.Any]:
-    """
-    Create a list of example events for testing.
-    """
-    return [create_event(**kwargs) for _ in range(count)]
+from analytics.database import (
+    AnalyticsDatabase,
+    DatabasePool,
+    HITS_INDEXES,
+    legacy_session_id,
+)
+from analytics.date_helpers import to_day_number
+from analytics.fetch_rss_feed import get_content_hash, RssEntry
+from analytics.hyperloglog import STANDARD_ERROR
+from analytics.migrations import LATEST_VERSION
+from analytics.referrers import RULES_VERSION
+from analytics.types import CountedReferrers, Event, PerDayCount, PerPageCount
+from conftest import create_event, create_events
 
 
 @pytest.mark.parametrize(
@@ -75,7 +62,7 @@ def test_count_unique_visitors_per_day(
 
     for day, visitor_count in requests.items():
         for visitor_id in range(visitor_count):
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(
                     day=day, visitor_id=visitor_id, count=random.randint(1, 10)
                 )
@@ -88,6 +75,48 @@ def test_count_unique_visitors_per_day(
     assert actual == expected_result
 
 
+def test_count_unique_visitors(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Count the unique visitors over a range of days.
+
+    Session identifiers change every day, so somebody who visits on
+    several days has a different identifier each day, and the count for
+    the range is roughly the sum of the daily counts.
+    """
+    rng = random.Random(1234)
+
+    for day, visitor_count in [
+        ("2001-01-01", 1000),
+        ("2001-01-02", 1500),
+        ("2001-01-03", 2000),
+    ]:
+        session_ids = [rng.randint(-(2**63), 2**63 - 1) for _ in range(visitor_count)]
+
+        # Every visitor loads two pages, but is only counted once
+        analytics_db.insert_events(
+            [create_event(day=day, visitor_id=s) for s in session_ids * 2]
+        )
+
+    start_date = datetime.date(2001, 1, 1)
+    end_date = datetime.date(2001, 1, 3)
+
+    daily_counts = [
+        c["count"]
+        for c in analytics_db.count_unique_visitors_per_day(start_date, end_date)
+    ]
+    assert daily_counts == pytest.approx([1000, 1500, 2000], rel=0.05)
+
+    assert analytics_db.count_unique_visitors(start_date, end_date) == pytest.approx(
+        sum(daily_counts), rel=3 * STANDARD_ERROR
+    )
+    assert (
+        analytics_db.count_unique_visitors(
+            datetime.date(2010, 1, 1), datetime.date(2010, 1, 2)
+        )
+        == 0
+    )
+
+
 @pytest.mark.parametrize(
     ["start_date", "end_date", "expected_result"],
     [
@@ -117,7 +146,7 @@ def test_count_visitors_by_country(
 
     for day, country_info in requests.items():
         for country_id, count in country_info.items():
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(day=day, country_id=country_id, count=count)
             )
 
@@ -175,7 +204,7 @@ class TestAnalyticsDatabase:
         is popular and has a long tail of referrers.
         """
         for row in records:
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(
                     day="2024-03-29",
                     title=row["title"],
@@ -216,7 +245,7 @@ class TestAnalyticsDatabase:
         Tally the number of htis per page.
         """
         for row in records:
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(
                     day="2024-03-29",
                     title=row["title"],
@@ -247,7 +276,7 @@ class TestAnalyticsDatabase:
         Count the number of pages which got a 404 error.
         """
         for row in records:
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(
                     day="2024-03-29",
                     title=row["title"],
@@ -258,7 +287,7 @@ class TestAnalyticsDatabase:
             )
 
         for path, count in [("/404", 2), ("/not-found", 5), ("/files/2021/null", 1)]:
-            analytics_db.events_table.insert_all(
+            analytics_db.insert_events(
                 create_events(
                     day="2024-03-29",
                     title="404 Not Found – alexwlchan",
@@ -283,16 +312,18 @@ class TestAnalyticsDatabase:
         """
         Count the number of pages which got a 404 Not Found or 410 Gone.
         """
-        analytics_db.events_table.insert(
-            create_event(
-                day="2024-05-26",
-                title="410 Gone – alexwlchan",
-                path="/2019/08/a-post-that-has-been-removed",
-                normalised_referrer="example.com",
-            )
+        analytics_db.insert_events(
+            [
+                create_event(
+                    day="2024-05-26",
+                    title="410 Gone – alexwlchan",
+                    path="/2019/08/a-post-that-has-been-removed",
+                    normalised_referrer="example.com",
+                )
+            ]
         )
 
-        analytics_db.events_table.insert_all(
+        analytics_db.insert_events(
             create_events(
                 day="2024-05-26",
                 title="404 Not Found – alexwlchan",
@@ -327,13 +358,15 @@ class TestAnalyticsDatabase:
             "Making a PDF that’s larger than Germany – alexwlchan",
             "Documenting my DNS records – alexwlchan",
         ):
-            analytics_db.events_table.insert(
-                create_event(
-                    day="2024-03-29",
-                    title=title,
-                    path=f"/{title}",
-                    normalised_referrer="https://example.com/",
-                )
+            analytics_db.insert_events(
+                [
+                    create_event(
+                        day="2024-03-29",
+                        title=title,
+                        path=f"/{title}",
+                        normalised_referrer="https://example.com/",
+                    )
+                ]
             )
 
         actual = analytics_db.count_referrers(
@@ -395,10 +428,1171 @@ class TestAnalyticsDatabase:
         }
 
         for day, count in requests.items():
-            analytics_db.events_table.insert_all(create_events(day=day, count=count))
+            analytics_db.insert_events(create_events(day=day, count=count))
 
         actual = analytics_db.count_requests_per_day(
             start_date=datetime.date.fromisoformat(start_date),
             end_date=datetime.date.fromisoformat(end_date),
         )
         assert actual == expected_result
+
+
+def test_connection_is_tuned(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Connections are opened in WAL mode with a busy timeout, so readers
+    and writers can share the database.
+    """
+    assert analytics_db.get_pragma("journal_mode") == "wal"
+    assert analytics_db.get_pragma("synchronous") == 1  # NORMAL
+    assert analytics_db.get_pragma("busy_timeout") == 5000
+
+
+def test_can_override_pragmas(tmp_path: pathlib.Path) -> None:
+    """
+    The pragmas applied to a new connection can be configured.
+    """
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite", pragmas={"cache_size": -100})
+
+    try:
+        assert db.get_pragma("cache_size") == -100
+    finally:
+        db.close()
+
+
+def test_events_are_stored_in_lookup_tables(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Repeated hosts, pages and referrers are only stored once, but the
+    ``events`` view still returns every event in full.
+    """
+    events = create_events(day="2001-01-01", count=3) + [
+        create_event(day="2001-01-01", normalised_referrer="Mastodon")
+        | {"url": "https://alexwlchan.net/example/?utm_source=mastodon"}
+    ]
+
+    analytics_db.insert_events(events)
+
+    assert analytics_db.db["hosts"].count == 1
+    assert analytics_db.db["pages"].count == 1
+    assert analytics_db.db["referrers"].count == 2
+
+    # The URL is only stored if it's different from the host and path
+    assert [row["url"] for row in analytics_db.db["hits"].rows] == [
+        None,
+        None,
+        None,
+        "https://alexwlchan.net/example/?utm_source=mastodon",
+    ]
+
+    rows = list(analytics_db.events_table.rows_where(order_by="id"))
+    assert [row["id"] for row in rows] == [1, 2, 3, 4]
+    assert [{k: row[k] for k in events[0]} for row in rows] == [
+        e | {"is_bot": 0, "is_me": 0} for e in events
+    ]
+
+
+def test_lookup_id_cache_is_bounded(
+    analytics_db: AnalyticsDatabase, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The cache of lookup IDs is cleared when it gets too big, and we
+    look the IDs up again afterwards.
+    """
+    monkeypatch.setattr("analytics.database.MAX_CACHED_DIMENSION_IDS", 2)
+
+    for path in ["/1/", "/2/", "/1/"]:
+        analytics_db.insert_events([create_event(day="2001-01-01", path=path)])
+
+    assert analytics_db.db["pages"].count == 2
+    assert analytics_db.events_table.count == 3
+
+
+def test_failed_insert_is_rolled_back(analytics_db: AnalyticsDatabase) -> None:
+    """
+    If a batch can't be inserted, none of it is recorded, and we don't
+    keep the IDs of lookup rows which were rolled back.
+    """
+    good_event = create_event(day="2001-01-01", path="/new-page/")
+    bad_event = typing.cast(Event, {"date": "2001-01-01T01:23:45Z"})
+
+    with pytest.raises(KeyError):
+        analytics_db.insert_events([good_event, bad_event])
+
+    assert analytics_db.db["pages"].count == 0
+
+    analytics_db.insert_events([good_event])
+    assert analytics_db.events_table.count == 1
+
+
+def reset_rollups(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Empty the daily rollups, as if the hits had been written by
+    a version of the app that didn't know about them.
+    """
+    analytics_db.db.executescript(
+        """
+        DELETE FROM metadata;
+        DELETE FROM daily_totals;
+        DELETE FROM daily_sketches;
+        DELETE FROM daily_pages;
+        DELETE FROM daily_countries;
+        DELETE FROM daily_referrers;
+        DELETE FROM path_totals;
+        DELETE FROM query_cache;
+        """
+    )
+
+
+def test_rollups_are_updated_with_new_events(analytics_db: AnalyticsDatabase) -> None:
+    """
+    The daily rollups are updated in the same transaction as the hits,
+    and only count the hits that appear on the dashboard.
+    """
+    analytics_db.insert_events(
+        create_events(day="2001-01-01", visitor_id=1, count=2)
+        + [
+            create_event(day="2001-01-01", visitor_id=2, country_id=None),
+            create_event(day="2001-01-02", visitor_id=1),
+            create_event(day="2001-01-02") | {"is_me": True},
+            create_event(day="2001-01-02") | {"host": "localhost"},
+        ]
+    )
+
+    assert list(analytics_db.db.query("SELECT * FROM daily_totals ORDER BY day")) == [
+        {"day": to_day_number(datetime.date(2001, 1, 1)), "hits": 3, "visitors": 2},
+        {"day": to_day_number(datetime.date(2001, 1, 2)), "hits": 1, "visitors": 1},
+    ]
+    assert analytics_db.db.execute(
+        "SELECT sum(hits) FROM daily_countries;"
+    ).fetchone() == (3,)
+    assert analytics_db.db.execute(
+        "SELECT value FROM metadata WHERE key = 'rollups_high_water_mark';"
+    ).fetchone() == (6,)
+
+
+def test_rollups_catch_up_when_hits_are_written(
+    analytics_db: AnalyticsDatabase, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If some hits weren't added to the daily rollups when they were
+    written, they're added a chunk at a time when we write more hits,
+    or when we migrate the database -- but not when we read the rollups.
+    """
+    monkeypatch.setattr("analytics.database.BACKFILL_CHUNK_SIZE", 2)
+
+    analytics_db.insert_events(create_events(day="2001-01-01", count=5))
+    reset_rollups(analytics_db)
+
+    day = datetime.date(2001, 1, 1)
+    assert analytics_db.count_requests_per_day(day, day) == [
+        {"day": "2001-01-01", "count": 0}
+    ]
+
+    analytics_db.insert_events(create_events(day="2001-01-01", count=1))
+    assert analytics_db.count_requests_per_day(day, day) == [
+        {"day": "2001-01-01", "count": 2}
+    ]
+
+    analytics_db.migrate()
+    assert analytics_db.count_requests_per_day(day, day) == [
+        {"day": "2001-01-01", "count": 6}
+    ]
+    assert analytics_db.count_visitors_by_country(day, day) == {"GB": 6}
+
+
+def test_rollups_wait_for_timestamps(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Hits aren't added to the daily rollups until they have a timestamp,
+    because the rollups are grouped by day.
+    """
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+    reset_rollups(analytics_db)
+    analytics_db.db.executescript("UPDATE hits SET timestamp = NULL, day = NULL;")
+
+    analytics_db.insert_events(create_events(day="2001-01-01", count=1))
+
+    day = datetime.date(2001, 1, 1)
+    assert analytics_db.count_requests_per_day(day, day) == [
+        {"day": "2001-01-01", "count": 0}
+    ]
+
+    analytics_db.migrate()
+    assert analytics_db.count_requests_per_day(day, day) == [
+        {"day": "2001-01-01", "count": 4}
+    ]
+
+
+def trace_statements(
+    analytics_db: AnalyticsDatabase, query: typing.Callable[[], typing.Any]
+) -> list[str]:
+    """
+    Run a query method, and return every SQL statement it ran.
+    """
+    statements: list[str] = []
+
+    analytics_db.db.conn.set_trace_callback(statements.append)
+    try:
+        query()
+    finally:
+        analytics_db.db.conn.set_trace_callback(None)
+
+    return statements
+
+
+def test_results_for_closed_days_are_cached(analytics_db: AnalyticsDatabase) -> None:
+    """
+    The result of a query for days before today can be saved in the
+    cache, and reused when hits are recorded today, but not after a late
+    hit for one of the days in the range.
+    """
+    day = datetime.date(2001, 1, 1)
+    today = datetime.date.today()
+
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+    assert analytics_db.count_hits_per_page(day, day, limit=5)[0]["count"] == 3
+    assert analytics_db.db["query_cache"].count == 0
+
+    analytics_db.save_cached_results(analytics_db.pop_uncached_results())
+    assert analytics_db.db["query_cache"].count == 1
+
+    def reads_rollups() -> bool:
+        """
+        Returns True if counting the hits per page reads the rollups,
+        rather than the cache.
+        """
+        statements = trace_statements(
+            analytics_db, lambda: analytics_db.count_hits_per_page(day, day, limit=5)
+        )
+
+        return any("daily_pages" in sql for sql in statements)
+
+    assert not reads_rollups()
+
+    analytics_db.insert_events([create_event(day=today.isoformat())])
+    assert not reads_rollups()
+
+    analytics_db.insert_events([create_event(day="2001-01-01")])
+    assert reads_rollups()
+    assert analytics_db.count_hits_per_page(day, day, limit=5)[0]["count"] == 4
+
+
+def test_default_range_reads_closed_days_from_cache(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    A range which ends today reads the days before today from the cache,
+    and only queries the rollups for today.
+    """
+    today = datetime.date.today()
+    yesterday = today - datetime.timedelta(days=1)
+    start_date = today - datetime.timedelta(days=29)
+
+    analytics_db.insert_events(
+        create_events(day=yesterday.isoformat(), count=3, title="A", path="/a/")
+        + create_events(day=today.isoformat(), count=1, title="A", path="/a/")
+        + create_events(day=today.isoformat(), count=2, title="B", path="/b/")
+    )
+
+    def count_pages() -> list[PerPageCount]:
+        """
+        Count the most popular page in the default range.
+        """
+        return analytics_db.count_hits_per_page(start_date, today, limit=1)
+
+    def rollup_queries() -> int:
+        """
+        Count the queries on the rollups when we count the hits per page.
+        """
+        statements = trace_statements(analytics_db, count_pages)
+        return sum("daily_pages" in sql for sql in statements)
+
+    assert rollup_queries() == 2
+    analytics_db.save_cached_results(analytics_db.pop_uncached_results())
+
+    assert rollup_queries() == 1
+    assert analytics_db.pop_uncached_results() == []
+
+    # The counts for the closed days and today are added up before we
+    # apply the limit
+    assert count_pages() == [
+        {"title": "A", "host": "alexwlchan.net", "path": "/a/", "count": 4}
+    ]
+
+    analytics_db.insert_events(create_events(day=today.isoformat(), count=3, title="B"))
+    assert count_pages()[0]["title"] == "B"
+    assert rollup_queries() == 1
+
+    # The same goes for the other queries
+    assert analytics_db.count_requests_per_day(yesterday, today) == [
+        {"day": yesterday.isoformat(), "count": 3},
+        {"day": today.isoformat(), "count": 6},
+    ]
+    assert analytics_db.count_unique_visitors(start_date, today) == 1
+
+
+def test_results_for_today_are_not_cached(analytics_db: AnalyticsDatabase) -> None:
+    """
+    The result of a query which includes today changes with every new
+    hit, so it isn't cached.
+    """
+    today = datetime.date.today()
+
+    analytics_db.insert_events([create_event(day=today.isoformat())])
+    assert analytics_db.count_requests_per_day(today, today)[0]["count"] == 1
+
+    analytics_db.insert_events([create_event(day=today.isoformat())])
+    assert analytics_db.count_requests_per_day(today, today)[0]["count"] == 2
+
+    assert analytics_db.pop_uncached_results() == []
+
+
+def test_reading_cache_does_not_write(tmp_path: pathlib.Path) -> None:
+    """
+    Querying the rollups doesn't write to the database, so it works
+    with a read-only connection.
+    """
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite")
+    db.insert_events(create_events(day="2001-01-01", count=3))
+
+    read_only_db = AnalyticsDatabase(
+        tmp_path / "requests.sqlite", pragmas={}, read_only=True
+    )
+
+    try:
+        day = datetime.date(2001, 1, 1)
+        assert read_only_db.count_requests_per_day(day, day)[0]["count"] == 3
+
+        db.save_cached_results(read_only_db.pop_uncached_results())
+        assert read_only_db.count_requests_per_day(day, day)[0]["count"] == 3
+        assert read_only_db.pop_uncached_results() == []
+    finally:
+        read_only_db.close()
+        db.close()
+
+
+def test_saving_results_deletes_outdated_results(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    When we save results in the cache, we skip results for an old version
+    of the rollups, and delete any saved results for old versions.
+    """
+    Table(analytics_db.db, "query_cache").insert_all(
+        [
+            {"key": "a", "version": "open:0:1", "stored_day": 0, "result": "1"},
+            {"key": "b", "version": "closed:0", "stored_day": 0, "result": "1"},
+        ]
+    )
+
+    day = datetime.date(2001, 1, 1)
+    analytics_db.count_requests_per_day(day, day)
+    outdated_results = analytics_db.pop_uncached_results()
+
+    # A late hit for a closed day changes the version of the rollups
+    analytics_db.insert_events([create_event(day="2001-01-01")])
+    analytics_db.count_hits_per_page(day, day, limit=5)
+
+    analytics_db.save_cached_results(
+        outdated_results + analytics_db.pop_uncached_results()
+    )
+
+    assert [row["version"] for row in analytics_db.db["query_cache"].rows] == [
+        "closed:1"
+    ]
+
+
+def test_new_referrers_record_the_rules_version(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    A new referrer records the version of the rules it was normalised
+    with, so it isn't normalised again until the rules change.
+    """
+    analytics_db.insert_events(
+        [create_event(day="2001-01-01", normalised_referrer="Example")]
+    )
+
+    assert analytics_db.count_outdated_referrers(RULES_VERSION) == 0
+    assert analytics_db.count_outdated_referrers(RULES_VERSION + 1) == 1
+
+
+def test_update_outdated_referrers(analytics_db: AnalyticsDatabase) -> None:
+    """
+    We can find the referrers which were normalised with older rules
+    a chunk at a time, and update them with the new rules.
+    """
+    analytics_db.insert_events(
+        [
+            create_event(day="2001-01-01", normalised_referrer=f"Example {i}")
+            for i in range(5)
+        ]
+    )
+    new_version = RULES_VERSION + 1
+
+    # Get the outdated referrers a chunk at a time
+    chunk_1 = analytics_db.get_outdated_referrers(new_version, limit=3)
+    assert [referrer_id for referrer_id, _, _ in chunk_1] == [1, 2, 3]
+
+    chunk_2 = analytics_db.get_outdated_referrers(
+        new_version, after_id=chunk_1[-1][0], limit=3
+    )
+    assert [referrer_id for referrer_id, _, _ in chunk_2] == [4, 5]
+
+    # Update the first chunk, where only one of the normalised
+    # referrers changes.
+    day = datetime.date(2001, 1, 1)
+    analytics_db.count_referrers(day, day)
+    version = analytics_db._get_metadata("closed_days_version")
+
+    changed = analytics_db.update_normalised_referrers(
+        {1: "Example 0", 2: "Example 1", 3: "Renamed"}, rules_version=new_version
+    )
+
+    assert changed == 1
+    assert analytics_db.count_outdated_referrers(new_version) == 2
+    assert analytics_db._get_metadata("closed_days_version") == version + 1
+
+    # If none of the referrers change, we don't invalidate the cache
+    changed = analytics_db.update_normalised_referrers(
+        {4: "Example 3", 5: "Example 4"}, rules_version=new_version
+    )
+
+    assert changed == 0
+    assert analytics_db.count_outdated_referrers(new_version) == 0
+    assert analytics_db._get_metadata("closed_days_version") == version + 1
+    assert analytics_db.get_outdated_referrers(new_version, limit=3) == []
+
+
+def test_existing_referrers_are_outdated_after_migration(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    We don't know which rules normalised the existing referrers, so
+    they're all re-normalised after the migration.
+    """
+    analytics_db.insert_events(
+        [create_event(day="2001-01-01", normalised_referrer="Example")]
+    )
+    analytics_db.db.executescript(
+        """
+        ALTER TABLE referrers DROP COLUMN rules_version;
+        PRAGMA user_version = 8;
+        """
+    )
+
+    analytics_db.migrate()
+
+    assert analytics_db.count_outdated_referrers(RULES_VERSION) == 1
+
+
+def test_migrates_legacy_events_table(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If the database has an old-style flat ``events`` table, its rows
+    are moved into the new tables.
+    """
+    monkeypatch.setattr("analytics.database.BACKFILL_CHUNK_SIZE", 2)
+
+    legacy_events = [
+        {
+            "id": str(uuid.uuid4()),
+            "date": f"2001-01-0{i}T01:23:45",
+            "url": "https://alexwlchan.net/?ref=example",
+            "title": "alexwlchan",
+            "session_id": session_id,
+            "country": "GB",
+            "host": "alexwlchan.net",
+            "path": "/",
+            "query": query,
+            "referrer": referrer,
+            "normalised_referrer": None,
+            "is_bot": False,
+            "is_me": True,
+        }
+        for i, (session_id, query, referrer) in enumerate(
+            [
+                ("12345678-1234-5678-1234-567812345678", '[["ref", "example"]]', ""),
+                ("not-a-uuid", None, None),
+                ("not-a-uuid", None, None),
+            ],
+            start=1,
+        )
+    ]
+
+    legacy_db = Database(tmp_path / "requests.sqlite")
+    legacy_db["events"].insert_all(legacy_events, pk="id")  # type: ignore
+    legacy_db.close()  # type: ignore
+
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite")
+
+    try:
+        assert "events_legacy" not in db.db.table_names()
+
+        rows = list(db.events_table.rows_where(order_by="id"))
+        assert [row["date"] for row in rows] == [e["date"] for e in legacy_events]
+        assert [row["session_id"] for row in rows] == [
+            0x1234567812345678,
+            legacy_session_id("not-a-uuid"),
+            legacy_session_id("not-a-uuid"),
+        ]
+        assert [row["query"] for row in rows] == ['[["ref", "example"]]', "[]", "[]"]
+        assert {row["url"] for row in rows} == {"https://alexwlchan.net/?ref=example"}
+        assert {row["referrer"] for row in rows} == {""}
+        assert {row["is_me"] for row in rows} == {1}
+
+        # We don't know which rules normalised the legacy referrers
+        assert db.count_outdated_referrers(RULES_VERSION) == db.referrers_table.count
+    finally:
+        db.close()
+
+
+def test_backfills_timestamps(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If the database was created before we had the ``timestamp`` and ``day``
+    columns, they're added and filled in, and they match the values we
+    compute for new events.
+    """
+    monkeypatch.setattr("analytics.database.BACKFILL_CHUNK_SIZE", 2)
+
+    dates = [
+        "1970-01-02T00:00:01",
+        "2001-01-01T01:23:45Z",
+        "2001-01-01T23:59:59.999999",
+        "2024-02-29T12:00:00.123456",
+        "2024-03-01T00:00:00+01:00",
+    ]
+
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite")
+    db.insert_events([create_event(day="2001-01-01") | {"date": d} for d in dates])
+    expected = [(row["timestamp"], row["day"]) for row in db.db["hits"].rows]
+
+    # Put the database back how it was before we had these columns,
+    # or numbered migrations
+    db.db.executescript(
+        """
+        PRAGMA user_version = 0;
+        DROP VIEW events;
+        DROP INDEX hits_by_timestamp;
+        ALTER TABLE hits DROP COLUMN timestamp;
+        ALTER TABLE hits DROP COLUMN day;
+        CREATE VIEW events AS SELECT * FROM hits;
+        CREATE INDEX hits_by_date ON hits(date);
+        """
+    )
+    db.close()
+
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite")
+
+    try:
+        rows = list(db.events_table.rows_where(order_by="id"))
+        assert [(row["timestamp"], row["day"]) for row in rows] == expected
+
+        # The view and indexes are replaced with the current versions
+        hits_indexes = Table(db.db, "hits").indexes
+        assert {idx.name for idx in hits_indexes} == set(HITS_INDEXES)
+        assert expected[0] == (86401, 1)
+        assert (
+            expected[1][1] == expected[2][1] == to_day_number(datetime.date(2001, 1, 1))
+        )
+        assert expected[4][1] == to_day_number(datetime.date(2024, 3, 1))
+    finally:
+        db.close()
+
+
+def test_get_latest_recorded_event(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Find the date of the most recent event.
+    """
+    analytics_db.insert_events(
+        [
+            create_event(day="2001-01-02") | {"date": "2001-01-02T01:00:00"},
+            create_event(day="2001-01-02") | {"date": "2001-01-02T23:00:00"},
+            create_event(day="2001-01-01") | {"date": "2001-01-01T23:30:00"},
+        ]
+    )
+
+    assert analytics_db.get_latest_recorded_event() == datetime.datetime(
+        2001, 1, 2, 23, 0, 0
+    )
+
+    # A late event doesn't move the latest event backwards.
+    analytics_db.insert_events(
+        [create_event(day="2001-01-01") | {"date": "2001-01-01T12:00:00"}]
+    )
+
+    assert analytics_db.get_latest_recorded_event() == datetime.datetime(
+        2001, 1, 2, 23, 0, 0
+    )
+
+
+def test_get_latest_recorded_event_is_none_if_no_events(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    If we haven't recorded any events yet, there's no latest event.
+    """
+    analytics_db.insert_events([])
+
+    assert analytics_db.get_latest_recorded_event() is None
+
+
+def test_get_latest_recorded_event_doesnt_read_hits(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    Finding the latest event reads a single row of ``metadata``, rather
+    than looking through the hits.
+    """
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+
+    plans = get_query_plans(analytics_db, analytics_db.get_latest_recorded_event)
+
+    assert plans == [
+        ["SEARCH metadata USING INDEX sqlite_autoindex_metadata_1 (key=?)"]
+    ]
+
+
+def test_migration_records_latest_event(analytics_db: AnalyticsDatabase) -> None:
+    """
+    When we upgrade an existing database, the migration records the
+    time of the latest hit we already have.
+    """
+    analytics_db.insert_events(
+        [create_event(day="2001-01-02") | {"date": "2001-01-02T03:04:05"}]
+    )
+    analytics_db.db.executescript(
+        """
+        DELETE FROM metadata WHERE key = 'latest_event_timestamp';
+        PRAGMA user_version = 7;
+        """
+    )
+    assert analytics_db.get_latest_recorded_event() is None
+
+    analytics_db.migrate()
+
+    assert analytics_db.get_latest_recorded_event() == datetime.datetime(
+        2001, 1, 2, 3, 4, 5
+    )
+
+
+def test_count_recent_post_views(analytics_db: AnalyticsDatabase) -> None:
+    """
+    Count the views of my most recent posts, including views where the
+    page had a different title.
+    """
+    analytics_db.posts_table.insert_all(
+        [
+            {
+                "id": f"post-{i}",
+                "host": "alexwlchan.net",
+                "path": f"/post-{i}/",
+                "title": f"Post {i}",
+                "date_posted": f"2001-01-0{i}T00:00:00+00:00",
+            }
+            for i in range(1, 4)
+        ],
+        pk="id",
+    )
+
+    analytics_db.insert_events(
+        create_events(day="2001-01-04", path="/post-2/", title="Post 2", count=2)
+        + create_events(day="2001-01-04", path="/post-2/", title="Old title", count=3)
+        + create_events(day="2001-01-04", path="/post-1/", count=1)
+    )
+
+    assert [
+        (post["path"], post["count"])
+        for post in analytics_db.count_recent_post_views(limit=2)
+    ] == [("/post-3/", 0), ("/post-2/", 5)]
+
+
+def test_path_totals_are_filled_in_from_the_rollups(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    When we add ``path_totals`` to an existing database, the migration
+    fills it in from the daily rollups, and any hits which aren't in
+    the rollups yet are added when they catch up.
+    """
+    analytics_db.posts_table.insert(
+        {
+            "id": "post-1",
+            "host": "alexwlchan.net",
+            "path": "/example/",
+            "title": "Example post",
+            "date_posted": "2001-01-01T00:00:00+00:00",
+        },
+        pk="id",
+    )
+
+    analytics_db.insert_events(
+        create_events(day="2001-01-01", count=2)
+        + create_events(day="2001-01-02", title="Old title", count=3)
+    )
+
+    # Copy the hits without updating the rollups, as if they'd been
+    # written by an older version of the app.
+    analytics_db.db.executescript(
+        """
+        DROP TABLE path_totals;
+        PRAGMA user_version = 6;
+
+        INSERT INTO hits (
+            date, page_id, referrer_id, session_id, country,
+            is_bot, is_me, url, timestamp, day
+        )
+        SELECT
+            date, page_id, referrer_id, session_id, country,
+            is_bot, is_me, url, timestamp, day
+        FROM hits;
+        """
+    )
+
+    analytics_db.migrate()
+
+    assert [
+        (post["path"], post["count"])
+        for post in analytics_db.count_recent_post_views(limit=10)
+    ] == [("/example/", 10)]
+
+
+def create_post(title: str = "Example post") -> RssEntry:
+    """
+    Create an example entry from my RSS feed for testing.
+    """
+    url = "https://alexwlchan.net/example/"
+    date_posted = datetime.datetime(2001, 1, 1, tzinfo=datetime.UTC)
+
+    return {
+        "id": url,
+        "date_posted": date_posted,
+        "title": title,
+        "url": url,
+        "host": "alexwlchan.net",
+        "path": "/example/",
+        "content_hash": get_content_hash(
+            entry_id=url, date_posted=date_posted, title=title, url=url
+        ),
+    }
+
+
+def test_save_posts_only_writes_changed_posts(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    Saving a post which hasn't changed doesn't rewrite it, but saving
+    a post which has changed does.
+    """
+    post = create_post()
+
+    assert analytics_db.save_posts([post]) == 1
+    assert analytics_db.get_post_content_hashes() == {post["content_hash"]}
+
+    assert analytics_db.save_posts([post]) == 0
+
+    renamed_post = create_post(title="A better title")
+    assert analytics_db.save_posts([renamed_post]) == 1
+
+    assert analytics_db.get_post_content_hashes() == {renamed_post["content_hash"]}
+    assert [p["title"] for p in analytics_db.count_recent_post_views(limit=10)] == [
+        "A better title"
+    ]
+
+
+def test_migration_adds_content_hash_to_existing_posts(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    If the ``posts`` table was created by an older version of the app,
+    the migration keeps the existing posts, and they don't have a hash
+    until they're saved again.
+    """
+    post = create_post()
+
+    analytics_db.db.executescript("DROP TABLE posts; PRAGMA user_version = 5;")
+    analytics_db.posts_table.upsert_all(
+        [{k: v for k, v in post.items() if k != "content_hash"}], pk="id"
+    )
+
+    analytics_db.migrate()
+
+    assert "content_hash" in analytics_db.posts_table.columns_dict
+    assert analytics_db.posts_table.count == 1
+    assert analytics_db.get_post_content_hashes() == set()
+
+    assert analytics_db.save_posts([post]) == 1
+    assert analytics_db.get_post_content_hashes() == {post["content_hash"]}
+
+
+def get_query_plans(
+    analytics_db: AnalyticsDatabase, query: typing.Callable[[], typing.Any]
+) -> list[list[str]]:
+    """
+    Run a query method, and return the query plan for every SELECT
+    statement it ran.
+    """
+    return [
+        [row[3] for row in analytics_db.db.execute("EXPLAIN QUERY PLAN " + sql)]
+        for sql in trace_statements(analytics_db, query)
+        if sql.strip().upper().startswith("SELECT")
+    ]
+
+
+@pytest.mark.parametrize(
+    "method",
+    [
+        "count_requests_per_day",
+        "count_unique_visitors_per_day",
+        "count_visitors_by_country",
+        "count_hits_per_page",
+        "count_referrers",
+        "count_missing_pages",
+        "count_recent_post_views",
+    ],
+)
+def test_dashboard_queries_use_an_index(
+    analytics_db: AnalyticsDatabase, method: str
+) -> None:
+    """
+    Every dashboard query reads the ``hits`` table and the daily rollups
+    through an index, rather than scanning the whole table.
+    """
+    analytics_db.posts_table.insert(
+        {
+            "id": "post-1",
+            "host": "alexwlchan.net",
+            "path": "/example/",
+            "title": "Example post",
+            "date_posted": "2001-01-01T00:00:00+00:00",
+        },
+        pk="id",
+    )
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+
+    start_date = datetime.date(2001, 1, 1)
+    end_date = datetime.date(2001, 1, 31)
+
+    queries: dict[str, typing.Callable[[], typing.Any]] = {
+        "count_requests_per_day": lambda: analytics_db.count_requests_per_day(
+            start_date, end_date
+        ),
+        "count_unique_visitors_per_day": (
+            lambda: analytics_db.count_unique_visitors_per_day(start_date, end_date)
+        ),
+        "count_visitors_by_country": lambda: analytics_db.count_visitors_by_country(
+            start_date, end_date
+        ),
+        "count_hits_per_page": lambda: analytics_db.count_hits_per_page(
+            start_date, end_date, limit=10
+        ),
+        "count_referrers": lambda: analytics_db.count_referrers(start_date, end_date),
+        "count_missing_pages": lambda: analytics_db.count_missing_pages(
+            start_date, end_date
+        ),
+        "count_recent_post_views": lambda: analytics_db.count_recent_post_views(
+            limit=10
+        ),
+    }
+
+    plans = get_query_plans(analytics_db, queries[method])
+    assert plans != []
+
+    large_tables = {
+        "e",
+        "d",
+        "hits",
+        "daily_totals",
+        "daily_countries",
+        "daily_pages",
+        "daily_referrers",
+        "t",
+        "path_totals",
+    }
+
+    large_table_steps = [
+        step for plan in plans for step in plan if step.split()[1] in large_tables
+    ]
+    assert large_table_steps != [], plans
+
+    for step in large_table_steps:
+        assert step.startswith("SEARCH") or "USING INDEX" in step, plans
+
+
+def get_schema(db: AnalyticsDatabase) -> dict[str, typing.Any]:
+    """
+    Return a description of every table and index in the database, which
+    can be compared between databases.
+    """
+    return {
+        name: (
+            typ,
+            [tuple(row)[1:] for row in db.db.execute(f"PRAGMA table_info({name});")],
+            [tuple(row)[1:] for row in db.db.execute(f"PRAGMA index_list({name});")],
+        )
+        for typ, name in db.db.execute(
+            "SELECT type, name FROM sqlite_master WHERE type IN ('table', 'view')"
+        )
+    }
+
+
+def test_migrated_database_matches_new_database(tmp_path: pathlib.Path) -> None:
+    """
+    Migrating a database with an old-style flat ``events`` table gives
+    the same schema as a new database created from ``schema.sql``.
+    """
+    legacy_db = Database(tmp_path / "legacy.sqlite")
+    legacy_db.execute(
+        """
+        CREATE TABLE [events] (
+           [id] TEXT PRIMARY KEY NOT NULL,
+           [date] TEXT NOT NULL,
+           [url] TEXT NOT NULL,
+           [title] TEXT NOT NULL,
+           [session_id] TEXT NOT NULL,
+           [country] TEXT,
+           [host] TEXT NOT NULL,
+           [path] TEXT NOT NULL,
+           [query] TEXT,
+           [referrer] TEXT,
+           [normalised_referrer] TEXT,
+           [is_bot] BOOLEAN NOT NULL,
+           [is_me] BOOLEAN NOT NULL
+        );
+        """
+    )
+    legacy_db.close()  # type: ignore
+
+    migrated_db = AnalyticsDatabase(tmp_path / "legacy.sqlite")
+    new_db = AnalyticsDatabase(tmp_path / "new.sqlite")
+
+    try:
+        assert get_schema(migrated_db) == get_schema(new_db)
+        assert migrated_db.get_pragma("user_version") == LATEST_VERSION
+        assert new_db.get_pragma("user_version") == LATEST_VERSION
+    finally:
+        migrated_db.close()
+        new_db.close()
+
+
+def test_migrations_are_safe_to_rerun(analytics_db: AnalyticsDatabase) -> None:
+    """
+    If a database was created before we numbered the migrations, they
+    run without changing its schema or its events.
+    """
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+    schema = get_schema(analytics_db)
+
+    analytics_db.db.execute("PRAGMA user_version = 0;")
+    analytics_db.migrate()
+
+    assert get_schema(analytics_db) == schema
+    assert analytics_db.events_table.count == 3
+    assert analytics_db.get_pragma("user_version") == LATEST_VERSION
+
+
+def test_plan_migrations(tmp_path: pathlib.Path) -> None:
+    """
+    A dry run describes the work that ``migrate()`` would do, without
+    changing the database.
+
+    It only needs a read-only connection, so this is how the dry run in
+    ``scripts/migrate_database.py`` opens the database.
+    """
+    legacy_db = Database(tmp_path / "requests.sqlite")
+    legacy_db["events"].insert_all(  # type: ignore
+        [{"id": str(i), "date": "2001-01-01T01:23:45"} for i in range(25001)],
+        pk="id",
+    )
+    legacy_db.close()  # type: ignore
+
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite", pragmas={}, read_only=True)
+
+    try:
+        assert db.plan_migrations() == [
+            "Migration 1: Store events in dictionary-encoded tables",
+            "Migration 2: Add integer timestamp and day columns to hits",
+            "Migration 3: Add daily rollup tables for the dashboard",
+            "Migration 4: Count daily visitors with HyperLogLog sketches",
+            "Migration 5: Add a cache for dashboard query results",
+            "Migration 6: Store a content hash for each post",
+            "Migration 7: Add all-time hit counts for each page",
+            "Migration 8: Record the time of the latest event",
+            "Migration 9: Record which rules each referrer was normalised with",
+            "Replace the events view",
+            "Create index hits_by_timestamp over 0 rows (in a single transaction)",
+            "Move events from the old flat events table: 25,001 rows "
+            "in 3 transactions of up to 10,000 rows",
+        ]
+        assert db.get_pragma("user_version") == 0
+        assert "hits" not in db.db.table_names()
+    finally:
+        db.close()
+
+
+def test_read_only_database_cannot_be_changed(tmp_path: pathlib.Path) -> None:
+    """
+    A read-only connection can't write to the database -- including
+    pragmas like ``journal_mode``, which are saved in the file.
+    """
+    AnalyticsDatabase(tmp_path / "requests.sqlite", pragmas={}).close()
+
+    with pytest.raises(sqlite3.OperationalError, match="readonly database"):
+        AnalyticsDatabase(tmp_path / "requests.sqlite", read_only=True)
+
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite", pragmas={}, read_only=True)
+
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="readonly database"):
+            db.insert_events(create_events(day="2001-01-01", count=1))
+
+        assert db.get_pragma("journal_mode") == "delete"
+    finally:
+        db.close()
+
+
+def test_plan_migrations_for_hits_without_timestamps(
+    analytics_db: AnalyticsDatabase,
+) -> None:
+    """
+    A dry run estimates how many hits need a timestamp, and whether
+    the indexes need to change.
+    """
+    analytics_db.insert_events(create_events(day="2001-01-01", count=3))
+    analytics_db.db.executescript(
+        """
+        PRAGMA user_version = 1;
+        DROP TABLE metadata;
+        DROP TABLE daily_totals;
+        DROP TABLE daily_sketches;
+        DROP TABLE daily_pages;
+        DROP TABLE daily_countries;
+        DROP TABLE daily_referrers;
+        DROP VIEW events;
+        DROP INDEX hits_by_timestamp;
+        ALTER TABLE hits DROP COLUMN timestamp;
+        ALTER TABLE hits DROP COLUMN day;
+        CREATE VIEW events AS SELECT * FROM hits;
+        CREATE INDEX hits_by_date ON hits(date);
+        """
+    )
+
+    assert analytics_db.plan_migrations() == [
+        "Migration 2: Add integer timestamp and day columns to hits",
+        "Migration 3: Add daily rollup tables for the dashboard",
+        "Migration 4: Count daily visitors with HyperLogLog sketches",
+        "Migration 5: Add a cache for dashboard query results",
+        "Migration 6: Store a content hash for each post",
+        "Migration 7: Add all-time hit counts for each page",
+        "Migration 8: Record the time of the latest event",
+        "Migration 9: Record which rules each referrer was normalised with",
+        "Replace the events view",
+        "Drop index hits_by_date",
+        "Create index hits_by_timestamp over 3 rows (in a single transaction)",
+        "Fill in timestamp and day for old hits: 3 rows "
+        "in 1 transactions of up to 10,000 rows",
+        "Add old hits to the daily rollups: 3 rows "
+        "in 1 transactions of up to 10,000 rows",
+    ]
+
+    messages: list[str] = []
+    analytics_db.migrate(log=messages.append)
+
+    assert messages == [
+        "Migration 2: Add integer timestamp and day columns to hits",
+        "Migration 3: Add daily rollup tables for the dashboard",
+        "Migration 4: Count daily visitors with HyperLogLog sketches",
+        "Migration 5: Add a cache for dashboard query results",
+        "Migration 6: Store a content hash for each post",
+        "Migration 7: Add all-time hit counts for each page",
+        "Migration 8: Record the time of the latest event",
+        "Migration 9: Record which rules each referrer was normalised with",
+        "Creating events",
+        "Creating hits_by_timestamp",
+        "Fill in timestamp and day for old hits: 3 rows",
+        "Add old hits to the daily rollups: 3 rows",
+    ]
+    assert analytics_db.plan_migrations() == []
+    assert analytics_db.get_latest_recorded_event() is not None
+
+
+def test_plan_migrations_for_new_database(tmp_path: pathlib.Path) -> None:
+    """
+    A dry run on a new database says it will be created from ``schema.sql``.
+    """
+    db = AnalyticsDatabase(tmp_path / "requests.sqlite", migrate=False)
+
+    try:
+        assert db.plan_migrations() == ["Create a new database from schema.sql"]
+
+        messages: list[str] = []
+        db.migrate(log=messages.append)
+        assert messages[0] == "Creating a new database from schema.sql"
+    finally:
+        db.close()
+
+
+def test_legacy_session_id_keeps_integers() -> None:
+    """
+    A session identifier which is already an integer is unchanged.
+    """
+    assert legacy_session_id(1234) == 1234
+
+
+class TestDatabasePool:
+    """
+    Tests for the ``DatabasePool`` class.
+    """
+
+    def test_reuses_connection_within_thread(self, db_pool: DatabasePool) -> None:
+        """
+        A thread gets the same connection every time it asks.
+        """
+        assert db_pool.get() is db_pool.get()
+
+    def test_each_thread_gets_own_connection(self, db_pool: DatabasePool) -> None:
+        """
+        Different threads get different connections, and connections
+        from finished threads are closed.
+        """
+        main_db = db_pool.get()
+        other_dbs: list[AnalyticsDatabase] = []
+
+        for _ in range(2):
+            thread = threading.Thread(target=lambda: other_dbs.append(db_pool.get()))
+            thread.start()
+            thread.join()
+
+        assert main_db not in other_dbs
+        assert other_dbs[0] is not other_dbs[1]
+
+        # The first thread had finished, so its connection was closed
+        # when the second thread opened a connection.
+        with pytest.raises(sqlite3.ProgrammingError):
+            other_dbs[0].db.execute("SELECT 1")
+
+        main_db.db.execute("SELECT 1")
+
+    def test_does_not_migrate_database(
+        self, analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+    ) -> None:
+        """
+        Getting a connection from the pool never migrates the database.
+        """
+        analytics_db.db.execute("PRAGMA user_version = 8;")
+
+        assert db_pool.get().get_pragma("user_version") == 8
+
+    def test_close_closes_all_connections(self, db_pool: DatabasePool) -> None:
+        """
+        Closing the pool closes every connection, and the next request
+        gets a fresh connection.
+        """
+        db = db_pool.get()
+        db_pool.close()
+
+        with pytest.raises(sqlite3.ProgrammingError):
+            db.db.execute("SELECT 1")
+
+        assert db_pool.get() is not db
@@ -0,0 +1,240 @@
+"""
+Tests for ``analytics.event_writer``.
+"""
+
+import pathlib
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from analytics.database import AnalyticsDatabase, DatabasePool
+from analytics.event_writer import EventWriter
+from conftest import create_event
+
+
+def count_events(analytics_db: AnalyticsDatabase) -> int:
+    """
+    Return the number of events which have been written to the database.
+    """
+    return analytics_db.events_table.count
+
+
+def wait_for_events(analytics_db: AnalyticsDatabase, count: int) -> None:
+    """
+    Wait (up to a couple of seconds) for events to be written by the
+    background thread.
+    """
+    for _ in range(200):  # pragma: no branch
+        if count_events(analytics_db) == count:
+            return
+        time.sleep(0.01)  # pragma: no cover
+
+    assert count_events(analytics_db) == count  # pragma: no cover
+
+
+def test_writes_full_batch_immediately(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    Events are written as soon as there are enough to fill a batch.
+    """
+    writer = EventWriter(db_pool, batch_size=3)
+
+    writer.put(create_event())
+    writer.put(create_event())
+    assert count_events(analytics_db) == 0
+
+    writer.put(create_event())
+    assert count_events(analytics_db) == 3
+
+
+def test_events_put_together_are_written_together(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    If several events are added at once, they're written in the same
+    batch, even if that makes the batch bigger than the batch size.
+    """
+    writer = EventWriter(db_pool, batch_size=2)
+
+    writer.put_many([create_event(), create_event(), create_event()])
+    assert count_events(analytics_db) == 3
+    assert writer.queue.empty()
+
+
+def test_stop_without_start(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    A writer whose background thread was never started can still be
+    stopped, e.g. if the app exits before the first hit.
+    """
+    writer = EventWriter(db_pool, batch_size=100)
+
+    writer.put(create_event())
+    writer.stop()
+    assert count_events(analytics_db) == 1
+
+
+def test_writes_partial_batch_after_interval(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    If a batch isn't full, the events are written after the flush interval.
+    """
+    writer = EventWriter(db_pool, batch_size=100, flush_interval=0.01)
+    writer.start()
+
+    try:
+        writer.put(create_event())
+        wait_for_events(analytics_db, count=1)
+    finally:
+        writer.stop()
+
+
+def test_stop_writes_remaining_events(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    Stopping the writer writes any events which are still queued.
+    """
+    writer = EventWriter(db_pool, batch_size=100, flush_interval=60)
+    writer.start()
+
+    writer.put(create_event())
+    writer.put(create_event())
+    assert count_events(analytics_db) == 0
+
+    writer.stop()
+    assert count_events(analytics_db) == 2
+
+
+def test_flush_with_no_events_is_noop(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    Flushing an empty queue doesn't write anything.
+    """
+    writer = EventWriter(db_pool)
+
+    assert writer.flush() == 0
+    assert analytics_db.events_table.count == 0
+
+
+def test_drop_policy_discards_events_when_full(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    With the ``drop`` overflow policy, events which arrive when the
+    queue is full are discarded.
+    """
+    writer = EventWriter(
+        db_pool, batch_size=10, max_queue_size=2, overflow_policy="drop"
+    )
+
+    for _ in range(3):
+        writer.put(create_event())
+
+    assert writer.dropped_events == 1
+    assert writer.flush() == 2
+
+
+def test_drop_policy_counts_events_from_every_thread(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    If several threads drop events at the same time, every dropped
+    event is counted.
+    """
+    writer = EventWriter(
+        db_pool, batch_size=10, max_queue_size=1, overflow_policy="drop"
+    )
+    writer.put(create_event())
+
+    def drop_events() -> None:
+        """
+        Put events on the full queue, which are all dropped.
+        """
+        for _ in range(1000):
+            writer.put(create_event())
+
+    threads = [threading.Thread(target=drop_events) for _ in range(8)]
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    assert writer.dropped_events == 8000
+
+
+def test_flush_policy_writes_events_when_full(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool
+) -> None:
+    """
+    With the ``flush`` overflow policy, events which arrive when the
+    queue is full cause the queue to be written immediately.
+    """
+    writer = EventWriter(
+        db_pool, batch_size=10, max_queue_size=2, overflow_policy="flush"
+    )
+
+    for _ in range(3):
+        writer.put(create_event())
+
+    assert writer.dropped_events == 0
+    assert count_events(analytics_db) == 2
+    assert writer.queue.qsize() == 1
+
+
+def test_failed_writes_are_retried(
+    analytics_db: AnalyticsDatabase, db_pool: DatabasePool, tmp_path: pathlib.Path
+) -> None:
+    """
+    If the events can't be written, they're kept and retried on
+    the next flush.
+    """
+    writer = EventWriter(DatabasePool(tmp_path / "doesnotexist" / "requests.sqlite"))
+    writer.put(create_event())
+
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+
+    writer.pool = db_pool
+    assert writer.flush() == 1
+    assert count_events(analytics_db) == 1
+
+
+def test_background_errors_are_reported(
+    analytics_db: AnalyticsDatabase,
+    db_pool: DatabasePool,
+    tmp_path: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    """
+    If the background thread can't write events, it reports the error
+    and keeps running.
+    """
+    writer = EventWriter(
+        DatabasePool(tmp_path / "doesnotexist" / "requests.sqlite"),
+        flush_interval=0.01,
+    )
+    writer.start()
+
+    try:
+        writer.put(create_event())
+
+        for _ in range(200):  # pragma: no branch
+            if "Unable to write events" in capsys.readouterr().err:
+                break
+            time.sleep(0.01)
+        else:  # pragma: no cover
+            assert False, "Error was never reported"
+    finally:
+        writer.pool = db_pool
+        writer.stop()
+
+    assert count_events(analytics_db) == 1
@@ -4,10 +4,17 @@ Tests for ``analytics.fetch_rss_feed``.
 
 import datetime
 import pathlib
+import typing
+from xml.etree import ElementTree
 
 import pytest
 
-from analytics.fetch_rss_feed import fetch_rss_feed_entries, NoNewEntries
+from analytics.fetch_rss_feed import (
+    fetch_rss_feed,
+    NoNewEntries,
+    parse_entry,
+    save_etag,
+)
 
 
 @pytest.mark.vcr()
@@ -15,9 +22,9 @@ def test_fetch_rss_feed_entries(tmp_working_dir: pathlib.Path) -> None:
     """
     Fetch entries from my RSS feed.
     """
-    entries = fetch_rss_feed_entries()
+    entries = fetch_rss_feed().entries
 
-    assert next(entries) == {
+    assert entries[0] == {
         "id": "https://alexwlchan.net/2024/documenting-my-dns",
         "date_posted": datetime.datetime(
             2024, 5, 25, 13, 21, 10, tzinfo=datetime.timezone.utc
@@ -26,9 +33,12 @@ def test_fetch_rss_feed_entries(tmp_working_dir: pathlib.Path) -> None:
         "url": "https://alexwlchan.net/2024/documenting-my-dns/",
         "host": "alexwlchan.net",
         "path": "/2024/documenting-my-dns/",
+        "content_hash": (
+            "ff9623a8091b3b8ef7156be0f13c289bf27cbe6168ae2d2ee2d50783f5571b7b"
+        ),
     }
 
-    assert next(entries) == {
+    assert entries[1] == {
         "id": "https://alexwlchan.net/2024/preserving-pixels-in-paris",
         "date_posted": datetime.datetime(
             2024, 5, 23, 20, 52, 42, tzinfo=datetime.timezone.utc
@@ -37,9 +47,27 @@ def test_fetch_rss_feed_entries(tmp_working_dir: pathlib.Path) -> None:
         "url": "https://alexwlchan.net/2024/preserving-pixels-in-paris/",
         "host": "alexwlchan.net",
         "path": "/2024/preserving-pixels-in-paris/",
+        "content_hash": (
+            "d066d5db7c9bfe73d7a0427e4a9c787538fb4edf4883dcdef48f19652f003dc1"
+        ),
     }
 
 
+def test_it_stops_at_known_entries(
+    tmp_working_dir: pathlib.Path, vcr: typing.Any
+) -> None:
+    """
+    It stops reading the RSS feed when it reaches an entry we've
+    already saved, which hasn't changed.
+    """
+    known_hashes = {"d066d5db7c9bfe73d7a0427e4a9c787538fb4edf4883dcdef48f19652f003dc1"}
+
+    with vcr.use_cassette("test_fetch_rss_feed_entries.yaml"):
+        entries = fetch_rss_feed(known_hashes=known_hashes).entries
+
+    assert [e["title"] for e in entries] == ["Documenting my DNS records"]
+
+
 @pytest.mark.vcr()
 def test_it_skips_if_no_new_entries(tmp_working_dir: pathlib.Path) -> None:
     """
@@ -49,11 +77,54 @@ def test_it_skips_if_no_new_entries(tmp_working_dir: pathlib.Path) -> None:
     This is using the HTTP caching headers to reduce passing around
     unnecessary data.
     """
-    for _ in fetch_rss_feed_entries():
-        pass
+    save_etag(fetch_rss_feed().etag)
 
     with pytest.raises(NoNewEntries):
-        for _ in fetch_rss_feed_entries():
-            pass  # pragma: no cover
+        fetch_rss_feed()
 
     assert (tmp_working_dir / "rss_feed.etag.txt").exists()
+
+
+def test_etag_is_only_saved_explicitly(
+    tmp_working_dir: pathlib.Path, vcr: typing.Any
+) -> None:
+    """
+    Fetching the RSS feed doesn't save the ETag, so if we fail to save
+    the entries, we fetch them again next time.
+    """
+    with vcr.use_cassette("test_fetch_rss_feed_entries.yaml"):
+        fetch_rss_feed()
+
+    assert not (tmp_working_dir / "rss_feed.etag.txt").exists()
+
+
+def test_html_titles_are_decoded(
+    tmp_working_dir: pathlib.Path, vcr: typing.Any
+) -> None:
+    """
+    A title with ``type="html"`` is decoded to plain text, so e.g.
+    ``&rarr;`` becomes an arrow.
+    """
+    with vcr.use_cassette("test_fetch_rss_feed_entries.yaml"):
+        titles = [e["title"] for e in fetch_rss_feed().entries]
+
+    assert "The new Flickr Commons Explorer \u2192" in titles
+    assert not any("&rarr;" in t for t in titles)
+
+
+def test_text_titles_are_not_decoded() -> None:
+    """
+    A title with ``type="text"`` is already plain text, so we keep
+    anything which looks like an HTML entity.
+    """
+    entry = ElementTree.fromstring(
+        """
+        <entry xmlns="http://www.w3.org/2005/Atom">
+          <id>https://alexwlchan.net/example</id>
+          <published>2001-01-01T00:00:00+00:00</published>
+          <title type="text">Escaping &amp;amp; in HTML</title>
+        </entry>
+        """
+    )
+
+    assert parse_entry(entry)["title"] == "Escaping &amp; in HTML"
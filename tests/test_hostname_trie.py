@@ -0,0 +1,119 @@
+"""
+Tests for ``analytics.hostname_trie``.
+"""
+
+import time
+
+import pytest
+
+from analytics.hostname_trie import HostnameTrie
+
+
+@pytest.fixture
+def trie() -> HostnameTrie:
+    """
+    A trie with a mix of exact and wildcard patterns.
+    """
+    return HostnameTrie(
+        {
+            "news.ycombinator.com": "Hacker News",
+            "hn.algolia.com": "Hacker News",
+            "www.google.*": "Search",
+            "www.google.*.*": "Search",
+            "*.search.yahoo.com": "Search",
+            "news.search.yahoo.com": "Yahoo News",
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "hostname, value",
+    [
+        ("news.ycombinator.com", "Hacker News"),
+        ("hn.algolia.com", "Hacker News"),
+        ("www.google.com", "Search"),
+        ("www.google.co.uk", "Search"),
+        ("cl.search.yahoo.com", "Search"),
+        # An exact label takes precedence over a wildcard
+        ("news.search.yahoo.com", "Yahoo News"),
+    ],
+)
+def test_finds_matching_pattern(trie: HostnameTrie, hostname: str, value: str) -> None:
+    """
+    A hostname matches an exact pattern, or a pattern with wildcards.
+    """
+    assert trie.get(hostname) == value
+
+
+@pytest.mark.parametrize(
+    "hostname",
+    [
+        # A pattern has to match the whole hostname, not just a suffix
+        "www.hn.algolia.com",
+        "algolia.com",
+        # A wildcard matches exactly one label
+        "search.yahoo.com",
+        "a.b.search.yahoo.com",
+        "www.google.a.b.c",
+        "google.com",
+        "",
+    ],
+)
+def test_ignores_other_hostnames(trie: HostnameTrie, hostname: str) -> None:
+    """
+    A hostname which doesn't match any of the patterns returns None.
+    """
+    assert trie.get(hostname) is None
+
+
+def test_backtracks_from_exact_label_to_wildcard() -> None:
+    """
+    If an exact label leads to a dead end, we try the wildcard instead.
+    """
+    trie = HostnameTrie({"a.example.com": "exact", "*.*.com": "wildcard"})
+
+    assert trie.get("a.example.com") == "exact"
+    assert trie.get("b.example.com") == "wildcard"
+
+
+def test_cannot_add_pattern_twice() -> None:
+    """
+    Adding the same pattern twice is an error, because it's probably
+    a mistake in the rules.
+    """
+    trie = HostnameTrie({"example.com": "first"})
+
+    with pytest.raises(AssertionError, match="Duplicate hostname pattern"):
+        trie.add("example.com", "second")
+
+
+def test_items_returns_every_pattern(trie: HostnameTrie) -> None:
+    """
+    Iterating over the trie gets back the patterns it was created with.
+    """
+    assert dict(trie.items()) == {
+        "news.ycombinator.com": "Hacker News",
+        "hn.algolia.com": "Hacker News",
+        "www.google.*": "Search",
+        "www.google.*.*": "Search",
+        "*.search.yahoo.com": "Search",
+        "news.search.yahoo.com": "Yahoo News",
+    }
+
+
+def test_lookups_are_fast_with_lots_of_hostnames() -> None:
+    """
+    A lookup takes about the same time with thousands of hostnames
+    as it does with a handful.
+    """
+    trie = HostnameTrie(
+        {f"mirror-{i}.news.example.com": f"Mirror {i}" for i in range(10_000)}
+    )
+    assert len(trie) == 10_000
+
+    start = time.perf_counter()
+
+    for i in range(10_000):
+        assert trie.get(f"mirror-{i}.news.example.com") == f"Mirror {i}"
+
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,83 @@
+"""
+Tests for ``analytics.hyperloglog``.
+"""
+
+import pytest
+
+from analytics.hyperloglog import HyperLogLog, REGISTER_COUNT, STANDARD_ERROR
+
+
+def test_empty_sketch_counts_zero() -> None:
+    """
+    A sketch with no values has a count of zero.
+    """
+    assert HyperLogLog().count() == 0
+
+
+def test_small_counts_are_exact() -> None:
+    """
+    Small counts use linear counting, which is exact for a handful
+    of values, and repeated values are only counted once.
+    """
+    sketch = HyperLogLog()
+
+    for value in [1, 2, 3, -1, 2**63 - 1, 1, 2, 3]:
+        sketch.add(value)
+
+    assert sketch.count() == 5
+
+
+@pytest.mark.parametrize("true_count", [1000, 10_000, 100_000])
+def test_large_counts_are_within_error_bound(true_count: int) -> None:
+    """
+    Large counts are within three standard errors of the true count.
+    """
+    sketch = HyperLogLog()
+
+    for value in range(true_count):
+        sketch.add(value)
+
+    assert abs(sketch.count() - true_count) <= 3 * STANDARD_ERROR * true_count
+
+
+def test_union_counts_values_from_every_sketch() -> None:
+    """
+    Merging sketches gives the same registers as adding all the values
+    to a single sketch, and overlapping values are only counted once.
+    """
+    sketches = [HyperLogLog(), HyperLogLog(), HyperLogLog()]
+    combined = HyperLogLog()
+
+    for i, sketch in enumerate(sketches):
+        for value in range(i * 500, i * 500 + 1000):
+            sketch.add(value)
+            combined.add(value)
+
+    union = HyperLogLog.union(sketches)
+
+    assert union.registers == combined.registers
+    assert HyperLogLog.union(sketches[:1]).registers == sketches[0].registers
+    assert HyperLogLog.union([]).count() == 0
+
+
+def test_can_serialise_sketch() -> None:
+    """
+    A sketch can be saved as bytes and loaded again.
+    """
+    sketch = HyperLogLog()
+
+    for value in range(100):
+        sketch.add(value)
+
+    data = sketch.to_bytes()
+
+    assert len(data) < REGISTER_COUNT
+    assert HyperLogLog.from_bytes(data).registers == sketch.registers
+
+
+def test_rejects_wrong_number_of_registers() -> None:
+    """
+    Creating a sketch with the wrong number of registers is an error.
+    """
+    with pytest.raises(ValueError, match="Expected 4096 registers, got 3"):
+        HyperLogLog(b"\x00\x00\x00")
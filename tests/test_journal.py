@@ -0,0 +1,236 @@
+"""
+Tests for ``analytics.journal``.
+"""
+
+import os
+import pathlib
+import subprocess
+import sys
+import time
+
+import pytest
+
+from analytics.database import AnalyticsDatabase
+from analytics.journal import compact_journal, EventJournal
+from conftest import create_event
+
+
+def list_segments(journal_dir: pathlib.Path, suffix: str) -> list[pathlib.Path]:
+    """
+    Return all the segments in the journal with the given suffix.
+    """
+    return sorted(journal_dir.glob(f"segment-*{suffix}"))
+
+
+def test_events_are_appended_to_segment(tmp_path: pathlib.Path) -> None:
+    """
+    Events are appended to an open segment, which is closed when the
+    journal is stopped.
+    """
+    journal = EventJournal(tmp_path / "journal")
+    journal.start()
+
+    journal.put(create_event())
+    journal.put_many([create_event(), create_event()])
+
+    open_segments = list_segments(tmp_path / "journal", ".open")
+    assert len(open_segments) == 1
+    assert len(open_segments[0].read_text().splitlines()) == 3
+
+    journal.stop()
+
+    assert list_segments(tmp_path / "journal", ".open") == []
+    assert len(list_segments(tmp_path / "journal", ".jsonl")) == 1
+
+
+def test_segment_is_closed_when_full(tmp_path: pathlib.Path) -> None:
+    """
+    Once a segment has enough events, it's closed and the next event
+    starts a new segment.
+    """
+    journal = EventJournal(tmp_path / "journal", max_segment_events=2)
+
+    for _ in range(3):
+        journal.put(create_event())
+
+    assert len(list_segments(tmp_path / "journal", ".jsonl")) == 1
+    assert len(list_segments(tmp_path / "journal", ".open")) == 1
+
+    journal.stop()
+
+
+def test_sync_closes_old_segment(tmp_path: pathlib.Path) -> None:
+    """
+    Syncing the journal fsyncs the current segment, and closes it once
+    it's old enough.
+    """
+    journal = EventJournal(tmp_path / "journal", max_segment_age=3600)
+
+    # Syncing with no segment does nothing
+    journal.sync()
+
+    journal.put(create_event())
+    journal.sync()
+    journal.sync()
+    assert len(list_segments(tmp_path / "journal", ".open")) == 1
+
+    journal.max_segment_age = 0
+    journal.sync()
+    assert len(list_segments(tmp_path / "journal", ".open")) == 0
+    assert len(list_segments(tmp_path / "journal", ".jsonl")) == 1
+
+    journal.stop()
+
+
+def test_background_thread_closes_old_segments(tmp_path: pathlib.Path) -> None:
+    """
+    The background thread closes segments when they get too old, even
+    if no more events arrive.
+    """
+    journal = EventJournal(
+        tmp_path / "journal", max_segment_age=0.01, fsync_interval=0.01
+    )
+    journal.start()
+
+    try:
+        journal.put(create_event())
+
+        for _ in range(200):  # pragma: no branch
+            if list_segments(tmp_path / "journal", ".jsonl"):
+                break
+            time.sleep(0.01)
+        else:  # pragma: no cover
+            assert False, "Segment was never closed"
+    finally:
+        journal.stop()
+
+
+def test_background_errors_are_reported(
+    tmp_path: pathlib.Path,
+    capsys: pytest.CaptureFixture[str],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    If the background thread can't sync the journal, it reports the error
+    and keeps running.
+    """
+    journal = EventJournal(tmp_path / "journal", fsync_interval=0.01)
+
+    def broken_sync() -> None:
+        """
+        Simulate a failure to sync the journal.
+        """
+        raise OSError("disk is full")
+
+    monkeypatch.setattr(journal, "sync", broken_sync)
+    journal.start()
+
+    try:
+        for _ in range(200):  # pragma: no branch
+            if "Unable to sync event journal" in capsys.readouterr().err:
+                break
+            time.sleep(0.01)
+        else:  # pragma: no cover
+            assert False, "Error was never reported"
+    finally:
+        journal.stop()
+
+
+class TestCompactJournal:
+    """
+    Tests for ``compact_journal()``.
+    """
+
+    def test_loads_closed_segments(
+        self, analytics_db: AnalyticsDatabase, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        Closed segments are loaded into the database, and then deleted.
+        Open segments are left alone.
+        """
+        journal_dir = tmp_path / "journal"
+
+        journal = EventJournal(journal_dir, max_segment_events=2)
+        for _ in range(5):
+            journal.put(create_event())
+
+        assert compact_journal(analytics_db, journal_dir) == 4
+        assert analytics_db.events_table.count == 4
+        assert list_segments(journal_dir, ".jsonl") == []
+        assert len(list_segments(journal_dir, ".open")) == 1
+
+        journal.stop()
+
+        assert compact_journal(analytics_db, journal_dir) == 1
+        assert analytics_db.events_table.count == 5
+        assert list(analytics_db.db["journal_checkpoints"].rows) == []
+
+    def test_segment_is_never_loaded_twice(
+        self, analytics_db: AnalyticsDatabase, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        If the compactor crashes after loading a segment but before
+        deleting it, the segment isn't loaded again.
+        """
+        journal_dir = tmp_path / "journal"
+
+        journal = EventJournal(journal_dir)
+        journal.put_many([create_event(), create_event()])
+        journal.stop()
+
+        segment = list_segments(journal_dir, ".jsonl")[0]
+        events = [create_event(), create_event()]
+        assert analytics_db.load_journal_segment(segment.name, events)
+
+        assert compact_journal(analytics_db, journal_dir) == 0
+        assert analytics_db.events_table.count == 2
+        assert not segment.exists()
+
+    def test_recovers_abandoned_segments(
+        self, analytics_db: AnalyticsDatabase, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        If a process stopped without closing its segment, the compactor
+        loads the segment anyway.
+        """
+        journal_dir = tmp_path / "journal"
+
+        # Get the ID of a process which has definitely finished
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+
+        journal = EventJournal(journal_dir)
+        journal.put_many([create_event(), create_event()])
+
+        own_segment = list_segments(journal_dir, ".open")[0]
+        dead_segment = own_segment.with_name(
+            own_segment.name.replace(f"-{os.getpid()}.", f"-{proc.pid}.")
+        )
+        dead_segment.write_text(own_segment.read_text())
+
+        assert compact_journal(analytics_db, journal_dir) == 2
+        assert list_segments(journal_dir, ".open") == [own_segment]
+
+        journal.stop()
+
+    def test_skips_incomplete_lines(
+        self,
+        analytics_db: AnalyticsDatabase,
+        tmp_path: pathlib.Path,
+        capsys: pytest.CaptureFixture[str],
+    ) -> None:
+        """
+        If the last line of a segment is incomplete, it's skipped.
+        """
+        journal_dir = tmp_path / "journal"
+
+        journal = EventJournal(journal_dir)
+        journal.put_many([create_event(), create_event()])
+        journal.stop()
+
+        segment = list_segments(journal_dir, ".jsonl")[0]
+        with open(segment, "a") as out_file:
+            out_file.write('{"date": "2001-01-01T01:23:45", "ur')
+
+        assert compact_journal(analytics_db, journal_dir) == 2
+        assert "Skipping bad line" in capsys.readouterr().err
@@ -4,6 +4,8 @@ Tests for ``analytics.referrer``.
 
 import pytest
 
+from analytics import referrers
+from analytics.hostname_trie import HostnameTrie
 from analytics.referrers import get_normalised_referrer, QueryParams
 
 
@@ -411,3 +413,27 @@ def test_it_drops_google_translate_referrer() -> None:
     )
 
     assert get_normalised_referrer(referrer=referrer, query=query) is None
+
+
+def test_rules_version_is_stable() -> None:
+    """
+    The rules version is the same every time we compute it, so we don't
+    re-normalise referrers unless the rules have changed.
+    """
+    assert referrers.get_rules_version() == referrers.RULES_VERSION
+
+
+def test_rules_version_changes_when_rules_change(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Changing the rules or the code version changes the rules version.
+    """
+    hostnames = HostnameTrie(dict(referrers.HOSTNAMES.items()))
+    hostnames.add("news.example.com", "Example News")
+    monkeypatch.setattr(referrers, "HOSTNAMES", hostnames)
+    assert referrers.get_rules_version() != referrers.RULES_VERSION
+
+    monkeypatch.undo()
+    monkeypatch.setattr(referrers, "RULES_CODE_VERSION", 2)
+    assert referrers.get_rules_version() != referrers.RULES_VERSION
@@ -0,0 +1,275 @@
+"""
+Tests for ``analytics.refresher``.
+"""
+
+from collections.abc import Callable, Iterator
+import datetime
+import http.server
+import json
+import pathlib
+import threading
+import time
+import typing
+
+import httpx
+import pytest
+
+from analytics.fetch_netlify_bandwidth import (
+    fetch_netlify_bandwidth_usage,
+    get_retry_after,
+)
+from analytics.fetch_rss_feed import fetch_rss_feed
+from analytics.refresher import BackgroundRefresher
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """
+    A local HTTP server which pretends to be the Netlify API, and
+    records how many requests it's had.
+    """
+
+    # How long to wait before responding to each request, in seconds.
+    delay: float = 0
+
+    # The ``Retry-After`` header to send with each response.
+    retry_after: datetime.datetime
+
+    request_count: int = 0
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Responds to every request with the same Netlify bandwidth usage.
+    """
+
+    server: StubServer
+
+    def do_GET(self) -> None:
+        """
+        Send the bandwidth usage as JSON.
+        """
+        self.server.request_count += 1
+        time.sleep(self.server.delay)
+
+        body = json.dumps(
+            {
+                "used": self.server.request_count,
+                "included": 200,
+                "period_start_date": "2024-05-17T00:00:00.000-07:00",
+                "period_end_date": "2024-06-17T00:00:00.000-07:00",
+            }
+        ).encode("utf8")
+
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", f'"{self.server.request_count}"')
+            self.send_header(
+                "Retry-After",
+                self.server.retry_after.strftime("%Y-%m-%d %H:%M:%S UTC"),
+            )
+            self.end_headers()
+            self.wfile.write(body)
+        except ConnectionError:  # pragma: no cover
+            pass
+
+    def log_message(self, format: str, *args: typing.Any) -> None:
+        """
+        Don't print a log line for every request.
+        """
+        pass
+
+
+@pytest.fixture
+def stub_server(tmp_working_dir: pathlib.Path) -> Iterator[StubServer]:
+    """
+    Run a stub Netlify API on a local port for the duration of the test.
+    """
+    server = StubServer(("127.0.0.1", 0), StubHandler)
+    server.retry_after = datetime.datetime.now(datetime.UTC)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def stub_url(server: StubServer) -> str:
+    """
+    Returns the URL of the stub server.
+    """
+    host, port = server.server_address[:2]
+    return f"http://{host!s}:{port}/bandwidth"
+
+
+def wait_until(condition: Callable[[], bool]) -> None:
+    """
+    Wait for up to five seconds for a condition to become true.
+    """
+    deadline = time.monotonic() + 5
+
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out waiting for condition"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def refresher(tmp_working_dir: pathlib.Path) -> Iterator[BackgroundRefresher]:
+    """
+    A BackgroundRefresher which is stopped at the end of the test.
+
+    It's stopped before we leave ``tmp_working_dir``, so a fetch which
+    is still running doesn't write its cache to the real working directory.
+    """
+    refresher = BackgroundRefresher()
+    yield refresher
+    refresher.stop()
+
+
+def test_refreshes_on_interval(refresher: BackgroundRefresher) -> None:
+    """
+    The value is fetched again every ``interval`` seconds, and ``get()``
+    returns the latest value.
+    """
+    calls = []
+
+    def fetch() -> int:
+        """
+        Return the number of times this has been called.
+        """
+        calls.append(1)
+        return len(calls)
+
+    refresher.add_task("counter", fetch, interval=0.01, retry_after=lambda: None)
+    refresher.start()
+
+    assert refresher.get("counter") >= 1
+
+    wait_until(lambda: refresher.get("counter") >= 3)
+
+
+def test_keeps_last_good_value_if_fetch_fails(
+    refresher: BackgroundRefresher, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    If a fetch fails, ``get()`` keeps returning the last value that
+    was fetched successfully.
+    """
+    calls = []
+
+    def fetch() -> str:
+        """
+        Succeed on the first call, then fail.
+        """
+        calls.append(1)
+
+        if len(calls) == 1:
+            return "first value"
+
+        raise ValueError("the service is down")
+
+    refresher.add_task("flaky", fetch, interval=0.01)
+    refresher.start()
+
+    wait_until(lambda: len(calls) >= 3)
+    refresher.stop()
+
+    assert refresher.get("flaky") == "first value"
+    assert "Unable to refresh 'flaky': the service is down" in capsys.readouterr().err
+
+
+def test_get_is_none_if_first_fetch_fails(
+    refresher: BackgroundRefresher, capsys: pytest.CaptureFixture[str]
+) -> None:
+    """
+    If the first fetch fails, ``get()`` returns None rather than waiting
+    for a fetch that succeeds.
+    """
+
+    def fetch() -> str:
+        """
+        Always fail.
+        """
+        raise ValueError("the service is down")
+
+    refresher.add_task("broken", fetch, interval=60)
+    refresher.start()
+
+    assert refresher.get("broken") is None
+    assert "Unable to refresh 'broken'" in capsys.readouterr().err
+
+
+def test_serves_stale_value_while_refreshing(
+    refresher: BackgroundRefresher, stub_server: StubServer
+) -> None:
+    """
+    While the service is slow to respond, ``get()`` returns the last
+    value immediately, rather than waiting for the new one.
+    """
+    url = stub_url(stub_server)
+
+    refresher.add_task(
+        "netlify_usage", lambda: fetch_netlify_bandwidth_usage(url), interval=0.01
+    )
+    refresher.start()
+
+    assert refresher.get("netlify_usage")["used"] == 1
+
+    stub_server.delay = 1
+    wait_until(lambda: stub_server.request_count >= 2)
+
+    start = time.monotonic()
+    assert refresher.get("netlify_usage")["used"] == 1
+    assert time.monotonic() - start < 0.1
+
+
+def test_waits_until_retry_after(
+    refresher: BackgroundRefresher, stub_server: StubServer
+) -> None:
+    """
+    If the Netlify API sends a ``Retry-After`` header, we don't fetch
+    the data again until that time, even if the interval has passed.
+    """
+    url = stub_url(stub_server)
+    stub_server.retry_after = datetime.datetime.now(datetime.UTC) + datetime.timedelta(
+        hours=1
+    )
+
+    refresher.add_task(
+        "netlify_usage",
+        lambda: fetch_netlify_bandwidth_usage(url),
+        interval=0.01,
+        retry_after=get_retry_after,
+    )
+    refresher.start()
+
+    assert refresher.get("netlify_usage")["used"] == 1
+    time.sleep(0.1)
+
+    assert stub_server.request_count == 1
+
+
+def test_get_retry_after_is_none_without_cache(
+    tmp_working_dir: pathlib.Path,
+) -> None:
+    """
+    If we've never fetched the Netlify bandwidth usage, we don't know
+    when we can fetch it again.
+    """
+    assert get_retry_after() is None
+
+
+def test_slow_feed_times_out(stub_server: StubServer) -> None:
+    """
+    If the server takes too long to respond, the fetch fails rather
+    than waiting forever.
+    """
+    stub_server.delay = 1
+
+    with pytest.raises(httpx.TimeoutException):
+        fetch_rss_feed(stub_url(stub_server), timeout=0.1)
@@ -0,0 +1,167 @@
+"""
+Tests for ``analytics.utils``.
+"""
+
+import concurrent.futures
+import datetime
+import os
+import pathlib
+import threading
+
+import pytest
+
+from analytics.utils import (
+    delete_old_session_keys,
+    get_session_identifier,
+    get_session_key,
+)
+
+
+def test_session_identifier_is_stable(tmp_path: pathlib.Path) -> None:
+    """
+    The same visitor gets the same session identifier on the same day,
+    even if the in-memory cache is cleared (e.g. by a restart, or
+    a different worker).
+    """
+    d = datetime.date(2001, 2, 3)
+    key_dir = tmp_path / "session_keys"
+
+    session_id = get_session_identifier(
+        d, ip_address="1.2.3.4", user_agent="Firefox", key_dir=key_dir
+    )
+    get_session_key.cache_clear()
+
+    assert session_id == get_session_identifier(
+        d, ip_address="1.2.3.4", user_agent="Firefox", key_dir=key_dir
+    )
+    assert isinstance(session_id, int)
+    assert -(2**63) <= session_id < 2**63
+
+
+def test_session_identifier_depends_on_visitor(tmp_path: pathlib.Path) -> None:
+    """
+    Visitors with a different IP address or User-Agent get different
+    session identifiers.
+    """
+    d = datetime.date(2001, 2, 3)
+    key_dir = tmp_path / "session_keys"
+
+    session_ids = {
+        get_session_identifier(
+            d, ip_address=ip_address, user_agent=user_agent, key_dir=key_dir
+        )
+        for ip_address in ("1.2.3.4", "5.6.7.8")
+        for user_agent in ("Firefox", "Safari")
+    }
+
+    assert len(session_ids) == 4
+
+
+def test_session_key_rotates_daily(tmp_path: pathlib.Path) -> None:
+    """
+    Each day gets a new key, readable only by us.
+    """
+    key_dir = tmp_path / "session_keys"
+
+    key1 = get_session_key(datetime.date(2001, 2, 3), key_dir=key_dir)
+    key2 = get_session_key(datetime.date(2001, 2, 4), key_dir=key_dir)
+
+    assert key1 != key2
+    assert sorted(os.listdir(key_dir)) == ["2001-02-03.key", "2001-02-04.key"]
+    assert (key_dir / "2001-02-04.key").stat().st_mode & 0o777 == 0o600
+
+
+def test_old_session_keys_are_deleted_after_grace_period(
+    tmp_path: pathlib.Path,
+) -> None:
+    """
+    Yesterday's key is deleted a few minutes after midnight, and the
+    keys for earlier days are deleted straight away.
+    """
+    key_dir = tmp_path / "session_keys"
+
+    for day in (2, 3, 4):
+        get_session_key(datetime.date(2001, 2, day), key_dir=key_dir)
+
+    delete_old_session_keys(datetime.datetime(2001, 2, 4, 0, 1), key_dir=key_dir)
+    assert sorted(os.listdir(key_dir)) == ["2001-02-03.key", "2001-02-04.key"]
+
+    delete_old_session_keys(datetime.datetime(2001, 2, 4, 0, 6), key_dir=key_dir)
+    assert os.listdir(key_dir) == ["2001-02-04.key"]
+
+    # The deleted keys are forgotten in memory, too
+    assert get_session_key.cache_info().currsize == 0
+
+
+def test_does_not_delete_newer_keys(tmp_path: pathlib.Path) -> None:
+    """
+    If another worker has already created the key for a later day
+    (e.g. because our clock is behind), we don't delete it.
+    """
+    key_dir = tmp_path / "session_keys"
+
+    get_session_key(datetime.date(2001, 2, 5), key_dir=key_dir)
+    get_session_key(datetime.date(2001, 2, 1), key_dir=key_dir)
+
+    delete_old_session_keys(datetime.datetime(2001, 2, 1, 12), key_dir=key_dir)
+
+    assert sorted(os.listdir(key_dir)) == ["2001-02-01.key", "2001-02-05.key"]
+
+
+def test_threads_share_one_key(tmp_path: pathlib.Path) -> None:
+    """
+    If several threads create today's key at the same time, they all
+    get the same key.
+    """
+    key_dir = tmp_path / "session_keys"
+    barrier = threading.Barrier(8)
+
+    def create_key() -> bytes:
+        """
+        Create the key once every thread is ready.
+        """
+        barrier.wait()
+        return get_session_key.__wrapped__(datetime.date(2001, 2, 3), key_dir=key_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        keys = {f.result() for f in [executor.submit(create_key) for _ in range(8)]}
+
+    assert len(keys) == 1
+    assert os.listdir(key_dir) == ["2001-02-03.key"]
+
+
+def test_uses_key_created_by_another_worker(tmp_path: pathlib.Path) -> None:
+    """
+    If another worker has already created today's key, we use that key
+    rather than creating our own.
+    """
+    key_dir = tmp_path / "session_keys"
+    key_dir.mkdir()
+    (key_dir / "2001-02-03.key").write_bytes(b"1234")
+
+    assert get_session_key(datetime.date(2001, 2, 3), key_dir=key_dir) == b"1234"
+
+
+def test_handles_race_to_create_key(
+    tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    If another worker creates today's key while we're creating ours,
+    we use their key and clean up our temporary file.
+    """
+    key_dir = tmp_path / "session_keys"
+    key_path = key_dir / "2001-02-03.key"
+
+    original_link = os.link
+
+    def racing_link(src: pathlib.Path, dst: pathlib.Path) -> None:
+        """
+        Simulate another worker creating the key just before we do.
+        """
+        key_path.write_bytes(b"5678")
+        original_link(src, dst)
+
+    monkeypatch.setattr(os, "link", racing_link)
+
+    assert get_session_key(datetime.date(2001, 2, 3), key_dir=key_dir) == b"5678"
+    assert os.listdir(key_dir) == ["2001-02-03.key"]